@@ -0,0 +1,400 @@
+import os
+import re
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from os.path import isdir, isfile
+
+from conversion_cache import ConversionCache
+from convert import Convert, engines
+from instrumentation import Instrumentation
+from lazy_imports import Gooey, GooeyParser, lazy_import
+from metadata_cache import MetadataCache
+from metadata_mapping import load_mapping
+from parallel_gzip import BackgroundCompressor, compression_modes
+from participants import ParticipantsTable
+from pipeline import ConversionPipeline, stages
+
+pandas = lazy_import('pandas')
+
+# determine whether to run as gui or not
+if len(sys.argv) >= 2:
+    if '--ignore-gooey' not in sys.argv:
+        sys.argv.append('--ignore-gooey')
+
+# columns recognized in a batch manifest, only folder is required
+manifest_columns = ['folder', 'subject_id', 'session_id', 'metadata_path', 'destination_path']
+
+# jobs journal their participants.tsv rows and merge them into the table every this many rows
+participants_flush_every = 100
+
+
+def read_manifest(manifest_path):
+    """
+    Reads a batch manifest (csv, tsv, or excel) into a list of job dictionaries. Each row describes
+    a single Convert job; blank cells are treated as not supplied.
+    :param manifest_path: path to the manifest file
+    :return: list of job dictionaries keyed by manifest_columns
+    """
+    extension = os.path.splitext(manifest_path)[1].lower()
+    if 'xls' in extension:
+        manifest = pandas.read_excel(manifest_path, dtype=str)
+    elif extension == '.tsv':
+        manifest = pandas.read_csv(manifest_path, sep='\t', dtype=str)
+    else:
+        manifest = pandas.read_csv(manifest_path, dtype=str)
+
+    manifest.columns = [column.strip().lower().replace('-', '_').replace(' ', '_') for column in manifest.columns]
+    if 'folder' not in manifest.columns:
+        raise Exception(f"Manifest {manifest_path} must contain a 'folder' column.")
+
+    jobs = []
+    for _, row in manifest.iterrows():
+        job = {}
+        for column in manifest_columns:
+            value = row.get(column)
+            job[column] = value.strip() if isinstance(value, str) and value.strip() else None
+        if job['folder']:
+            jobs.append(job)
+
+    return jobs
+
+
+def job_filename(job, extension):
+    """
+    :return: a file name unique to the job's folder, used for its trace and log files
+    """
+    return re.sub(r'[^a-zA-Z0-9_.-]', '_', os.path.abspath(job['folder']).strip(os.sep)) + extension
+
+
+def participants_root(job, dataset_root=None):
+    """
+    :return: the folder whose participants.tsv a job adds its subject to
+    """
+    if dataset_root:
+        return dataset_root
+    return job['destination_path'] if job['destination_path'] else job['folder']
+
+
+def flush_participants(jobs, dataset_root=None):
+    """
+    Merges the participants rows still pending at the end of a batch into each participants.tsv
+    """
+    for root in sorted({participants_root(job, dataset_root) for job in jobs}):
+        try:
+            ParticipantsTable(root).flush()
+        except OSError as err:
+            print(f"Unable to update participants.tsv in {root}: {err}")
+
+
+def make_converter(job, cache_dir=None, trace_dir=None, timeout=None, log_dir=None, metadata_cache_dir=None,
+                   mapping=None, dataset_root=None, compression='gzip', gzip_threads=None, engine='dcm2niix',
+                   verify_cache=False, threaded=False):
+    """
+    Creates the Convert for a job without running any of its stages
+    :param job: a job dictionary as returned by read_manifest
+    :param cache_dir: folder of a ConversionCache to share between jobs, optional
+    :param trace_dir: write a json trace of each job's stages into this folder, optional
+    :param timeout: kill dcm2niix if it runs longer than this many seconds, optional
+    :param log_dir: write each job's dcm2niix output into this folder, optional
+    :param metadata_cache_dir: keep parsed metadata workbooks in this folder so workers share them, optional
+    :param mapping: metadata mapping spec used to build each session's BIDS metadata, optional
+    :param dataset_root: add every subject to the participants.tsv in this folder instead of each destination's
+    :param compression: gzip, none, or background (the niftis are listed in the Convert's uncompressed_outputs)
+    :param gzip_threads: number of threads to gzip with, defaults to the number of cpus
+    :param engine: dcm2niix or native (see convert.engines)
+    :param verify_cache: check the checksums of cached conversions before reusing them
+    :param threaded: the Convert's stages will run on threads next to other sessions' (see Instrumentation)
+    :return: Convert
+    """
+    if not isdir(job['folder']):
+        raise FileNotFoundError(f"{job['folder']} is not a valid path")
+
+    instrumentation = None
+    if trace_dir:
+        instrumentation = Instrumentation(name=job['folder'],
+                                          trace_path=os.path.join(trace_dir, job_filename(job, '.json')),
+                                          threaded=threaded)
+    return Convert(
+        image_folder=job['folder'],
+        metadata_path=job['metadata_path'],
+        destination_path=job['destination_path'],
+        subject_id=job['subject_id'],
+        session_id=job['session_id'],
+        conversion_cache=ConversionCache(cache_dir, verify=verify_cache) if cache_dir else None,
+        instrumentation=instrumentation,
+        dcm2niix_timeout=timeout,
+        dcm2niix_log=os.path.join(log_dir, job_filename(job, '.log')) if log_dir else None,
+        metadata_cache=MetadataCache(metadata_cache_dir) if metadata_cache_dir else None,
+        mapping=mapping,
+        participants=ParticipantsTable(participants_root(job, dataset_root), flush_every=participants_flush_every),
+        compression=compression,
+        gzip_threads=gzip_threads,
+        engine=engine,
+        convert=False)
+
+
+def run_job(job, cache_dir=None, trace_dir=None, timeout=None, log_dir=None, metadata_cache_dir=None, mapping=None,
+            dataset_root=None, compression='gzip', gzip_threads=None, engine='dcm2niix', verify_cache=False):
+    """
+    Runs a single Convert job, this is the unit of work handed to each worker process. Exceptions
+    are caught and reported so that one bad session doesn't take down the rest of the batch.
+    :param job: a job dictionary as returned by read_manifest
+    :param cache_dir: folder of a ConversionCache to share between jobs, optional
+    :param trace_dir: write a json trace of each job's stages into this folder, optional
+    :param timeout: kill dcm2niix if it runs longer than this many seconds, optional
+    :param log_dir: write each job's dcm2niix output into this folder, optional
+    :param metadata_cache_dir: keep parsed metadata workbooks in this folder so workers share them, optional
+    :param mapping: metadata mapping spec used to build each session's BIDS metadata, optional
+    :param dataset_root: add every subject to the participants.tsv in this folder instead of each destination's
+    :param compression: gzip, none, or background (the niftis left to compress are listed under 'uncompressed')
+    :param gzip_threads: number of threads to gzip with, defaults to the number of cpus
+    :param engine: dcm2niix or native (see convert.engines)
+    :param verify_cache: check the checksums of cached conversions before reusing them
+    :return: a summary dictionary with the job's status, error (if any), and run time in seconds
+    """
+    summary = dict(job)
+    start = time.time()
+    converter = None
+    try:
+        converter = make_converter(job, cache_dir, trace_dir, timeout, log_dir, metadata_cache_dir, mapping,
+                                   dataset_root, compression, gzip_threads, engine, verify_cache)
+        for _, method, _ in stages:
+            getattr(converter, method)()
+
+        summary['status'] = 'success'
+        summary['error'] = None
+    except Exception as err:
+        summary['status'] = 'failed'
+        summary['error'] = f"{type(err).__name__}: {err}"
+        summary['traceback'] = traceback.format_exc()
+
+    if converter is not None and converter.uncompressed_outputs:
+        summary['uncompressed'] = converter.uncompressed_outputs
+    summary['seconds'] = round(time.time() - start, 3)
+    return summary
+
+
+def compress_in_background(compressor, compressing, result):
+    """
+    Hands the niftis a job left uncompressed to the batch's background compressor
+    :param compressor: BackgroundCompressor, or None when the batch isn't compressing in the background
+    :param compressing: dictionary of compression future -> job summary, filled in for finish_compression
+    :param result: the job's summary
+    :return:
+    """
+    uncompressed = result.pop('uncompressed', None)
+    if compressor is not None and uncompressed:
+        compressing[compressor.submit(uncompressed)] = result
+
+
+def finish_compression(compressor, compressing):
+    """
+    Waits for the background compressor to finish and fails the jobs whose niftis couldn't be compressed
+    """
+    if compressor is None:
+        return
+    compressor.close()
+    for future, result in compressing.items():
+        err = future.exception()
+        if err is not None:
+            result.update(status='failed', error=f"Compressing niftis: {type(err).__name__}: {err}")
+            print_result(result)
+
+
+def run_batch(jobs, workers=None, cache_dir=None, trace_dir=None, timeout=None, log_dir=None,
+              metadata_cache_dir=None, mapping=None, dataset_root=None, compression='gzip', gzip_threads=None,
+              engine='dcm2niix', verify_cache=False):
+    """
+    Runs Convert jobs over a process pool.
+    :param jobs: list of job dictionaries
+    :param workers: number of worker processes, defaults to the number of cpus
+    :param cache_dir: folder of a ConversionCache to share between jobs, optional
+    :param trace_dir: write a json trace of each job's stages into this folder, optional
+    :param timeout: kill dcm2niix if it runs longer than this many seconds, optional
+    :param log_dir: write each job's dcm2niix output into this folder, optional
+    :param metadata_cache_dir: keep parsed metadata workbooks in this folder so workers share them, optional
+    :param mapping: metadata mapping spec used to build each session's BIDS metadata, optional
+    :param dataset_root: add every subject to the participants.tsv in this folder instead of each destination's
+    :param compression: gzip, none, or background (workers write .nii and move on while this process gzips them)
+    :param gzip_threads: number of threads to gzip with, defaults to the number of cpus
+    :param engine: dcm2niix or native (see convert.engines)
+    :param verify_cache: check the checksums of cached conversions before reusing them
+    :return: list of job summaries in the same order as jobs
+    """
+    if not workers:
+        workers = os.cpu_count() or 1
+    for folder in (trace_dir, log_dir):
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    compressor = BackgroundCompressor(gzip_threads) if compression == 'background' else None
+    compressing = {}
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job, cache_dir, trace_dir, timeout, log_dir, metadata_cache_dir, mapping,
+                                   dataset_root, compression, gzip_threads, engine, verify_cache): index
+                   for index, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as err:
+                # the worker itself died (e.g. killed by the OS), record it against the job
+                results[index] = dict(jobs[index], status='failed', error=f"{type(err).__name__}: {err}",
+                                      seconds=None)
+            compress_in_background(compressor, compressing, results[index])
+            print_result(results[index])
+
+    finish_compression(compressor, compressing)
+    flush_participants(jobs, dataset_root)
+    return results
+
+
+def print_result(result):
+    print(f"[{result['status']}] {result['folder']}" + (f": {result['error']}" if result['error'] else ''))
+
+
+def run_pipeline(jobs, workers=None, cache_dir=None, trace_dir=None, timeout=None, log_dir=None,
+                 metadata_cache_dir=None, mapping=None, dataset_root=None, queue_size=2, compression='gzip',
+                 gzip_threads=None, engine='dcm2niix', verify_cache=False):
+    """
+    Runs Convert jobs through a ConversionPipeline in this process so that each session's header scan,
+    dcm2niix run, metadata parsing and writes overlap with those of its neighbours.
+    :param jobs: list of job dictionaries
+    :param workers: dictionary of stage name -> number of worker threads (see pipeline.stages)
+    :param cache_dir: folder of a ConversionCache to share between jobs, optional
+    :param trace_dir: write a json trace of each job's stages into this folder, optional
+    :param timeout: kill dcm2niix if it runs longer than this many seconds, optional
+    :param log_dir: write each job's dcm2niix output into this folder, optional
+    :param metadata_cache_dir: keep parsed metadata workbooks in this folder so workers share them, optional
+    :param mapping: metadata mapping spec used to build each session's BIDS metadata, optional
+    :param dataset_root: add every subject to the participants.tsv in this folder instead of each destination's
+    :param queue_size: number of sessions allowed to wait between two stages
+    :param compression: gzip, none, or background (compressed by a stage of its own while later sessions convert)
+    :param gzip_threads: number of threads to gzip with, defaults to the number of cpus
+    :param engine: dcm2niix or native (see convert.engines)
+    :param verify_cache: check the checksums of cached conversions before reusing them
+    :return: list of job summaries in the same order as jobs
+    """
+    for folder in (trace_dir, log_dir):
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    compressor = BackgroundCompressor(gzip_threads) if compression == 'background' else None
+    compressing = {}
+
+    def on_result(result):
+        compress_in_background(compressor, compressing, result)
+        print_result(result)
+
+    pipeline = ConversionPipeline(
+        partial(make_converter, cache_dir=cache_dir, trace_dir=trace_dir, timeout=timeout, log_dir=log_dir,
+                metadata_cache_dir=metadata_cache_dir, mapping=mapping, dataset_root=dataset_root,
+                compression=compression, gzip_threads=gzip_threads, engine=engine, verify_cache=verify_cache,
+                threaded=True),
+        workers=workers, queue_size=queue_size, on_result=on_result)
+    results = pipeline.run(jobs)
+    finish_compression(compressor, compressing)
+    flush_participants(jobs, dataset_root)
+    return results
+
+
+def write_summary(results, summary_path):
+    """
+    Writes the per-job summary to a tsv file
+    :param results: list of job summaries as returned by run_batch
+    :param summary_path: path to write the summary to
+    :return:
+    """
+    summary_df = pandas.DataFrame(results, columns=manifest_columns + ['status', 'error', 'seconds'])
+    summary_df.to_csv(summary_path, sep='\t', index=False)
+
+
+@Gooey
+def cli():
+    parser = GooeyParser()
+    parser.add_argument('manifest', type=str, widget="FileChooser",
+                        help="Path to a csv, tsv, or excel manifest with the columns: " +
+                             ", ".join(manifest_columns) + ". Only folder is required.")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Number of conversions to run at once, defaults to the number of cpus.")
+    parser.add_argument('-o', '--summary-path', type=str, default=None, widget="FileSaver",
+                        help="Write a per job success/failure summary tsv to this path.")
+    parser.add_argument('-c', '--cache-dir', type=str, default=None, widget="DirChooser",
+                        help="Reuse dcm2niix outputs stored in this folder when the same dicoms have already " +
+                             "been converted, new conversions are added to it.")
+    parser.add_argument('-t', '--trace-dir', type=str, default=None, widget="DirChooser",
+                        help="Write a json trace of the time, cpu, io, and memory used by each stage of each job " +
+                             "into this folder. With --pipeline stages share the process, so only wall time and " +
+                             "the cpu time of each stage's own thread are recorded.")
+    parser.add_argument('-M', '--metadata-cache-dir', type=str, default=None, widget="DirChooser",
+                        help="Keep parsed metadata workbooks in this folder so a workbook shared by many " +
+                             "sessions is only parsed once for the whole batch.")
+    parser.add_argument('--mapping', type=str, default=None, widget="FileChooser",
+                        help="Json (or yaml) spec describing how the BIDS metadata is built from the dicom header, " +
+                             "dcm2niix sidecar and metadata spreadsheet, defaults to mappings/nimh_pet.json.")
+    parser.add_argument('-r', '--dataset-root', type=str, default=None, widget="DirChooser",
+                        help="Root of the BIDS dataset, every subject is added to the participants.tsv there. " +
+                             "Defaults to each job's destination path.")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="Fail a job if dcm2niix runs for longer than this many seconds.")
+    parser.add_argument('-l', '--log-dir', type=str, default=None, widget="DirChooser",
+                        help="Write each job's dcm2niix output to a log file in this folder.")
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help="Run the batch as a pipeline in a single process, overlapping one session's header " +
+                             "scan and dcm2niix run with another's metadata parsing and writes. --workers then " +
+                             "sets the number of dcm2niix workers.")
+    parser.add_argument('-z', '--compression', type=str, default='gzip', choices=compression_modes,
+                        help="gzip the niftis as they're converted (with pigz if it's installed, otherwise on every " +
+                             "cpu in this process), leave them uncompressed, or write them uncompressed and gzip " +
+                             "them in the background while the next sessions convert.")
+    parser.add_argument('--gzip-threads', type=int, default=None,
+                        help="Number of threads to gzip each nifti with, defaults to the number of cpus.")
+    parser.add_argument('-e', '--engine', type=str, default='dcm2niix', choices=engines,
+                        help="Convert with the dcm2niix executable, or natively in each worker with pydicom and " +
+                             "nibabel, which skips starting a dcm2niix process and reading its sidecar back.")
+    parser.add_argument('--verify-cache', action='store_true',
+                        help="Check the checksums of cached conversions before reusing them, not just their sizes " +
+                             "and modification times.")
+    parser.add_argument('--queue-size', type=int, default=2,
+                        help="With --pipeline, the number of sessions allowed to wait between two stages.")
+    args = parser.parse_args()
+
+    if not isfile(args.manifest):
+        raise FileNotFoundError(f"{args.manifest} is not a valid path")
+
+    if args.mapping:
+        # fail on a broken spec now rather than once per job
+        load_mapping(args.mapping)
+
+    jobs = read_manifest(args.manifest)
+    if args.pipeline:
+        results = run_pipeline(jobs, workers={'dcm2niix': args.workers}, cache_dir=args.cache_dir,
+                               trace_dir=args.trace_dir, timeout=args.timeout, log_dir=args.log_dir,
+                               metadata_cache_dir=args.metadata_cache_dir, mapping=args.mapping,
+                               dataset_root=args.dataset_root, queue_size=args.queue_size,
+                               compression=args.compression, gzip_threads=args.gzip_threads, engine=args.engine,
+                               verify_cache=args.verify_cache)
+    else:
+        results = run_batch(jobs, workers=args.workers, cache_dir=args.cache_dir, trace_dir=args.trace_dir,
+                            timeout=args.timeout, log_dir=args.log_dir, metadata_cache_dir=args.metadata_cache_dir,
+                            mapping=args.mapping, dataset_root=args.dataset_root, compression=args.compression,
+                            gzip_threads=args.gzip_threads, engine=args.engine, verify_cache=args.verify_cache)
+
+    failed = [result for result in results if result['status'] != 'success']
+    print(f"Converted {len(results) - len(failed)} of {len(results)} sessions, {len(failed)} failed.")
+    for result in failed:
+        print(f"    {result['folder']}: {result['error']}")
+
+    if args.summary_path:
+        write_summary(results, args.summary_path)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,441 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from lazy_imports import lazy_import
+
+psutil = lazy_import('psutil')
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def bare_convert(image_folder, **arguments):
+    """
+    Creates a Convert without running any of its stages (convert=False) so that individual stages can be timed
+    on their own. None of the stages timed this way run the image conversion, so the native engine is used by
+    default to keep dcm2niix from being required.
+    :param image_folder: folder of dicoms
+    :param arguments: passed on to Convert
+    :return: Convert, with the output file names build_metadata would have set
+    """
+    from convert import Convert
+    arguments = dict({'subject_id': 'synthetic', 'engine': 'native'}, **arguments)
+    converter = Convert(image_folder, convert=False, **arguments)
+    converter.session_string = ''
+    converter.subject_string = 'sub-' + converter.subject_id
+    return converter
+
+
+def folder_size(folder):
+    """
+    :return: (total bytes, number of files) under folder
+    """
+    total, count = 0, 0
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+            count += 1
+    return total, count
+
+
+# Each stage takes the benchmark context and does any (untimed) setup, it returns a function that
+# does the timed work along with the number of bytes and items that work processes.
+
+def stage_header_scan_cold(context):
+    from dicom_index import DicomSeriesIndex
+    if os.path.exists(context['index_path']):
+        os.remove(context['index_path'])
+    index = DicomSeriesIndex(context['dicom_folder'], index_path=context['index_path'])
+    return index.update, context['dicom_bytes'], context['dicom_files']
+
+
+def stage_header_scan_warm(context):
+    from dicom_index import DicomSeriesIndex
+    DicomSeriesIndex(context['dicom_folder'], index_path=context['index_path']).update()
+
+    def work():
+        DicomSeriesIndex(context['dicom_folder'], index_path=context['index_path']).update()
+    return work, context['dicom_bytes'], context['dicom_files']
+
+
+def stage_dcm2niix(context):
+    from synthetic_data import write_dcm2niix_outputs
+    destination = context['nifti_folder']
+    shutil.rmtree(destination, ignore_errors=True)
+    os.makedirs(destination)
+
+    if context['dcm2niix']:
+        def work():
+            subprocess.run(['dcm2niix', '-w', '1', '-z', 'y', '-o', destination, context['dicom_folder']],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    else:
+        def work():
+            write_dcm2niix_outputs(destination, 'dcm', context['dicom_shape'])
+    return work, context['dicom_bytes'], context['dicom_files']
+
+
+def stage_native_convert(context):
+    # the in process alternative to dcm2niix, the header scan it builds on is timed by the header_scan stages
+    from dicom_index import DicomSeriesIndex
+    from native_convert import convert_index
+    destination = os.path.join(context['output_folder'], 'native')
+    shutil.rmtree(destination, ignore_errors=True)
+    index = DicomSeriesIndex(context['dicom_folder'], index_path=context['index_path'])
+    index.update()
+
+    def work():
+        convert_index(index, destination)
+    return work, context['dicom_bytes'], context['dicom_files']
+
+
+def stage_sidecar_discovery(context):
+    if not os.path.isdir(context['nifti_folder']) or not os.listdir(context['nifti_folder']):
+        stage_dcm2niix(context)[0]()
+    converter = bare_convert(context['dicom_folder'], destination_path=context['nifti_folder'])
+    return converter.extract_nifti_json, 0, len(os.listdir(context['nifti_folder']))
+
+
+def stage_metadata_parse(context):
+    converter = bare_convert(context['dicom_folder'], metadata_path=context['metadata_path'])
+    return converter.extract_metadata, os.path.getsize(context['metadata_path']), 1
+
+
+def stage_metadata_parse_cached(context):
+    # what a worker sees once another worker has parsed the workbook: only the on disk cache is warm
+    from metadata_cache import MetadataCache
+    cache = MetadataCache(os.path.join(os.path.dirname(context['metadata_path']), 'metadata_cache'))
+    cache.read(context['metadata_path'])
+    cache.clear()
+    converter = bare_convert(context['dicom_folder'], metadata_path=context['metadata_path'], metadata_cache=cache)
+    return converter.extract_metadata, os.path.getsize(context['metadata_path']), 1
+
+
+def stage_bespoke_and_writes(context):
+    from dicom_index import DicomSeriesIndex
+    from participants import ParticipantsTable
+    output_folder = context['output_folder']
+    os.makedirs(output_folder, exist_ok=True)
+
+    if not os.path.isdir(context['nifti_folder']) or not os.listdir(context['nifti_folder']):
+        stage_dcm2niix(context)[0]()
+
+    converter = bare_convert(context['dicom_folder'], destination_path=context['nifti_folder'],
+                             metadata_path=context['metadata_path'], participants=ParticipantsTable(output_folder))
+    index = DicomSeriesIndex(context['dicom_folder'], index_path=context['index_path'])
+    index.update()
+    converter.dicom_header_data = index.get_header()
+    converter.extract_nifti_json()
+    converter.extract_metadata()
+
+    def work():
+        bespoke_data = converter.bespoke()
+        converter.future_json = bespoke_data['future_json']
+        converter.future_blood_tsv = bespoke_data['future_blood_tsv']
+        converter.future_blood_json = bespoke_data['future_blood_json']
+        converter.participant_info = bespoke_data['participants_info']
+        converter.write_out_jsons(output_folder)
+        converter.write_out_blood_tsv(output_folder)
+    return work, 0, 1
+
+
+def stage_ecat_load_reorient(context):
+    from ecat_convert import ConvertToNifti
+
+    def work():
+        ConvertToNifti(context['ecat_path'], destination_path=context['output_folder'], dtype=context['dtype'])
+    return work, context['ecat_bytes'], context['ecat_frames']
+
+
+def stage_ecat_stream(context):
+    from ecat_convert import ConvertToNifti
+
+    def work():
+        ConvertToNifti(context['ecat_path'], destination_path=context['output_folder'], dtype=context['dtype'],
+                       stream=True)
+    return work, context['ecat_bytes'], context['ecat_frames']
+
+
+def stage_ecat_write_nifti(context):
+    from ecat_convert import ConvertToNifti
+    converter = ConvertToNifti(context['ecat_path'], destination_path=context['output_folder'],
+                               dtype=context['dtype'])
+    return converter.write_nifti, context['ecat_bytes'], context['ecat_frames']
+
+
+def uncompressed_ecat_nifti(context):
+    from ecat_convert import ConvertToNifti
+    converter = ConvertToNifti(context['ecat_path'], destination_path=context['output_folder'], dtype=context['dtype'],
+                               stream=True, compression='none')
+    return converter.nifti_file
+
+
+def stage_nifti_gzip(context):
+    from parallel_gzip import compress_file
+    nifti_path = uncompressed_ecat_nifti(context)
+
+    def work():
+        compress_file(nifti_path, remove=False)
+    return work, os.path.getsize(nifti_path), 1
+
+
+def stage_nifti_gzip_single_thread(context):
+    # what dcm2niix without pigz, or nibabel, would do
+    import gzip
+    nifti_path = uncompressed_ecat_nifti(context)
+
+    def work():
+        with open(nifti_path, 'rb') as infile, gzip.open(nifti_path + '.gz', 'wb', compresslevel=6) as outfile:
+            shutil.copyfileobj(infile, outfile, 1 << 20)
+    return work, os.path.getsize(nifti_path), 1
+
+
+stages = {
+    'header_scan_cold': stage_header_scan_cold,
+    'header_scan_warm': stage_header_scan_warm,
+    'dcm2niix': stage_dcm2niix,
+    'native_convert': stage_native_convert,
+    'sidecar_discovery': stage_sidecar_discovery,
+    'metadata_parse': stage_metadata_parse,
+    'metadata_parse_cached': stage_metadata_parse_cached,
+    'bespoke_and_writes': stage_bespoke_and_writes,
+    'ecat_load_reorient': stage_ecat_load_reorient,
+    'ecat_stream': stage_ecat_stream,
+    'ecat_write_nifti': stage_ecat_write_nifti,
+    'nifti_gzip': stage_nifti_gzip,
+    'nifti_gzip_single_thread': stage_nifti_gzip_single_thread,
+}
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process in bytes
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, mac reports bytes
+        return peak if platform.system() == 'Darwin' else peak * 1024
+    memory = psutil.Process().memory_info()
+    return getattr(memory, 'peak_wset', memory.rss)
+
+
+def measure_stage(name, context):
+    """
+    Runs a single stage and measures it, this is called in a fresh process so that peak memory
+    belongs to the stage alone.
+    :param name: key into stages
+    :param context: benchmark context
+    :return: measurement dictionary
+    """
+    # load the heavy dependencies up front so import time isn't counted against the stage
+    for module in ('numpy', 'pandas', 'pydicom', 'nibabel'):
+        getattr(lazy_import(module), '__name__')
+
+    work, processed_bytes, items = stages[name](context)
+    start_rss = psutil.Process().memory_info().rss
+    start_times = os.times()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+
+    work()
+
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    end_times = os.times()
+    child_cpu = (end_times.children_user - start_times.children_user) + \
+                (end_times.children_system - start_times.children_system)
+    peak = peak_rss()
+    return {
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'subprocess_cpu_seconds': child_cpu,
+        'peak_rss_bytes': peak,
+        'start_rss_bytes': start_rss,
+        'peak_rss_over_start_bytes': max(peak - start_rss, 0),
+        'bytes': processed_bytes,
+        'items': items,
+    }
+
+
+def run_stage(name, context, repeats=3):
+    """
+    Runs a stage repeats times, each time in its own spawned process.
+    :return: summary of the stage's measurements
+    """
+    runs = []
+    error = None
+    spawn = multiprocessing.get_context('spawn')
+    for _ in range(repeats):
+        with spawn.Pool(1) as pool:
+            try:
+                runs.append(pool.apply(measure_stage, (name, context)))
+            except Exception as err:
+                error = f"{type(err).__name__}: {err}"
+                break
+
+    result = {'stage': name, 'status': 'failed' if error else 'success', 'error': error, 'repeats': len(runs)}
+    if runs:
+        wall = statistics.median(run['wall_seconds'] for run in runs)
+        result.update({
+            'wall_seconds': round(wall, 6),
+            'min_wall_seconds': round(min(run['wall_seconds'] for run in runs), 6),
+            'cpu_seconds': round(statistics.median(run['cpu_seconds'] for run in runs), 6),
+            'subprocess_cpu_seconds': round(statistics.median(run['subprocess_cpu_seconds'] for run in runs), 6),
+            'peak_rss_mb': round(max(run['peak_rss_bytes'] for run in runs) / 1024 ** 2, 2),
+            'start_rss_mb': round(max(run['start_rss_bytes'] for run in runs) / 1024 ** 2, 2),
+            'peak_rss_over_start_mb': round(max(run['peak_rss_over_start_bytes'] for run in runs) / 1024 ** 2, 2),
+            'mb_per_second': round(runs[0]['bytes'] / 1024 ** 2 / wall, 3) if wall and runs[0]['bytes'] else None,
+            'items_per_second': round(runs[0]['items'] / wall, 3) if wall and runs[0]['items'] else None,
+        })
+    return result
+
+
+def prepare(workdir, slices, frames, rows, columns, dtype):
+    """
+    Generates the synthetic inputs in workdir
+    :return: benchmark context
+    """
+    from synthetic_data import write_ecat, write_metadata_workbook, write_pet_dicom_series
+
+    context = {
+        'dicom_folder': os.path.join(workdir, 'dicom'),
+        'index_path': os.path.join(workdir, 'dicom_series_index.json'),
+        'nifti_folder': os.path.join(workdir, 'nifti'),
+        'output_folder': os.path.join(workdir, 'output'),
+        'metadata_path': os.path.join(workdir, 'metadata.xlsx'),
+        'ecat_path': os.path.join(workdir, 'synthetic.v'),
+        'dicom_shape': (rows, columns, slices, frames),
+        'ecat_frames': frames,
+        'dtype': dtype,
+        'dcm2niix': shutil.which('dcm2niix') is not None,
+    }
+    write_pet_dicom_series(context['dicom_folder'], slices=slices, frames=frames, rows=rows, columns=columns)
+    context['dicom_bytes'], context['dicom_files'] = folder_size(context['dicom_folder'])
+    write_ecat(context['ecat_path'], shape=(columns, rows, slices), frames=frames)
+    context['ecat_bytes'] = os.path.getsize(context['ecat_path'])
+    try:
+        write_metadata_workbook(context['metadata_path'])
+    except ImportError as err:
+        print(f"Unable to write metadata workbook, skipping spreadsheet stages: {err}")
+        context['metadata_path'] = None
+    os.makedirs(context['output_folder'], exist_ok=True)
+    return context
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(slices=47, frames=10, rows=128, columns=128, dtype='float64', repeats=3, selected=None,
+                   workdir=None):
+    """
+    Generates synthetic data then times each stage
+    :return: results dictionary
+    """
+    cleanup = workdir is None
+    workdir = workdir if workdir else tempfile.mkdtemp(prefix='bespoke_benchmark_')
+    try:
+        context = prepare(workdir, slices, frames, rows, columns, dtype)
+        results = {
+            'commit': git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'parameters': {'slices': slices, 'frames': frames, 'rows': rows, 'columns': columns, 'dtype': dtype,
+                           'repeats': repeats, 'dcm2niix': 'binary' if context['dcm2niix'] else 'stub'},
+            'stages': [],
+        }
+        for name in selected or stages:
+            if name in ('metadata_parse', 'metadata_parse_cached', 'bespoke_and_writes') and not context['metadata_path']:
+                results['stages'].append({'stage': name, 'status': 'skipped', 'error': 'no metadata workbook'})
+                continue
+            result = run_stage(name, context, repeats)
+            results['stages'].append(result)
+            print(format_result(result))
+        return results
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def format_result(result):
+    if result['status'] != 'success':
+        return f"{result['stage']:<20} {result['status']}: {result['error']}"
+    throughput = f"{result['mb_per_second']} MB/s" if result['mb_per_second'] else \
+        f"{result['items_per_second']} items/s"
+    return f"{result['stage']:<20} {result['wall_seconds']:>10.4f}s wall {result['cpu_seconds']:>10.4f}s cpu " + \
+           f"{result['peak_rss_mb']:>9.1f}MB peak  {throughput}"
+
+
+def compare(current, previous):
+    """
+    Prints the change in median wall time and peak memory of each stage relative to an earlier run
+    :param current: results of this run
+    :param previous: results loaded from an earlier run's json
+    :return:
+    """
+    earlier = {result['stage']: result for result in previous['stages'] if result.get('status') == 'success'}
+    print(f"compared to {previous.get('commit')} ({previous.get('created')}):")
+    if previous.get('parameters') != current['parameters']:
+        print(f"    warning, parameters differ: {previous.get('parameters')} vs {current['parameters']}")
+    for result in current['stages']:
+        before = earlier.get(result['stage'])
+        if result.get('status') != 'success' or before is None:
+            continue
+        wall_ratio = result['wall_seconds'] / before['wall_seconds'] if before['wall_seconds'] else float('nan')
+        memory_ratio = result['peak_rss_mb'] / before['peak_rss_mb'] if before['peak_rss_mb'] else float('nan')
+        print(f"    {result['stage']:<20} wall x{wall_ratio:.2f}  peak memory x{memory_ratio:.2f}")
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks each conversion stage against synthetic PET dicom and ECAT 7.3 data.")
+    parser.add_argument('--slices', type=int, default=47, help="Slices per frame.")
+    parser.add_argument('--frames', type=int, default=10, help="Number of frames.")
+    parser.add_argument('--rows', type=int, default=128, help="Rows per slice.")
+    parser.add_argument('--columns', type=int, default=128, help="Columns per slice.")
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float32', 'float64'],
+                        help="Output data type used for the ECAT stages.")
+    parser.add_argument('-r', '--repeats', type=int, default=3, help="Times to run each stage.")
+    parser.add_argument('--stages', nargs='+', choices=list(stages), default=None,
+                        help="Only run these stages, defaults to all of them.")
+    parser.add_argument('--workdir', type=str, default=None,
+                        help="Folder to generate data in, kept afterwards. Defaults to a temporary folder.")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Write results as json to this path.")
+    parser.add_argument('--compare', type=str, default=None, help="Results json from an earlier run to compare to.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(slices=args.slices, frames=args.frames, rows=args.rows, columns=args.columns,
+                             dtype=args.dtype, repeats=args.repeats, selected=args.stages, workdir=args.workdir)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            compare(results, json.load(infile))
+
+    if any(result['status'] == 'failed' for result in results['stages']):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
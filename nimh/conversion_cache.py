@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# where converted outputs are kept if no cache directory is supplied
+default_cache_dir = os.environ.get(
+    'BESPOKE_CONVERSION_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'bespoke_bids_converters', 'dcm2niix'))
+
+# dcm2niix output files, these are left out of an input fingerprint so that converting into the
+# image folder itself doesn't change the fingerprint of that folder
+output_extensions = ('.nii', '.nii.gz', '.json', '.bval', '.bvec')
+
+manifest_filename = 'manifest.json'
+
+
+def _sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConversionCache:
+    def __init__(self, cache_dir=None, max_age_days=30, max_size_gb=50, hash_contents=False, verify=False):
+        """
+        A cache of dcm2niix outputs keyed by a fingerprint of the input dicom files and the flags
+        dcm2niix was run with. Entries are checked against the sizes and modification times recorded
+        when they were stored before being reused and are evicted by age and total cache size.
+        :param cache_dir: folder to keep cached conversions in, defaults to default_cache_dir
+        :param max_age_days: entries that haven't been used in this many days are evicted
+        :param max_size_gb: least recently used entries are evicted once the cache grows past this size
+        :param hash_contents: fingerprint inputs by their contents instead of their path, size and
+        modification time, slower but survives copying the dicoms somewhere else
+        :param verify: also check the checksums of an entry's files before reusing it, this reads the whole
+        entry back so it's only worth it when the cache is suspected of being damaged
+        """
+        self.cache_dir = cache_dir if cache_dir else default_cache_dir
+        self.max_age_seconds = max_age_days * 24 * 60 * 60 if max_age_days else None
+        self.max_size_bytes = int(max_size_gb * 1024 ** 3) if max_size_gb else None
+        self.hash_contents = hash_contents
+        self.verify = verify
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def fingerprint(self, image_folder, flags):
+        """
+        Creates a fingerprint for a set of dicom inputs and dcm2niix flags
+        :param image_folder: folder containing the dicom files
+        :param flags: list of flags passed to dcm2niix (excluding the output and input paths)
+        :return: hex digest
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(list(flags)).encode())
+        for root, dirs, files in os.walk(image_folder):
+            dirs.sort()
+            for f in sorted(files):
+                if f.startswith('.') or f.lower().endswith(output_extensions):
+                    continue
+                path = os.path.join(root, f)
+                digest.update(os.path.relpath(path, image_folder).encode())
+                if self.hash_contents:
+                    digest.update(_sha256(path).encode())
+                else:
+                    stat = os.stat(path)
+                    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    def entry_path(self, fingerprint):
+        return os.path.join(self.cache_dir, fingerprint[:2], fingerprint)
+
+    def lookup(self, fingerprint):
+        """
+        Checks for an intact cache entry, entries with missing or altered files are removed.
+        :param fingerprint: fingerprint as returned by self.fingerprint
+        :return: the entry's manifest or None
+        """
+        entry = self.entry_path(fingerprint)
+        try:
+            with open(os.path.join(entry, manifest_filename), 'r') as infile:
+                manifest = json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+        for name, recorded in manifest['files'].items():
+            path = os.path.join(entry, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            # entries stored before modification times were recorded are checked by their checksums
+            if stat is None or stat.st_size != recorded['size'] or \
+                    stat.st_mtime_ns != recorded.get('mtime', stat.st_mtime_ns) or \
+                    ((self.verify or 'mtime' not in recorded) and _sha256(path) != recorded['sha256']):
+                print(f"Cached conversion {fingerprint} is damaged, discarding it.")
+                shutil.rmtree(entry, ignore_errors=True)
+                return None
+
+        return manifest
+
+    def restore(self, fingerprint, destination_path):
+        """
+        Places the cached outputs for a fingerprint into destination_path
+        :param fingerprint: fingerprint as returned by self.fingerprint
+        :param destination_path: folder to place the outputs in
+        :return: list of restored file paths, or None if there is no usable cache entry
+        """
+        manifest = self.lookup(fingerprint)
+        if manifest is None:
+            return None
+
+        entry = self.entry_path(fingerprint)
+        restored = []
+        for name in manifest['files']:
+            target = os.path.join(destination_path, name)
+            if os.path.exists(target):
+                os.remove(target)
+            shutil.copy2(os.path.join(entry, name), target)
+            restored.append(target)
+
+        # mark the entry as recently used
+        os.utime(os.path.join(entry, manifest_filename))
+        return restored
+
+    def store(self, fingerprint, output_files):
+        """
+        Copies dcm2niix outputs into the cache
+        :param fingerprint: fingerprint as returned by self.fingerprint
+        :param output_files: paths to the files dcm2niix produced
+        :return:
+        """
+        entry = self.entry_path(fingerprint)
+        if not output_files or os.path.isdir(entry):
+            return
+
+        temporary_entry = entry + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        os.makedirs(temporary_entry, exist_ok=True)
+        manifest = {'created': time.time(), 'files': {}}
+        for path in output_files:
+            name = os.path.basename(path)
+            cached_path = os.path.join(temporary_entry, name)
+            shutil.copy2(path, cached_path)
+            stat = os.stat(cached_path)
+            manifest['files'][name] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': _sha256(path)}
+
+        with open(os.path.join(temporary_entry, manifest_filename), 'w') as outfile:
+            json.dump(manifest, outfile, indent=4)
+
+        try:
+            os.rename(temporary_entry, entry)
+        except OSError:
+            # another process stored the same conversion first
+            shutil.rmtree(temporary_entry, ignore_errors=True)
+
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (entry path, last used time, size in bytes) for every entry in the cache
+        """
+        found = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_path = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for name in os.listdir(prefix_path):
+                entry = os.path.join(prefix_path, name)
+                manifest_path = os.path.join(entry, manifest_filename)
+                if name.endswith('.tmp') or not os.path.isfile(manifest_path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                found.append((entry, os.path.getmtime(manifest_path), size))
+        return found
+
+    def evict(self):
+        """
+        Removes entries older than max_age_days, then removes the least recently used entries until
+        the cache is smaller than max_size_gb.
+        :return: list of evicted entry paths
+        """
+        evicted = []
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        now = time.time()
+
+        if self.max_age_seconds:
+            for entry in [entry for entry in entries if now - entry[1] > self.max_age_seconds]:
+                shutil.rmtree(entry[0], ignore_errors=True)
+                evicted.append(entry[0])
+                entries.remove(entry)
+
+        if self.max_size_bytes:
+            total_size = sum(entry[2] for entry in entries)
+            while entries and total_size > self.max_size_bytes:
+                entry = entries.pop(0)
+                shutil.rmtree(entry[0], ignore_errors=True)
+                evicted.append(entry[0])
+                total_size -= entry[2]
+
+        return evicted
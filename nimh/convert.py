@@ -1,17 +1,31 @@
 import os.path
-import subprocess
-import pandas
-import pandas as pd
+import shutil
 import sys
 from os.path import isdir, isfile
-from os import listdir, walk, makedirs
+from os import listdir, makedirs
 import pathlib
 import json
-import pydicom
 import re
 import platform
-from numpy import cumsum
-from gooey import Gooey, GooeyParser
+
+from conversion_cache import ConversionCache, output_extensions
+from dcm2niix_runner import compression_flags, default_flags, run_dcm2niix
+from dicom_index import DicomSeriesIndex
+from instrumentation import Instrumentation
+from lazy_imports import Gooey, GooeyParser, lazy_import
+from metadata_cache import MetadataCache
+from metadata_mapping import load_mapping
+from native_convert import convert_index
+from nifti_index import NiftiSidecarIndex, split_nifti_path
+from parallel_gzip import BackgroundCompressor, compress_file, compression_modes, pigz_available
+from participants import ParticipantsTable
+
+# heavy dependencies are only loaded once they're used
+pandas = lazy_import('pandas')
+pd = pandas
+
+# what turns the dicoms into niftis: the dcm2niix executable, or native_convert.py in this process
+engines = ('dcm2niix', 'native')
 
 # determine whether to run as gui or not
 if len(sys.argv) >= 2:
@@ -20,43 +34,113 @@ if len(sys.argv) >= 2:
 
 
 class Convert:
-    def __init__(self, image_folder, metadata_path=None, destination_path=None, subject_id=None, session_id=None):
+    def __init__(self, image_folder, metadata_path=None, destination_path=None, subject_id=None, session_id=None,
+                 conversion_cache=None, instrumentation=None, dcm2niix_timeout=None, dcm2niix_log=None, metadata_cache=None, mapping=None,
+                 participants=None, compression='gzip', gzip_threads=None, compressor=None, engine='dcm2niix',
+                 convert=True):
+        """
+        Converts a folder of dicoms to nifti and builds BIDS metadata for it. By default every stage is
+        run immediately, pass convert=False to run scan_headers, convert_images, build_metadata and
+        write_outputs individually (see pipeline.py).
+        """
         self.image_folder = image_folder
         self.metadata_path = metadata_path
         self.destination_path = None
         self.subject_id = subject_id
+        self.supplied_subject_id = subject_id
         self.session_id = session_id
         self.metadata_dataframe = None  # dataframe object of text file metadata
         self.dicom_header_data = None  # extracted data from dicom header
+        self.dicom_index = None  # index of the dicom series in image_folder
         self.nifti_json_data = None  # extracted data from dcm2niix generated json file
+        self.nifti_outputs = []  # files written (or restored from the cache) by the last dcm2niix run
+        self.nifti_index = None  # index of the niftis and sidecars in destination_path
+        self.nifti_path = None  # the nifti paired with nifti_json_data
+        self.conversion_cache = conversion_cache  # ConversionCache used to skip redundant dcm2niix runs
+        self.dcm2niix_timeout = dcm2niix_timeout  # seconds before a hung dcm2niix is killed, None waits forever
+        self.dcm2niix_log = dcm2niix_log  # file to stream dcm2niix's output into, optional
+        self.dcm2niix_result = None  # parsed output of the last dcm2niix run, see dcm2niix_runner.make_result
+        # parsed metadata workbooks, by default they're only shared between sessions converted in this process
+        self.metadata_cache = metadata_cache if metadata_cache else MetadataCache(persist=False)
+        # spec for building BIDS metadata, path or MappingPlan, defaults to metadata_mapping.default_mapping
+        self.mapping = mapping
+        self.participants = participants  # ParticipantsTable subjects are added to, see write_out_blood_tsv
+        # how niftis are written: gzip, none (.nii), or background (.nii handed to compressor), see compress_outputs
+        self.compression = compression
+        self.gzip_threads = gzip_threads  # threads used to gzip niftis when dcm2niix can't use pigz, defaults to cpus
+        self.compressor = compressor  # BackgroundCompressor for 'background' compression, optional
+        self.uncompressed_outputs = []  # niftis left for a background compressor by the last dcm2niix run
+        self.engine = engine  # 'dcm2niix' or 'native', see engines
+        # records the time and resources used by each stage, disabled unless one is supplied
+        self.instrumentation = instrumentation if instrumentation else Instrumentation(enabled=False)
 
         # if no destination path is supplied plop nifti into the same folder as the dicom images
         if not destination_path:
             self.destination_path = self.image_folder
         else:
             # make sure destination path exists
-            if isdir(destination_path):
-                self.destination_path = destination_path
-                pass
-            else:
+            if not isdir(destination_path):
                 print(f"No folder found at destination, creating folder(s) at {destination_path}")
                 makedirs(destination_path)
+            self.destination_path = destination_path
+
+        if self.compression not in compression_modes:
+            raise Exception(f"Unknown compression {self.compression}, expected one of {list(compression_modes)}")
 
-        if self.check_for_dcm2niix() != 0:
+        if self.participants is None:
+            self.participants = ParticipantsTable(self.destination_path)
+
+        if self.engine not in engines:
+            raise Exception(f"Unknown engine {self.engine}, expected one of {list(engines)}")
+
+        if self.engine == 'dcm2niix' and self.check_for_dcm2niix() != 0:
             raise Exception("dcm2niix error:\n" +
                             "The converter relies on dcm2niix.\n" +
                             "dcm2niix was not found in path, try installing or adding to path variable.")
 
         # no reason not to convert the image files immediately if dcm2niix is there
-        self.run_dcm2niix()
+        if convert:
+            self.scan_headers()
+            self.convert_images()
+            self.build_metadata()
 
-        # extract all metadata
-        self.extract_dicom_header()
-        self.extract_nifti_json()
+    def scan_headers(self):
+        """
+        First stage of a conversion, reads the dicom headers (io bound)
+        :return:
+        """
+        with self.instrumentation.stage('extract_dicom_header'):
+            self.extract_dicom_header()
+
+    def convert_images(self):
+        """
+        Second stage of a conversion, runs dcm2niix (cpu bound) and loads the sidecar it wrote, or converts
+        in process with the native engine which hands over its sidecar directly
+        :return:
+        """
+        self.nifti_json_data = None
+        if self.engine == 'native':
+            with self.instrumentation.stage('native_convert', image_folder=self.image_folder):
+                self.run_native()
+        else:
+            with self.instrumentation.stage('dcm2niix', image_folder=self.image_folder):
+                self.run_dcm2niix()
+        if self.nifti_json_data is None:
+            with self.instrumentation.stage('extract_nifti_json'):
+                self.extract_nifti_json()
+
+    def build_metadata(self):
+        """
+        Third stage of a conversion, parses the metadata spreadsheet and assembles the output structures
+        and file names
+        :return:
+        """
         if self.metadata_path:
-            self.extract_metadata()
+            with self.instrumentation.stage('extract_metadata', metadata_path=self.metadata_path):
+                self.extract_metadata()
             # build output structures for metadata
-            bespoke_data = self.bespoke()
+            with self.instrumentation.stage('bespoke'):
+                bespoke_data = self.bespoke()
 
             # assign output structures to class variables
             self.future_json = bespoke_data['future_json']
@@ -71,8 +155,8 @@ class Convert:
             self.session_string = ''
 
         # now for subject id
-        if subject_id:
-            self.subject_id = subject_id
+        if self.supplied_subject_id:
+            self.subject_id = self.supplied_subject_id
         else:
             self.subject_id = str(self.dicom_header_data.PatientName)
             # check for non-bids values
@@ -80,57 +164,86 @@ class Convert:
 
         self.subject_string = 'sub-' + self.subject_id
 
+    def write_outputs(self):
+        """
+        Last stage of a conversion, writes out the jsons and tsvs built from the metadata (if any)
+        :return:
+        """
+        if self.metadata_path:
+            self.write_out_jsons()
+            self.write_out_blood_tsv()
+
     @staticmethod
     def check_for_dcm2niix():
-        check = subprocess.run("dcm2niix -h", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return check.returncode
+        return 0 if shutil.which('dcm2niix') else 1
 
     def extract_dicom_header(self, additional_fields=[]):
         """
-        Opening up files till a dicom is located, then extracting any header information
+        Scans the headers of the dicoms in the image folder, then extracts any header information
         to be used during and after the conversion process. This includes patient/subject id,
-        as well any additional frame or metadata that's required for
+        as well any additional frame or metadata that's required for. Only the tags listed in
+        dicom_index.header_tags (plus additional_fields) are read and the results are kept in an
+        index inside of the image folder so later runs don't have to re-read unchanged files.
+        :param additional_fields: extra dicom tags to collect on top of dicom_index.header_tags
         :return:
         """
 
-        for root, dirs, files in os.walk(self.image_folder):
-            for f in files:
-                try:
-                    dicom_header = pydicom.dcmread(os.path.join(root, f))
-
-                    # collect subject/patient id if none is supplied
-                    if self.subject_id is None:
-                        self.subject_id = dicom_header.PatientID
+        self.dicom_index = DicomSeriesIndex(self.image_folder, tags=additional_fields)
+        self.dicom_index.update()
+        dicom_header = self.dicom_index.get_header()
 
-                    self.dicom_header_data = dicom_header
-                    break
+        if dicom_header is not None:
+            # collect subject/patient id if none is supplied
+            if self.subject_id is None:
+                self.subject_id = dicom_header.PatientID
 
-                except pydicom.errors.InvalidDicomError:
-                    pass
+            self.dicom_header_data = dicom_header
 
     def extract_nifti_json(self):
         """
-        Collects the information contained in the wanted information list and adds it to self.
+        Finds the sidecar json dcm2niix wrote for this session and loads it. The destination path is
+        indexed in a single pass (see nifti_index.NiftiSidecarIndex) and the index is reused between
+        runs. Sidecars written by this run's dcm2niix call are preferred, then those whose series
+        matches the dicom header, then the most recently written one.
         :return:
         """
-
-        # look for nifti json in destination folder
-        pet_json = None
-        collect_contents = listdir(self.destination_path)
-        for filepath in collect_contents:
-            if ".json" in filepath:
-                pet_json = os.path.join(self.destination_path, filepath)
-                break
-            else:
-                for root, dirs, files in os.walk(self.destination_path):
-                    for f in files:
-                        if ".json" in f:
-                            pet_json = os.path.join(root, f)
-                            break
-
-        if pet_json is None:
+        self.nifti_index = NiftiSidecarIndex(self.destination_path)
+
+        candidates = []
+        if self.nifti_outputs:
+            # no need to walk the destination, just add what dcm2niix just wrote
+            self.nifti_index.add(self.nifti_outputs)
+            produced = {split_nifti_path(path)[0] for path in self.nifti_outputs}
+            images = {path for path in self.nifti_outputs if split_nifti_path(path)[1]}
+            image_stems = {split_nifti_path(path)[0] for path in images}
+            # a .nii or .nii.gz left by an earlier run shares its name with this run's image, only keep this run's
+            candidates = [match for match in self.nifti_index.find() if split_nifti_path(match[0])[0] in produced
+                          and (match[0] in images or split_nifti_path(match[0])[0] not in image_stems)]
+        if not candidates:
+            self.nifti_index.update()
+            candidates = self.nifti_index.find()
+
+        if len(candidates) > 1 and self.dicom_header_data is not None:
+            series_uid = str(self.dicom_header_data.get('SeriesInstanceUID', '')) or None
+            series_number = self.dicom_header_data.get('SeriesNumber')
+            matching = []
+            for candidate in candidates:
+                entry = candidate[2]
+                if entry.get('SeriesInstanceUID'):
+                    if entry['SeriesInstanceUID'] == series_uid:
+                        matching.append(candidate)
+                elif series_number is not None and entry.get('SeriesNumber') == int(series_number):
+                    matching.append(candidate)
+            if matching:
+                candidates = matching
+
+        if not candidates:
             raise Exception("Unable to find json file for nifti image")
+        if len(candidates) > 1:
+            print(f"Found {len(candidates)} nifti sidecars that could belong to {self.image_folder}, " +
+                  f"using the most recent: {candidates[0][1]}")
 
+        self.nifti_path, pet_json, _ = candidates[0]
         with open(pet_json, 'r') as infile:
             self.nifti_json_data = json.load(infile)
 
@@ -144,103 +257,161 @@ class Convert:
         self.open_meta_data(metadata_extension)
 
     def open_meta_data(self, extension):
-        methods = {'excel': pd.read_excel}
-
-        if 'xls' in extension:
-            proper_method = 'excel'
-        else:
-            proper_method = extension
+        """
+        Reads the metadata file through the metadata cache, so a workbook shared by many sessions is only
+        parsed once.
+        :param extension: the metadata file's extension
+        :return:
+        """
+        if not any(known in extension.lower() for known in ('xls', 'csv', 'tsv')):
+            raise Exception(f"Unable to read metadata from {self.metadata_path}, expected an excel, csv, or tsv file.")
 
         try:
-            use_me_to_read = methods.get(proper_method, None)
-            self.metadata_dataframe = use_me_to_read(self.metadata_path)
+            self.metadata_dataframe = self.metadata_cache.read(self.metadata_path)
         except IOError as err:
-            raise err(f"Problem opening {self.metadata_path}")
+            raise IOError(f"Problem opening {self.metadata_path}") from err
+
+    def list_outputs(self):
+        """
+        Lists the dcm2niix output files currently sitting in the destination path
+        :return: dictionary of output file path -> modification time
+        """
+        outputs = {}
+        for f in listdir(self.destination_path):
+            path = os.path.join(self.destination_path, f)
+            if f.lower().endswith(output_extensions) and isfile(path):
+                outputs[path] = os.stat(path).st_mtime_ns
+        return outputs
 
     def run_dcm2niix(self):
         """
-        Just passing some args to dcm2niix using the good ole shell
+        Runs dcm2niix on the image folder (see dcm2niix_runner), if it hangs for longer than
+        dcm2niix_timeout it's killed. If a conversion cache was supplied and it holds the outputs for
+        this set of dicoms and flags they are copied into the destination path instead of running
+        dcm2niix again.
         :return:
         """
-
-        convert = subprocess.run(f"dcm2niix -w 1 -z y -o {self.destination_path} {self.image_folder}", shell=True,
-                                 capture_output=True)
-        if convert.returncode != 0 and bytes("Skipping existing file named",
-                                             'utf-8') not in convert.stdout or convert.stderr:
-            print(convert.stderr)
+        # without pigz dcm2niix gzips on a single thread, it's faster to have it write .nii and compress them here
+        compress_here = self.compression == 'background' or (self.compression == 'gzip' and not pigz_available())
+        flags = compression_flags(default_flags, self.compression == 'gzip')
+        if compress_here:
+            flags = compression_flags(flags, False)
+        # gzipped here or by dcm2niix the outputs are the same, so they share cached conversions
+        cache_flags = compression_flags(flags, True) if self.compression == 'gzip' else flags
+
+        fingerprint = None
+        if self.conversion_cache:
+            fingerprint = self.conversion_cache.fingerprint(self.image_folder, cache_flags)
+            restored = self.conversion_cache.restore(fingerprint, self.destination_path)
+            if restored:
+                print(f"Reusing cached conversion of {self.image_folder}")
+                self.nifti_outputs = restored
+                if self.compression == 'background':
+                    self.compress_outputs()
+                return
+
+        existing_outputs = self.list_outputs()
+        self.dcm2niix_result = run_dcm2niix(self.image_folder, self.destination_path, flags=flags,
+                                            timeout=self.dcm2niix_timeout, log_path=self.dcm2niix_log)
+        for warning in self.dcm2niix_result['warnings']:
+            print(warning)
+        if not self.dcm2niix_result['succeeded']:
+            print("\n".join(self.dcm2niix_result['errors'] or self.dcm2niix_result['tail']))
             raise Exception("Error during image conversion from dcm to nii!")
 
+        self.nifti_outputs = self.dcm2niix_result['written']
+        if not any(split_nifti_path(path)[1] for path in self.nifti_outputs):
+            # dcm2niix's output couldn't be parsed (or didn't name the image), look at what changed in the
+            # destination instead so a session is never compressed or cached without its image
+            changed = [path for path, mtime in self.list_outputs().items() if existing_outputs.get(path) != mtime]
+            self.nifti_outputs = sorted(set(self.nifti_outputs) | set(changed))
+        if not any(split_nifti_path(path)[1] for path in self.nifti_outputs):
+            raise Exception(f"dcm2niix didn't write a nifti for {self.image_folder}")
+        if compress_here and self.compression == 'gzip':
+            self.compress_outputs()
+        if fingerprint:
+            self.conversion_cache.store(fingerprint, self.nifti_outputs)
+        if self.compression == 'background':
+            self.compress_outputs()
+
         # note dcm2niix will go through folder and look for dicoms, it will then create a nifti with a filename
         # of the folder dcm2niix was pointed at with a .nii extension. In other words it will place a .nii file with
         # the parent folder's name in the parent folder. We need to keep track of this path and possibly (most likely)
         # rename it
 
-    def bespoke(self):
-
-        future_json = {
-            'Manufacturer': self.nifti_json_data.get('Manufacturer'),
-            'ManufacturersModelName': self.nifti_json_data.get('ManufacturersModelName'),
-            'Units': 'Bq/mL',
-            'TracerName': self.nifti_json_data.get('Radiopharmaceutical'),  # need to grab part of this string
-            'TracerRadionuclide': self.nifti_json_data.get('RadionuclideTotalDose', default=0) / 10 ** 6,
-            'InjectedRadioactivityUnits': 'MBq',
-            'InjectedMass': self.metadata_dataframe.iloc[35, 10] * self.metadata_dataframe.iloc[38, 6],
-            # nmol/kg * weight
-            'InjectedMassUnits': 'nmol',
-            'MolarActivity': self.metadata_dataframe.iloc[0, 35] * 0.000037,  # uCi to GBq
-            'MolarActivityUnits': 'GBq/nmol',
-            'SpecificRadioactivity': 'n/a',
-            'SpecificRadioactivityUnits': 'n/a',
-            'ModeOfAdministration': 'bolus',
-            'TimeZero': '10:15:14',
-            'ScanStart': 61,
-            'InjectionStart': 0,
-            'FrameTimesStart':
-                [int(entry) for entry in ([0] +
-                                          list(cumsum(self.nifti_json_data['FrameDuration']))[
-                                          0:len(self.nifti_json_data['FrameDuration']) - 1])],
-            'FrameDuration': self.nifti_json_data['FrameDuration'],
-            'AcquisitionMode': 'list mode',
-            'ImageDecayCorrected': True,
-            'ImageDecayCorrectionTime': -61,
-            'ReconMethodName': self.dicom_header_data.ReconstructionMethod,
-            'ReconMethodParameterLabels': ['iterations', 'subsets', 'lower energy threshold', 'upper energy threshold'],
-            'ReconMethodParameterUnits': ['none', 'none', 'keV', 'keV'],
-            'ReconMethodParameterValues': [
-                3,
-                21,
-                float(min(re.findall('\d+\.\d+', str(self.dicom_header_data.EnergyWindowRangeSequence).lower()))),
-                float(max(re.findall('\d+\.\d+', str(self.dicom_header_data.EnergyWindowRangeSequence).lower()))),
-            ],
-            'ReconFilterType': self.dicom_header_data.ConvolutionKernel,
-            'ReconFilterSize': 0,
-            'AttenuationCorrection': self.dicom_header_data.AttenuationCorrectionMethod,
-            'DecayCorrectionFactor': self.nifti_json_data['DecayFactor']
-
-        }
-
-        future_blood_json = {
-
-        }
-
-        future_blood_tsv = {
-            'time': self.metadata_dataframe.iloc[2:7, 6] * 60,  # convert minutes to seconds,
-            'PlasmaRadioactivity': self.metadata_dataframe.iloc[2:7, 7] / 60,
-            'WholeBloodRadioactivity': self.metadata_dataframe.iloc[2:7, 9] / 60,
-            'MetaboliteParentFraction': self.metadata_dataframe.iloc[2:7, 8] / 60
-        }
+    def run_native(self):
+        """
+        Converts the image folder with native_convert instead of dcm2niix. The series are taken from the
+        dicom index built by scan_headers, and the sidecar of the series the dicom header came from is kept
+        in memory so it doesn't have to be found and read back from the destination. Cached conversions are
+        reused the same way as with run_dcm2niix.
+        :return:
+        """
+        if self.dicom_index is None:
+            self.extract_dicom_header()
+
+        fingerprint = None
+        if self.conversion_cache:
+            flags = ['--native'] + compression_flags([], self.compression == 'gzip')
+            fingerprint = self.conversion_cache.fingerprint(self.image_folder, flags)
+            restored = self.conversion_cache.restore(fingerprint, self.destination_path)
+            if restored:
+                print(f"Reusing cached conversion of {self.image_folder}")
+                self.nifti_outputs = restored
+                if self.compression == 'background':
+                    self.compress_outputs()
+                return
+
+        converted = convert_index(self.dicom_index, self.destination_path, compression=self.compression,
+                                  gzip_threads=self.gzip_threads)
+        if not converted:
+            raise Exception(f"No dicoms found in {self.image_folder}")
+        self.nifti_outputs = [path for result in converted.values()
+                              for path in (result['nifti_path'], result['sidecar_path'])]
+        if fingerprint:
+            self.conversion_cache.store(fingerprint, self.nifti_outputs)
+
+        series_uid = str(self.dicom_header_data.get('SeriesInstanceUID', '')) if self.dicom_header_data is not None \
+            else None
+        result = converted.get(series_uid, next(iter(converted.values())))
+        self.nifti_path = result['nifti_path']
+        self.nifti_json_data = result['sidecar']
+        if self.compression == 'background':
+            self.compress_outputs()
+
+    def compress_outputs(self):
+        """
+        Gzips the .nii files among the dcm2niix outputs. With 'gzip' compression they're compressed here on
+        gzip_threads threads, with 'background' they're handed to the compressor (or, without one, listed in
+        uncompressed_outputs for whoever is running the conversion to compress) so this session can move on.
+        :return:
+        """
+        niftis = [path for path in self.nifti_outputs if path.lower().endswith('.nii')]
+        if self.compression == 'background':
+            self.uncompressed_outputs = niftis
+            if self.compressor and niftis:
+                self.compressor.submit(niftis)
+            return
+        compressed = {path: compress_file(path, threads=self.gzip_threads) for path in niftis}
+        self.nifti_outputs = [compressed.get(path, path) for path in self.nifti_outputs]
 
-        participants_tsv = {
-            'sub_id': [self.subject_id],
-            'weight': [self.dicom_header_data.PatientWeight],
-            'sex': [self.dicom_header_data.PatientSex]
-        }
+    def bespoke(self):
+        """
+        Builds the PET sidecar, blood json and tsv, and participants entries for this session by applying
+        the metadata mapping (see metadata_mapping.py and mappings/nimh_pet.json) to the dicom header,
+        dcm2niix sidecar and metadata spreadsheet.
+        :return: dictionary of the output structures
+        """
+        plan = load_mapping(self.mapping)
+        mapped = plan.apply(dicom=self.dicom_header_data, nifti_json=self.nifti_json_data,
+                            spreadsheet=self.metadata_dataframe,
+                            session={'subject_id': self.subject_id, 'session_id': self.session_id})
 
         return {
-            'future_json': future_json,
-            'future_blood_json': future_blood_json,
-            'future_blood_tsv': future_blood_tsv,
-            'participants_info': participants_tsv
+            'future_json': mapped['pet_json'],
+            'future_blood_json': mapped['blood_json'],
+            'future_blood_tsv': mapped['blood_tsv'],
+            'participants_info': mapped['participants']
         }
 
     def write_out_jsons(self, manual_path=None):
@@ -249,19 +420,19 @@ class Convert:
         manual_path: a folder path specified at function cal by user, defaults none
         :return:
         """
+        with self.instrumentation.stage('write_out_jsons'):
+            if manual_path is None:
+                # dry
+                identity_string = os.path.join(self.destination_path, self.subject_string + self.session_string)
+            else:
+                identity_string = os.path.join(manual_path, self.subject_string + self.session_string)
 
-        if manual_path is None:
-            # dry
-            identity_string = os.path.join(self.destination_path, self.subject_string + self.session_string)
-        else:
-            identity_string = os.path.join(manual_path, self.subject_string + self.session_string)
-
-        with open(identity_string + '_pet.json', 'w') as outfile:
-            json.dump(self.future_json, outfile, indent=4)
+            with open(identity_string + '_pet.json', 'w') as outfile:
+                json.dump(self.future_json, outfile, indent=4)
 
-        # write out better json
-        with open(identity_string + '_recording-manual-blood.json', 'w') as outfile:
-            json.dump(self.future_blood_json, outfile, indent=4)
+            # write out better json
+            with open(identity_string + '_recording-manual-blood.json', 'w') as outfile:
+                json.dump(self.future_blood_json, outfile, indent=4)
 
     def write_out_blood_tsv(self, manual_path=None):
         """
@@ -269,19 +440,19 @@ class Convert:
         manual_path:  a folder path specified at function call by user, defaults none
         :return:
         """
-        if manual_path is None:
-            # dry
-            identity_string = os.path.join(self.destination_path, self.subject_string + self.session_string)
-        else:
-            identity_string = os.path.join(manual_path, self.subject_string + self.session_string)
+        with self.instrumentation.stage('write_out_blood_tsv'):
+            if manual_path is None:
+                # dry
+                identity_string = os.path.join(self.destination_path, self.subject_string + self.session_string)
+            else:
+                identity_string = os.path.join(manual_path, self.subject_string + self.session_string)
 
-        # make a pandas dataframe from blood data
-        blood_data_df = pandas.DataFrame.from_dict(self.future_blood_tsv)
-        blood_data_df.to_csv(identity_string + '_recording-manual_blood.tsv', sep='\t', index=False)
+            # make a pandas dataframe from blood data
+            blood_data_df = pandas.DataFrame.from_dict(self.future_blood_tsv)
+            blood_data_df.to_csv(identity_string + '_recording-manual_blood.tsv', sep='\t', index=False)
 
-        # make a small dataframe for the participants
-        participants_df = pandas.DataFrame.from_dict(self.participant_info)
-        participants_df.to_csv('participants.tsv', sep='\t', index=False)
+            # add this subject to the dataset's participants.tsv
+            self.participants.add(self.participant_info)
 
 
 # get around dark mode issues on OSX
@@ -340,26 +511,78 @@ def cli():
     parser.add_argument('-s', '--session_id', type=str, gooey_options=item_default,
                         help="User supplied session id. If left blank defaults to " +
                              "None/null and omits addition to output")
+    parser.add_argument('-c', '--cache-dir', type=str, gooey_options=item_default, widget="DirChooser",
+                        help="Reuse dcm2niix outputs stored in this folder when the same dicoms have already " +
+                             "been converted, new conversions are added to it.", required=False)
+    parser.add_argument('-t', '--trace', type=str, gooey_options=item_default, widget="FileSaver",
+                        help="Time each conversion stage and write a json trace of the time, cpu, io, and memory " +
+                             "used by each stage to this path.", required=False)
+    parser.add_argument('-M', '--metadata-cache-dir', type=str, gooey_options=item_default, widget="DirChooser",
+                        help="Keep parsed metadata workbooks in this folder so a workbook shared by many " +
+                             "sessions is only parsed once.", required=False)
+    parser.add_argument('--mapping', type=str, gooey_options=item_default, widget="FileChooser",
+                        help="Json (or yaml) spec describing how the BIDS metadata is built from the dicom header, " +
+                             "dcm2niix sidecar and metadata spreadsheet, defaults to mappings/nimh_pet.json.",
+                        required=False)
+    parser.add_argument('-r', '--dataset-root', type=str, gooey_options=item_default, widget="DirChooser",
+                        help="Root of the BIDS dataset, the subject is added to the participants.tsv there. " +
+                             "Defaults to the destination path.", required=False)
+    parser.add_argument('--timeout', type=float, gooey_options=item_default,
+                        help="Give up on dcm2niix if it runs for longer than this many seconds.", required=False)
+    parser.add_argument('-l', '--log', type=str, gooey_options=item_default, widget="FileSaver",
+                        help="Write dcm2niix's output to this file.", required=False)
+    parser.add_argument('-z', '--compression', type=str, default='gzip', choices=compression_modes,
+                        gooey_options=item_default,
+                        help="gzip the niftis (on every cpu, with pigz if it's installed), leave them uncompressed, " +
+                             "or gzip them in the background while the metadata is written.")
+    parser.add_argument('--gzip-threads', type=int, gooey_options=item_default,
+                        help="Number of threads to gzip with, defaults to the number of cpus.", required=False)
+    parser.add_argument('-e', '--engine', type=str, default='dcm2niix', choices=engines, gooey_options=item_default,
+                        help="Convert with the dcm2niix executable, or natively in this process with pydicom and " +
+                             "nibabel (no dcm2niix needed).")
+    parser.add_argument('--verify-cache', action='store_true', gooey_options=item_default,
+                        help="Check the checksums of cached conversions before reusing them, not just their sizes " +
+                             "and modification times.")
 
     args = parser.parse_args()
 
     if not isdir(args.folder):
         raise FileNotFoundError(f"{args.folder} is not a valid path")
 
+    instrumentation = Instrumentation(name=args.folder, trace_path=args.trace) if args.trace else None
+    compressor = BackgroundCompressor(args.gzip_threads) if args.compression == 'background' else None
     converter = Convert(
         image_folder=args.folder,
         metadata_path=args.metadata_path,
         destination_path=args.destination_path,
         subject_id=args.subject_id,
-        session_id=args.session_id)
+        session_id=args.session_id,
+        conversion_cache=ConversionCache(args.cache_dir, verify=args.verify_cache) if args.cache_dir else None,
+        instrumentation=instrumentation,
+        dcm2niix_timeout=args.timeout,
+        dcm2niix_log=args.log,
+        metadata_cache=MetadataCache(args.metadata_cache_dir) if args.metadata_cache_dir else None,
+        mapping=args.mapping,
+        participants=ParticipantsTable(args.dataset_root) if args.dataset_root else None,
+        compression=args.compression,
+        gzip_threads=args.gzip_threads,
+        compressor=compressor,
+        engine=args.engine)
 
     # convert it all!
-    converter.run_dcm2niix()
     if args.metadata_path:
-        converter.bespoke()
         converter.write_out_jsons()
         converter.write_out_blood_tsv()
 
+    if compressor:
+        errors = compressor.close()
+        if errors:
+            raise Exception("\n".join(errors))
+
+    if args.trace:
+        instrumentation.write_trace()
+        instrumentation.print_summary()
+
 
 if __name__ == "__main__":
     cli()
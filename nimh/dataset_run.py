@@ -0,0 +1,517 @@
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import isdir, isfile
+
+from batch_convert import flush_participants, print_result, read_manifest, run_job
+from convert import engines
+from instrumentation import Instrumentation
+from lazy_imports import Gooey, GooeyParser
+from metadata_mapping import load_mapping
+from parallel_gzip import BackgroundCompressor, compression_modes
+from scheduler import MemoryScheduler
+
+# determine whether to run as gui or not
+if len(sys.argv) >= 2:
+    if '--ignore-gooey' not in sys.argv:
+        sys.argv.append('--ignore-gooey')
+
+manifest_filename = 'manifest.json'
+checkpoint_folder = 'checkpoints'
+
+# files that are never dicoms: dcm2niix outputs, spreadsheets, notes, and our own indexes
+skipped_extensions = ('.nii', '.nii.gz', '.json', '.bval', '.bvec', '.tsv', '.csv', '.xls', '.xlsx', '.txt',
+                      '.log', '.v', '.tmp')
+
+# number of files looked at in a folder before deciding it holds no dicoms
+dicom_probe_limit = 20
+
+
+def is_dicom(path):
+    """
+    :return: True if the file has the DICM marker after the 128 byte preamble or a dicom extension
+    """
+    if path.lower().endswith(('.dcm', '.ima')):
+        return True
+    try:
+        with open(path, 'rb') as infile:
+            infile.seek(128)
+            return infile.read(4) == b'DICM'
+    except OSError:
+        return False
+
+
+def is_ecat(path):
+    """
+    :return: True if the file starts with an ECAT 7 magic number
+    """
+    try:
+        with open(path, 'rb') as infile:
+            return infile.read(6) == b'MATRIX'
+    except OSError:
+        return False
+
+
+def job_id(relative_path):
+    """
+    :return: a short id for a job that's the same on every node as long as the input tree is the same
+    """
+    return hashlib.sha1(relative_path.replace(os.sep, '/').encode()).hexdigest()[:16]
+
+
+def make_job(kind, input_path, input_root, output_root=None, metadata_path=None):
+    """
+    Describes a single session, the same dictionary batch_convert.run_job takes plus kind and job_id.
+    For ecat sessions folder is the path to the ecat file.
+    """
+    relative_path = os.path.relpath(input_path, input_root)
+    relative_folder = relative_path if kind == 'dicom' else os.path.dirname(relative_path)
+    destination_path = os.path.normpath(os.path.join(output_root, relative_folder)) if output_root else None
+    return {
+        'job_id': job_id(relative_path),
+        'kind': kind,
+        'folder': input_path,
+        'subject_id': None,
+        'session_id': None,
+        'metadata_path': metadata_path,
+        'destination_path': destination_path,
+    }
+
+
+def find_sessions(input_root, output_root=None, metadata_path=None):
+    """
+    Walks an input tree and returns a job for every folder holding dicoms and every ecat file, in an order that
+    only depends on the tree's contents
+    :param input_root: folder to search
+    :param output_root: mirror the input tree under this folder for the outputs, defaults to converting in place
+    :param metadata_path: metadata spreadsheet used for every dicom session, optional
+    :return: list of job dictionaries sorted by path
+    """
+    jobs = []
+    output_root = os.path.abspath(output_root) if output_root else None
+    for root, dirs, files in os.walk(input_root):
+        dirs.sort()
+        # don't descend into the outputs if they're kept inside of the input tree
+        dirs[:] = [d for d in dirs if not d.startswith('.') and
+                   (output_root is None or os.path.abspath(os.path.join(root, d)) != output_root)]
+        probed = 0
+        holds_dicoms = False
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            if f.startswith('.'):
+                continue
+            if f.lower().endswith('.v'):
+                if is_ecat(path):
+                    jobs.append(make_job('ecat', path, input_root, output_root))
+                continue
+            if holds_dicoms or probed >= dicom_probe_limit or f.lower().endswith(skipped_extensions):
+                continue
+            probed += 1
+            holds_dicoms = is_dicom(path)
+        if holds_dicoms:
+            jobs.append(make_job('dicom', root, input_root, output_root, metadata_path))
+    return sorted(jobs, key=lambda job: job['folder'])
+
+
+def load_manifest(run_dir, input_path=None, output_root=None, metadata_path=None, rebuild=False, dataset_root=None):
+    """
+    Loads the run's job manifest, building it the first time. Every shard of a run reads the same manifest
+    so the jobs (and which shard they belong to) don't change if the input tree changes part way through.
+    The output and dataset roots are kept in the manifest too, so later runs write to the same places without
+    being given them again.
+    :param run_dir: folder holding the manifest and checkpoints for a run
+    :param input_path: input tree to enumerate, or a batch_convert manifest (csv, tsv, excel)
+    :param output_root: see find_sessions
+    :param metadata_path: see find_sessions
+    :param rebuild: enumerate the inputs again even if a manifest has already been written
+    :param dataset_root: root of the BIDS dataset for participants.tsv, defaults to the output root
+    :return: manifest dictionary with the run's jobs under 'jobs' and its 'output_root' and 'dataset_root'
+    """
+    output_root = os.path.abspath(output_root) if output_root else None
+    dataset_root = os.path.abspath(dataset_root) if dataset_root else None
+    manifest_path = os.path.join(run_dir, manifest_filename)
+    if isfile(manifest_path) and not rebuild:
+        with open(manifest_path, 'r') as infile:
+            manifest = json.load(infile)
+        for key, value in (('output_root', output_root), ('dataset_root', dataset_root)):
+            if key not in manifest:
+                # written before the roots were kept in it
+                manifest[key] = value
+            elif value is not None and manifest[key] != value:
+                raise Exception(f"{run_dir} was created with {key} {manifest[key]}, not {value}. Leave it out to " +
+                                f"use the run's, or rebuild the manifest.")
+        if manifest['dataset_root'] is None:
+            manifest['dataset_root'] = manifest['output_root']
+        return manifest
+    if input_path is None:
+        raise Exception(f"No manifest found in {run_dir}, supply the input folder or manifest to create one.")
+
+    if isdir(input_path):
+        jobs = find_sessions(input_path, output_root, metadata_path)
+    elif isfile(input_path):
+        jobs = []
+        for job in read_manifest(input_path):
+            job['kind'] = 'ecat' if job['folder'].lower().endswith('.v') else 'dicom'
+            job['job_id'] = job_id(os.path.abspath(job['folder']))
+            jobs.append(job)
+    else:
+        raise FileNotFoundError(f"{input_path} is not a valid path")
+
+    manifest = {'input': os.path.abspath(input_path), 'created': time.time(), 'output_root': output_root,
+                'dataset_root': dataset_root if dataset_root else output_root, 'jobs': jobs}
+    os.makedirs(run_dir, exist_ok=True)
+    temporary_path = manifest_path + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary_path, 'w') as outfile:
+        json.dump(manifest, outfile, indent=4)
+    os.replace(temporary_path, manifest_path)
+    return manifest
+
+
+def shard_from_environment():
+    """
+    :return: (shard, shards) of a SLURM array job, or (0, 1) outside of one
+    """
+    if 'SLURM_ARRAY_TASK_ID' not in os.environ:
+        return 0, 1
+    task = int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    return task, int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1))
+
+
+def select_shard(jobs, shard, shards):
+    """
+    :return: the jobs belonging to shard (counting from 0) of shards, jobs are dealt out in turn so every shard
+    gets a similar mix of sessions
+    """
+    if not 0 <= shard < shards:
+        raise Exception(f"Shard {shard} is out of range for {shards} shards.")
+    return [job for index, job in enumerate(jobs) if index % shards == shard]
+
+
+class CheckpointJournal:
+    def __init__(self, run_dir, shard=0, shards=1):
+        """
+        Append only record of finished jobs. Each shard appends to its own file so shards never write to the
+        same file, all of the files are read to find out what's already done, so completions survive a
+        change in the number of shards.
+        :param run_dir: folder holding the run's checkpoints
+        :param shard: this shard
+        :param shards: number of shards
+        """
+        self.folder = os.path.join(run_dir, checkpoint_folder)
+        self.path = os.path.join(self.folder, f'shard-{shard:05d}-of-{shards:05d}.jsonl')
+        os.makedirs(self.folder, exist_ok=True)
+
+    def latest(self):
+        """
+        :return: dictionary of job_id -> the last record written for that job
+        """
+        records = []
+        for f in sorted(os.listdir(self.folder)):
+            if not f.endswith('.jsonl'):
+                continue
+            with open(os.path.join(self.folder, f), 'r') as infile:
+                for line in infile:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # a record cut short by a crash
+                        continue
+        latest = {}
+        for record in sorted(records, key=lambda record: record.get('finished', 0)):
+            latest[record['job_id']] = record
+        return latest
+
+    def completed(self):
+        """
+        :return: ids of the jobs that have succeeded
+        """
+        return {job_id for job_id, record in self.latest().items() if record['status'] == 'success'}
+
+    def record(self, result):
+        """
+        Appends a job's result and makes sure it's on disk before returning
+        :param result: job summary
+        :return:
+        """
+        record = {key: result.get(key) for key in ('job_id', 'kind', 'folder', 'status', 'error', 'seconds',
+                                                   'memory_bytes')}
+        record['finished'] = time.time()
+        record['host'] = socket.gethostname()
+        with open(self.path, 'a') as outfile:
+            outfile.write(json.dumps(record, default=str) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+
+def run_ecat_job(job, trace_dir=None, dtype='float64', stream=False, compression='gzip', gzip_threads=None):
+    """
+    Converts a single ecat file, the ecat counterpart of batch_convert.run_job
+    :param job: job dictionary with the ecat file as its folder
+    :param trace_dir: write a json trace of the job's stages into this folder, optional
+    :param dtype: data type of the converted image
+    :param stream: write one frame at a time instead of building the whole image in memory
+    :param compression: gzip, none, or background (the nifti is left for the caller, listed under 'uncompressed')
+    :param gzip_threads: number of threads to gzip with, defaults to the number of cpus
+    :return: a summary dictionary with the job's status, error (if any), and run time in seconds
+    """
+    from ecat_convert import ConvertToNifti
+    summary = dict(job)
+    start = time.time()
+    try:
+        instrumentation = None
+        if trace_dir:
+            trace_name = job['job_id'] + '.json'
+            instrumentation = Instrumentation(name=job['folder'], trace_path=os.path.join(trace_dir, trace_name))
+        converter = ConvertToNifti(job['folder'], destination_path=job['destination_path'], dtype=dtype,
+                                   stream=stream, instrumentation=instrumentation, compression=compression,
+                                   gzip_threads=gzip_threads)
+        if not stream:
+            converter.write_nifti()
+        if compression == 'background':
+            summary['uncompressed'] = [converter.nifti_file]
+        summary['status'] = 'success'
+        summary['error'] = None
+    except Exception as err:
+        summary['status'] = 'failed'
+        summary['error'] = f"{type(err).__name__}: {err}"
+        summary['traceback'] = traceback.format_exc()
+    summary['seconds'] = round(time.time() - start, 3)
+    return summary
+
+
+def run_dataset_job(job, options):
+    """
+    Runs a dicom or ecat job
+    :param job: job dictionary
+    :param options: keyword arguments for batch_convert.run_job and run_ecat_job, each takes the ones it uses
+    :return: job summary
+    """
+    if job.get('kind') == 'ecat':
+        return run_ecat_job(job, trace_dir=options.get('trace_dir'), dtype=options.get('dtype', 'float64'),
+                            stream=options.get('stream', False), compression=options.get('compression', 'gzip'),
+                            gzip_threads=options.get('gzip_threads'))
+    return run_job(job, cache_dir=options.get('cache_dir'), trace_dir=options.get('trace_dir'),
+                   timeout=options.get('timeout'), log_dir=options.get('log_dir'),
+                   metadata_cache_dir=options.get('metadata_cache_dir'), mapping=options.get('mapping'),
+                   dataset_root=options.get('dataset_root'), compression=options.get('compression', 'gzip'),
+                   gzip_threads=options.get('gzip_threads'), engine=options.get('engine', 'dcm2niix'),
+                   verify_cache=options.get('verify_cache', False))
+
+
+def parse_memory_budget(value):
+    """
+    :param value: 'auto' or a number of gigabytes
+    :return: 'auto' or bytes
+    """
+    if value is None or str(value).lower() == 'auto':
+        return value
+    return int(float(value) * 1024 ** 3)
+
+
+def run_pool(todo, workers, options):
+    """
+    Runs every job on a fixed number of worker processes
+    :return: generator of (job, finished future)
+    """
+    with ProcessPoolExecutor(max_workers=workers if workers else os.cpu_count() or 1) as executor:
+        futures = {executor.submit(run_dataset_job, job, options): job for job in todo}
+        for future in as_completed(futures):
+            yield futures[future], future
+
+
+def run_shard(jobs, run_dir, shard=0, shards=1, workers=None, memory_budget=None, **options):
+    """
+    Runs the unfinished jobs of a shard, skipping those that have already succeeded (in this shard or any other)
+    and retrying those that failed. Each result is checkpointed as soon as its job finishes so a crashed or
+    cancelled shard picks up where it left off when it's run again. With background compression a job is only
+    checkpointed once its niftis have been gzipped by this process, while the workers move on to the next jobs.
+    :param jobs: every job in the run (see load_manifest)
+    :param run_dir: folder holding the run's checkpoints
+    :param shard: shard to run, counting from 0
+    :param shards: number of shards the run is split into
+    :param workers: number of worker processes, defaults to the number of cpus. With a memory budget it's the
+    most that are run at once
+    :param memory_budget: None runs workers jobs at a time, otherwise jobs are started as memory allows (see
+    scheduler.MemoryScheduler) within this many bytes, or 'auto' for most of the memory available now
+    :param options: passed on to run_dataset_job
+    :return: list of summaries of the jobs run
+    """
+    journal = CheckpointJournal(run_dir, shard, shards)
+    completed = journal.completed()
+    shard_jobs = select_shard(jobs, shard, shards)
+    todo = [job for job in shard_jobs if job['job_id'] not in completed]
+    print(f"Shard {shard} of {shards}: {len(shard_jobs)} sessions, {len(shard_jobs) - len(todo)} already done, " +
+          f"running {len(todo)}.")
+
+    for folder in (options.get('trace_dir'), options.get('log_dir')):
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    results = []
+    compressor = BackgroundCompressor(options.get('gzip_threads')) if options.get('compression') == 'background' \
+        else None
+    compressing = {}  # compression future -> result of the job waiting on it
+
+    def checkpoint(result):
+        journal.record(result)
+        print_result(result)
+        results.append(result)
+
+    def checkpoint_compressed(wait=False):
+        for future in [future for future in compressing if wait or future.done()]:
+            result = compressing.pop(future)
+            err = future.exception()
+            if err is not None:
+                result.update(status='failed', error=f"Compressing niftis: {type(err).__name__}: {err}")
+            checkpoint(result)
+
+    if todo:
+        scheduler = None
+        if memory_budget is not None:
+            scheduler = MemoryScheduler(None if memory_budget == 'auto' else memory_budget, workers, options=options)
+            print(f"Scheduling jobs within {scheduler.budget / 1024 ** 3:.1f}GB of memory.")
+            finished = scheduler.run(todo, run_dataset_job, options)
+        else:
+            finished = run_pool(todo, workers, options)
+        for job, future in finished:
+            try:
+                result = future.result()
+            except Exception as err:
+                # the worker itself died (e.g. killed by the OS), record it against the job
+                result = dict(job, status='failed', error=f"{type(err).__name__}: {err}", seconds=None)
+            uncompressed = result.pop('uncompressed', None)
+            if compressor is not None and uncompressed:
+                compressing[compressor.submit(uncompressed)] = result
+            else:
+                checkpoint(result)
+            checkpoint_compressed()
+        if scheduler is not None:
+            print(f"Ran at most {scheduler.peak_running} jobs at once, reserving at most " +
+                  f"{scheduler.peak_committed / 1024 ** 3:.1f}GB.")
+        if compressor is not None:
+            compressor.close()
+            checkpoint_compressed(wait=True)
+
+    flush_participants([job for job in shard_jobs if job.get('kind') != 'ecat'], options.get('dataset_root'))
+    return results
+
+
+def run_status(jobs, run_dir):
+    """
+    :return: dictionary of status -> number of jobs, jobs without a checkpoint are pending
+    """
+    latest = CheckpointJournal(run_dir).latest()
+    counts = {'success': 0, 'failed': 0, 'pending': 0}
+    for job in jobs:
+        status = latest[job['job_id']]['status'] if job['job_id'] in latest else 'pending'
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+@Gooey
+def cli():
+    parser = GooeyParser(description="Converts a whole dataset, optionally split into shards for cluster array jobs. " +
+                                     "Finished sessions are checkpointed so a run can be restarted or resubmitted " +
+                                     "and only picks up sessions that haven't succeeded yet.")
+    parser.add_argument('input', type=str, nargs='?', default=None, widget="DirChooser",
+                        help="Folder to search for dicom sessions and ecat files, or a batch_convert manifest. " +
+                             "Only needed the first time, later runs read the manifest from the run folder.")
+    parser.add_argument('--run-dir', type=str, required=True, widget="DirChooser",
+                        help="Folder to keep the job manifest and checkpoints in, shared by every shard.")
+    parser.add_argument('-o', '--output-root', type=str, default=None, widget="DirChooser",
+                        help="Mirror the input tree under this folder for the outputs, defaults to converting " +
+                             "in place. Kept in the run folder's manifest.")
+    parser.add_argument('--shard', type=int, default=None,
+                        help="Shard to run counting from 0, defaults to $SLURM_ARRAY_TASK_ID (minus " +
+                             "$SLURM_ARRAY_TASK_MIN) or 0.")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="Number of shards, defaults to $SLURM_ARRAY_TASK_COUNT or 1.")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Number of sessions to convert at once, defaults to the number of cpus.")
+    parser.add_argument('-m', '--metadata-path', type=str, default=None, widget="FileChooser",
+                        help="Metadata spreadsheet for every dicom session found in the input folder.")
+    parser.add_argument('-r', '--dataset-root', type=str, default=None, widget="DirChooser",
+                        help="Root of the BIDS dataset for participants.tsv, defaults to the output root. Kept in " +
+                             "the run folder's manifest.")
+    parser.add_argument('-c', '--cache-dir', type=str, default=None, widget="DirChooser",
+                        help="Reuse dcm2niix outputs stored in this folder.")
+    parser.add_argument('-M', '--metadata-cache-dir', type=str, default=None, widget="DirChooser",
+                        help="Keep parsed metadata workbooks in this folder.")
+    parser.add_argument('--mapping', type=str, default=None, widget="FileChooser",
+                        help="Metadata mapping spec, defaults to mappings/nimh_pet.json.")
+    parser.add_argument('-t', '--trace-dir', type=str, default=None, widget="DirChooser",
+                        help="Write a json trace of each job's stages into this folder.")
+    parser.add_argument('-l', '--log-dir', type=str, default=None, widget="DirChooser",
+                        help="Write each dicom job's dcm2niix output to a log file in this folder.")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="Fail a dicom job if dcm2niix runs for longer than this many seconds.")
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float32', 'float64'],
+                        help="Data type of converted ecat images.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Convert ecats one frame at a time straight to disk.")
+    parser.add_argument('-z', '--compression', type=str, default='gzip', choices=compression_modes,
+                        help="gzip the niftis as they're converted, leave them uncompressed, or write them " +
+                             "uncompressed and gzip them in this process while the workers convert the next sessions.")
+    parser.add_argument('--gzip-threads', type=int, default=None,
+                        help="Number of threads to gzip each nifti with, defaults to the number of cpus.")
+    parser.add_argument('-e', '--engine', type=str, default='dcm2niix', choices=engines,
+                        help="Convert dicom sessions with the dcm2niix executable, or natively with pydicom and " +
+                             "nibabel.")
+    parser.add_argument('--verify-cache', action='store_true',
+                        help="Check the checksums of cached conversions before reusing them, not just their sizes " +
+                             "and modification times.")
+    parser.add_argument('--memory-budget', type=str, default=None,
+                        help="Start jobs as memory allows instead of --workers at a time: gigabytes the jobs may " +
+                             "use between them, or auto for most of the memory available now. Each job's memory is " +
+                             "estimated from its ecat headers or dicom sizes, the largest are started first, and " +
+                             "the estimates are corrected as jobs finish. --workers is then the most run at once.")
+    parser.add_argument('--rebuild-manifest', action='store_true',
+                        help="Search the input again even if the run folder already has a manifest. Only do this " +
+                             "when no shards are running, it can change which shard a session belongs to.")
+    parser.add_argument('--list', action='store_true', help="Print this shard's sessions and exit.")
+    parser.add_argument('--status', action='store_true', help="Print how many sessions have succeeded, failed " +
+                                                              "or are still pending and exit.")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.run_dir, args.input, args.output_root, args.metadata_path, args.rebuild_manifest,
+                             args.dataset_root)
+    jobs = manifest['jobs']
+    shard, shards = shard_from_environment()
+    shard = args.shard if args.shard is not None else shard
+    shards = args.shards if args.shards is not None else shards
+
+    if args.status:
+        counts = run_status(jobs, args.run_dir)
+        print(", ".join(f"{count} {status}" for status, count in counts.items()) + f" of {len(jobs)} sessions")
+        return
+    if args.list:
+        for job in select_shard(jobs, shard, shards):
+            print(f"{job['job_id']}\t{job['kind']}\t{job['folder']}")
+        return
+
+    if args.mapping:
+        # fail on a broken spec now rather than once per job
+        load_mapping(args.mapping)
+
+    results = run_shard(jobs, args.run_dir, shard, shards, workers=args.workers,
+                        memory_budget=parse_memory_budget(args.memory_budget), cache_dir=args.cache_dir,
+                        trace_dir=args.trace_dir, timeout=args.timeout, log_dir=args.log_dir,
+                        metadata_cache_dir=args.metadata_cache_dir, mapping=args.mapping,
+                        dataset_root=manifest['dataset_root'],
+                        dtype=args.dtype, stream=args.stream, compression=args.compression,
+                        gzip_threads=args.gzip_threads, engine=args.engine, verify_cache=args.verify_cache)
+
+    failed = [result for result in results if result['status'] != 'success']
+    print(f"Converted {len(results) - len(failed)} of {len(results)} sessions in shard {shard}, {len(failed)} failed.")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import os
+import re
+import signal
+import sys
+import time
+
+# flags Convert runs dcm2niix with: overwrite existing files, gzip the niftis
+default_flags = ['-w', '1', '-z', 'y']
+
+# extensions dcm2niix gives the files it writes beside the nifti
+sidecar_extensions = ('.json', '.bval', '.bvec')
+
+# number of output lines kept in memory per job for error messages, everything goes to the log file
+tail_length = 50
+
+# seconds an output's modification time may be before dcm2niix started and still count as written by it, some
+# file systems (FAT, network shares) only keep timestamps to the second or two
+mtime_tolerance = 2.0
+
+
+def compression_flags(flags, gzip):
+    """
+    :param flags: dcm2niix flags
+    :param gzip: True to have dcm2niix gzip its niftis (using pigz when it's installed), False for plain .nii
+    :return: a copy of flags with the -z option set accordingly
+    """
+    flags = list(flags)
+    value = 'y' if gzip else 'n'
+    if '-z' in flags and flags.index('-z') + 1 < len(flags):
+        flags[flags.index('-z') + 1] = value
+    else:
+        flags += ['-z', value]
+    return flags
+
+
+convert_pattern = re.compile(r'^Convert\s+\d+\s+DICOM\s+as\s+(.+?)\s+\(\d+(x\d+)*\)\s*$')
+skip_pattern = re.compile(r'Skipping existing file named?\s+(.+?)\s*$')
+
+
+def nifti_extension(flags):
+    """
+    :param flags: dcm2niix flags
+    :return: the extension dcm2niix gives the niftis it writes with those flags
+    """
+    flags = list(flags)
+    gzip = flags[flags.index('-z') + 1] if '-z' in flags and flags.index('-z') + 1 < len(flags) else 'n'
+    return '.nii' if gzip.lower() in ('n', '3') else '.nii.gz'
+
+
+class Dcm2niixOutputParser:
+    def __init__(self, flags=None):
+        """
+        Collects the files written and skipped, warnings, and errors from dcm2niix's output one line
+        at a time so the output never needs to be held in memory.
+        :param flags: the flags dcm2niix is run with, defaults to default_flags
+        """
+        self.image_extension = nifti_extension(default_flags if flags is None else flags)
+        self.started = time.time()
+        self.stems = []  # output paths without extensions, see written_files
+        self.skipped = []
+        self.warnings = []
+        self.errors = []
+        self.tail = collections.deque(maxlen=tail_length)
+
+    def feed(self, line):
+        line = line.rstrip('\r\n')
+        self.tail.append(line)
+
+        converted = convert_pattern.match(line)
+        if converted:
+            # dcm2niix reports the output path without an extension, and before it has finished writing the
+            # files, so they're only looked for once it has exited
+            self.stems.append(converted.group(1))
+            return
+
+        skipped = skip_pattern.search(line)
+        if skipped:
+            self.skipped.append(skipped.group(1))
+        elif line.lower().startswith('warning'):
+            self.warnings.append(line)
+        elif line.lower().startswith('error'):
+            self.errors.append(line)
+
+    def written_files(self):
+        """
+        Looks for the files dcm2niix wrote for every output it reported, call once it has exited. Only the
+        nifti extension the flags give and files modified since the parser was created (just before dcm2niix
+        was started) count, so a .nii or .nii.gz left over from an earlier run isn't taken for a new output.
+        :return: list of paths
+        """
+        written = []
+        for stem in self.stems:
+            for extension in (self.image_extension,) + sidecar_extensions:
+                try:
+                    modified = os.stat(stem + extension).st_mtime
+                except OSError:
+                    continue
+                if modified >= self.started - mtime_tolerance:
+                    written.append(stem + extension)
+        return written
+
+
+async def _pump(stream, parser, log_file, prefix):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        text = line.decode('utf-8', 'replace')
+        parser.feed(text)
+        if log_file:
+            log_file.write(prefix + text)
+            log_file.flush()
+
+
+async def run_dcm2niix_async(image_folder, destination_path, flags=None, timeout=None, log_path=None,
+                             semaphore=None, executable='dcm2niix'):
+    """
+    Runs dcm2niix on a folder without going through the shell. stdout and stderr are streamed line by
+    line into a log file (if given) and parsed as they arrive.
+    :param image_folder: folder of dicoms to convert
+    :param destination_path: folder for dcm2niix to write to
+    :param flags: dcm2niix flags (excluding -o and the input folder), defaults to default_flags
+    :param timeout: seconds to wait before killing dcm2niix, None waits forever
+    :param log_path: write dcm2niix's output to this file, optional
+    :param semaphore: asyncio.Semaphore limiting how many dcm2niix processes run at once, optional
+    :param executable: dcm2niix executable
+    :return: result dictionary, see make_result
+    """
+    flags = list(default_flags if flags is None else flags)
+    parser = Dcm2niixOutputParser(flags)
+    async with semaphore if semaphore else contextlib.AsyncExitStack():
+        start = time.time()
+        timed_out = False
+        with open(log_path, 'w') if log_path else contextlib.nullcontext() as log_file:
+            process = await asyncio.create_subprocess_exec(
+                executable, *flags, '-o', destination_path, image_folder,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                # its own process group so pigz (or anything else dcm2niix starts) is killed along with it
+                start_new_session=os.name == 'posix')
+            try:
+                await asyncio.wait_for(asyncio.gather(
+                    _pump(process.stdout, parser, log_file, ''),
+                    _pump(process.stderr, parser, log_file, 'stderr: '),
+                    process.wait()), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                kill(process)
+                await process.wait()
+                parser.errors.append(f"Error: dcm2niix timed out after {timeout} seconds")
+        return make_result(image_folder, destination_path, process.returncode, timed_out, time.time() - start,
+                           parser, log_path)
+
+
+def kill(process):
+    """
+    Kills a dcm2niix process started by run_dcm2niix_async and any children it has started
+    """
+    try:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+def make_result(image_folder, destination_path, returncode, timed_out, seconds, parser, log_path):
+    """
+    :return: dictionary describing a dcm2niix run, 'succeeded' is True when dcm2niix exited cleanly or
+    every output already existed and was skipped
+    """
+    succeeded = not timed_out and (returncode == 0 or (bool(parser.skipped) and not parser.errors))
+    return {
+        'image_folder': image_folder,
+        'destination_path': destination_path,
+        'returncode': returncode,
+        'succeeded': succeeded,
+        'timed_out': timed_out,
+        'seconds': round(seconds, 3),
+        'written': parser.written_files(),
+        'skipped': parser.skipped,
+        'warnings': parser.warnings,
+        'errors': parser.errors,
+        'tail': list(parser.tail),
+        'log_path': log_path,
+    }
+
+
+async def run_dcm2niix_jobs_async(jobs, max_concurrent=None, timeout=None, log_dir=None, flags=None,
+                                  executable='dcm2niix'):
+    """
+    Runs many dcm2niix conversions with at most max_concurrent running at once
+    :param jobs: list of (image_folder, destination_path) pairs
+    :param max_concurrent: limit on concurrent dcm2niix processes, defaults to the number of cpus
+    :param timeout: per job timeout in seconds
+    :param log_dir: write one log file per job into this folder, optional
+    :param flags: dcm2niix flags, defaults to default_flags
+    :param executable: dcm2niix executable
+    :return: list of results in the same order as jobs
+    """
+    semaphore = asyncio.Semaphore(max_concurrent or os.cpu_count() or 1)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    async def run(index, image_folder, destination_path):
+        log_path = os.path.join(log_dir, f'{index:05d}_{os.path.basename(os.path.normpath(image_folder))}.log') \
+            if log_dir else None
+        try:
+            return await run_dcm2niix_async(image_folder, destination_path, flags=flags, timeout=timeout,
+                                            log_path=log_path, semaphore=semaphore, executable=executable)
+        except OSError as err:
+            # e.g. dcm2niix isn't installed or the log folder isn't writable
+            parser = Dcm2niixOutputParser()
+            parser.errors.append(f"Error: {err}")
+            return make_result(image_folder, destination_path, None, False, 0, parser, log_path)
+
+    return await asyncio.gather(*[run(index, image_folder, destination_path)
+                                  for index, (image_folder, destination_path) in enumerate(jobs)])
+
+
+def run_dcm2niix(image_folder, destination_path, flags=None, timeout=None, log_path=None, executable='dcm2niix'):
+    """
+    Blocking wrapper around run_dcm2niix_async for a single conversion
+    """
+    return asyncio.run(run_dcm2niix_async(image_folder, destination_path, flags=flags, timeout=timeout,
+                                          log_path=log_path, executable=executable))
+
+
+def run_dcm2niix_jobs(jobs, max_concurrent=None, timeout=None, log_dir=None, flags=None, executable='dcm2niix'):
+    """
+    Blocking wrapper around run_dcm2niix_jobs_async
+    """
+    return asyncio.run(run_dcm2niix_jobs_async(jobs, max_concurrent=max_concurrent, timeout=timeout,
+                                               log_dir=log_dir, flags=flags, executable=executable))
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Runs dcm2niix over many dicom folders at once.")
+    parser.add_argument('folders', nargs='+', help="Folders of dicoms to convert.")
+    parser.add_argument('-o', '--destination-path', type=str, default=None,
+                        help="Folder to write every conversion to, defaults to each dicom folder.")
+    parser.add_argument('-j', '--max-concurrent', type=int, default=None,
+                        help="Number of dcm2niix processes to run at once, defaults to the number of cpus.")
+    parser.add_argument('--timeout', type=float, default=None, help="Kill any dcm2niix run taking longer than this.")
+    parser.add_argument('-l', '--log-dir', type=str, default=None, help="Write a log per conversion to this folder.")
+    args = parser.parse_args()
+
+    jobs = [(folder, args.destination_path if args.destination_path else folder) for folder in args.folders]
+    results = run_dcm2niix_jobs(jobs, max_concurrent=args.max_concurrent, timeout=args.timeout, log_dir=args.log_dir)
+    for result in results:
+        status = 'success' if result['succeeded'] else ('timed out' if result['timed_out'] else 'failed')
+        print(f"[{status}] {result['image_folder']}: {len(result['written'])} written, " +
+              f"{len(result['skipped'])} skipped, {len(result['warnings'])} warnings, {result['seconds']}s")
+        for error in result['errors']:
+            print(f"    {error}")
+
+    if not all(result['succeeded'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
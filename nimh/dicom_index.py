@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+
+from lazy_imports import lazy_import
+
+pydicom = lazy_import('pydicom')
+
+# name of the index file written into each scanned folder
+index_filename = '.dicom_series_index.json'
+
+# bump this when the layout of the index file changes so stale indexes get rebuilt
+index_version = 1
+
+# the only header entries the converters make use of, everything else (including pixel data) is skipped
+header_tags = [
+    'PatientName',
+    'PatientID',
+    'PatientWeight',
+    'PatientSex',
+    'ReconstructionMethod',
+    'EnergyWindowRangeSequence',
+    'ConvolutionKernel',
+    'AttenuationCorrectionMethod',
+    'StudyInstanceUID',
+    'SeriesInstanceUID',
+    'SeriesNumber',
+    'SeriesDescription',
+]
+
+
+class DicomSeriesIndex:
+    def __init__(self, folder, index_path=None, tags=None):
+        """
+        Keeps an on disk index of the dicom series contained in a folder. Only the tags in header_tags
+        are read from each file and reading stops before the pixel data. Each file is keyed by its path,
+        modification time, and size so repeat scans only read files that are new or have changed.
+        :param folder: folder containing dicom files, scanned recursively
+        :param index_path: where to keep the index, defaults to index_filename inside of folder
+        :param tags: additional header tags to collect on top of header_tags
+        """
+        self.folder = folder
+        self.index_path = index_path if index_path else os.path.join(folder, index_filename)
+        self.tags = header_tags + [tag for tag in (tags or []) if tag not in header_tags]
+        self.files = {}  # relative path -> {'mtime', 'size', 'series_uid'}
+        self.series = {}  # series uid -> {'header', 'files'}
+
+        self.load()
+
+    def load(self):
+        """
+        Reads a previously written index from disk, an index written with a different version or
+        tag list is discarded.
+        :return:
+        """
+        if not os.path.isfile(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, 'r') as infile:
+                index = json.load(infile)
+        except (OSError, ValueError):
+            print(f"Unable to read dicom index at {self.index_path}, rebuilding it.")
+            return
+
+        if index.get('version') != index_version or index.get('tags') != self.tags:
+            return
+
+        self.files = index.get('files', {})
+        self.series = index.get('series', {})
+
+    def save(self):
+        """
+        Writes the index to disk, failing to write (e.g. on a read only share) is not an error,
+        the index is simply rebuilt next time.
+        :return:
+        """
+        index = {'version': index_version, 'tags': self.tags, 'files': self.files, 'series': self.series}
+        temporary_path = self.index_path + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary_path, 'w') as outfile:
+                json.dump(index, outfile)
+            os.replace(temporary_path, self.index_path)
+        except OSError as err:
+            print(f"Unable to write dicom index to {self.index_path}: {err}")
+
+    def read_header(self, path):
+        """
+        Reads only the tags in self.tags from a dicom file.
+        :param path: path to the file
+        :return: a pydicom dataset, or None if the file isn't a dicom
+        """
+        try:
+            return pydicom.dcmread(path, stop_before_pixels=True, specific_tags=self.tags)
+        except (pydicom.errors.InvalidDicomError, EOFError, OSError):
+            return None
+
+    def update(self):
+        """
+        Walks self.folder and reads the header of any file that isn't in the index or has changed
+        since it was indexed. Files that have disappeared are dropped from the index. The index is
+        written back to disk if anything changed.
+        :return: self.series
+        """
+        seen = {}
+        changed = False
+        for root, dirs, files in os.walk(self.folder):
+            dirs.sort()
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                if os.path.abspath(path) == os.path.abspath(self.index_path) or f.startswith(index_filename):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                relative_path = os.path.relpath(path, self.folder)
+                entry = self.files.get(relative_path)
+                if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                    seen[relative_path] = entry
+                    continue
+
+                changed = True
+                header = self.read_header(path)
+                series_uid = None
+                if header is not None:
+                    series_uid = str(header.get('SeriesInstanceUID', ''))
+                    if series_uid not in self.series:
+                        self.series[series_uid] = {'header': header.to_json_dict(), 'files': []}
+                seen[relative_path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'series_uid': series_uid}
+
+        if changed or seen.keys() != self.files.keys():
+            self.files = seen
+            self.rebuild_series()
+            self.save()
+
+        return self.series
+
+    def rebuild_series(self):
+        """
+        Regenerates the per series file lists from self.files, dropping any series that no longer
+        has files.
+        :return:
+        """
+        for series in self.series.values():
+            series['files'] = []
+        for relative_path, entry in self.files.items():
+            if entry['series_uid'] is not None and entry['series_uid'] in self.series:
+                self.series[entry['series_uid']]['files'].append(relative_path)
+        self.series = {uid: series for uid, series in self.series.items() if series['files']}
+
+    def series_uids(self):
+        """
+        :return: series uids in the index ordered by series number then uid
+        """
+        def series_number(uid):
+            number = self.series[uid]['header'].get('00200011', {}).get('Value', [0])[0]
+            try:
+                return int(number), uid
+            except (TypeError, ValueError):
+                return 0, uid
+
+        return sorted(self.series, key=series_number)
+
+    def get_header(self, series_uid=None):
+        """
+        Returns the indexed header of a series without touching the dicom files.
+        :param series_uid: series to return, defaults to the first series in the folder
+        :return: a pydicom dataset, or None if the folder contains no dicoms
+        """
+        if not self.series:
+            return None
+        if series_uid is None:
+            series_uid = self.series_uids()[0]
+        return pydicom.Dataset.from_json(self.series[series_uid]['header'])
+
+    def get_files(self, series_uid):
+        """
+        :param series_uid: series to list
+        :return: absolute paths to the files in a series
+        """
+        return [os.path.join(self.folder, f) for f in self.series[series_uid]['files']]
@@ -1,9 +1,17 @@
-import nibabel
+import csv
+import json
 import sys
 import os
-from os.path import isfile
-import numpy
-from gooey import Gooey, GooeyParser
+from concurrent.futures import ProcessPoolExecutor
+from os.path import isdir, isfile
+
+from instrumentation import Instrumentation
+from lazy_imports import Gooey, GooeyParser, lazy_import
+from parallel_gzip import ParallelGzipWriter, compression_modes
+
+# heavy dependencies are only loaded once they're used
+nibabel = lazy_import('nibabel')
+numpy = lazy_import('numpy')
 
 # use gui if no arguments are supplied to command line w/ call
 if len(sys.argv) >= 2:
@@ -11,35 +19,145 @@ if len(sys.argv) >= 2:
         sys.argv.append('--ignore-gooey')
 
 
+class EcatSubheaders:
+    __slots__ = ('records',)
+
+    def __init__(self, subheaders):
+        """
+        Holds an ecat's subheaders as a single numpy structured array (one record per frame) so that
+        each subheader entry can be pulled out as a whole vector, e.g. subheaders.frame_duration.
+        :param subheaders: nibabel subheader records, or a structured array of them
+        """
+        self.records = numpy.array(subheaders).reshape(-1)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getattr__(self, name):
+        # records and python's own hooks (copy and pickle look up __setstate__ etc. before records is set)
+        # are never subheader entries
+        if name == 'records' or name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self.column(name)
+        except (KeyError, ValueError):
+            raise AttributeError(f"ECAT subheaders have no entry named {name}")
+
+    def __getitem__(self, index):
+        """
+        Returns a single frame's subheader as {name: {'value', 'dtype'}}
+        """
+        record = self.records[index]
+        holder = {}
+        for name, dtype in record.dtype.descr:
+            holder[name] = {
+                'value': ConvertToNifti.transform_from_bytes(record[name].tolist()),
+                'dtype': ConvertToNifti.transform_from_bytes(dtype)}
+        return holder
+
+    @property
+    def names(self):
+        """
+        :return: subheader entry names excluding the fill sections
+        """
+        return [name for name in self.records.dtype.names if 'fill' not in name.lower()]
+
+    def column(self, name):
+        """
+        :param name: subheader entry name
+        :return: the entry for every frame as a native byte order numpy array
+        """
+        values = self.records[name]
+        return values.astype(values.dtype.newbyteorder('='), copy=False)
+
+    def take(self, frame_order):
+        """
+        :param frame_order: indexes of the frames to keep, in the order to keep them
+        :return: a new EcatSubheaders
+        """
+        return EcatSubheaders(self.records[numpy.asarray(frame_order, dtype=int)])
+
+    def to_dicts(self):
+        """
+        :return: list with each frame's subheader as {name: {'value', 'dtype'}}
+        """
+        return [self[index] for index in range(len(self))]
+
+    def to_records(self):
+        """
+        :return: list with each frame's subheader as {name: value}, fill sections are skipped
+        """
+        columns = {name: self.column(name).tolist() for name in self.names}
+        return [{name: ConvertToNifti.transform_from_bytes(columns[name][index]) for name in self.names}
+                for index in range(len(self))]
+
+
 class ConvertToNifti:
-    def __init__(self, ecat_path, destination_path=None):
+    def __init__(self, ecat_path, destination_path=None, dtype='float64', stream=False, convert=True,
+                 instrumentation=None, compression='gzip', gzip_threads=None):
         """
         This class converts an ecat to a more sane file format, aka a nifti. Currently
         relies on Nibabel and only supports ecat versions 7.3.
         :param ecat_path: path to the ecat file
         :param destination_path: destination of nifti and json file, if not supplied will
         send output to ecat_path's parent direction
+        :param dtype: data type of the output image, float32 halves the memory needed to convert
+        :param stream: convert one frame at a time straight into a nifti file at self.nifti_file instead
+        of holding the whole image in memory
+        :param convert: when False only the main header and subheaders are read, the image data is
+        never touched
+        :param instrumentation: Instrumentation to record the time and resources used by each stage
+        :param compression: 'gzip' writes a .nii.gz compressed on gzip_threads threads, 'none' and 'background'
+        write a .nii (with 'background' whoever runs the conversion gzips it afterwards, see dataset_run.py)
+        :param gzip_threads: number of threads to gzip with, defaults to the number of cpus
         """
+        if compression not in compression_modes:
+            raise Exception(f"Unknown compression {compression}, expected one of {list(compression_modes)}")
         self.ecat_path = ecat_path
+        self.compression = compression
+        self.gzip_threads = gzip_threads
+        self.instrumentation = instrumentation if instrumentation else Instrumentation(enabled=False)
+        self.dtype = numpy.dtype(dtype)
         if not destination_path:
             self.destination_path = os.path.dirname(self.ecat_path)
         else:
-            self.nifti_file = destination_path
+            self.destination_path = destination_path
+            if not os.path.isdir(destination_path):
+                print(f"No folder found at destination, creating folder(s) at {destination_path}")
+                os.makedirs(destination_path)
+        self.nifti_file = os.path.join(self.destination_path,
+                                       os.path.splitext(os.path.basename(self.ecat_path))[0] +
+                                       ('.nii.gz' if compression == 'gzip' else '.nii'))
         self.ecat = None
         self.ecat_main_header = {}
-        self.ecat_subheaders = []
+        self.ecat_subheaders = None  # EcatSubheaders
         self.affine = None
+        self.image_data = None  # scaled and reoriented 4d image
+        self.nifti_image = None
+        self.frame_start_times = []
+        self.frame_durations = []
+        self.frame_prompts = []
+        self.frame_randoms = []
 
         # load ecat file
-        self.read_in_ecat()
+        with self.instrumentation.stage('read_in_ecat', ecat_path=self.ecat_path):
+            self.read_in_ecat()
 
         # populate affine, header, subheaders datastructures from ecat
-        self.extract_affine()
-        self.extract_header()
-        self.extract_subheaders()
+        with self.instrumentation.stage('extract_headers'):
+            self.extract_affine()
+            self.extract_header()
+            self.extract_subheaders()
 
         # convert to nifti
-        self.to_nifti()
+        if not convert:
+            pass
+        elif stream:
+            with self.instrumentation.stage('stream_to_nifti', nifti_path=self.nifti_file):
+                self.stream_to_nifti()
+        else:
+            with self.instrumentation.stage('to_nifti'):
+                self.to_nifti()
 
         # will populate this at some point
         self.nifti_json_contents = {}
@@ -80,19 +198,12 @@ class ConvertToNifti:
         return self.ecat_main_header
 
     def extract_subheaders(self):
-        # collect subheaders
-        subheaders = self.ecat.dataobj._subheader.subheaders
-        for subheader in subheaders:
-            holder = {}
-            subheader_data = subheader.tolist()
-            subheader_dtypes = subheader.dtype.descr
-
-            for i in range(len(subheader_data)):
-                holder[subheader_dtypes[i][0]] = {
-                    'value': self.transform_from_bytes(subheader_data[i]),
-                    'dtype': self.transform_from_bytes(subheader_dtypes[i][1])}
-
-            self.ecat_subheaders.append(holder)
+        """
+        Collects the subheaders into an EcatSubheaders
+        :return: self.ecat_subheaders
+        """
+        self.ecat_subheaders = EcatSubheaders(self.ecat.dataobj._subheader.subheaders)
+        return self.ecat_subheaders
 
     @staticmethod
     def transform_from_bytes(bytes_like):
@@ -115,53 +226,243 @@ class ConvertToNifti:
             else:
                 print(f"{entry}: {value}")
 
-    def to_nifti(self):
-        # check if these exist
+    def frame_order(self):
+        """
+        ECAT frames aren't necessarily stored in acquisition order, this collects the matrix list
+        index of each frame in acquisition order.
+        :return: list of matrix list indexes
+        """
+        frame_mapping = nibabel.ecat.get_frame_order(self.ecat.dataobj._subheader._mlist)
+        return [frame_mapping[frame_number][0] for frame_number in sorted(frame_mapping)]
 
+    def frame_scale_factors(self, frame_order):
+        """
+        :param frame_order: matrix list indexes of the frames as returned by self.frame_order
+        :return: array of the factor each frame's raw data is multiplied by
+        """
+        scale_factors = self.ecat_subheaders.scale_factor[frame_order].astype(self.dtype)
+        return scale_factors * self.dtype.type(self.ecat_main_header.get('ecat_calibration_factor', 1))
+
+    def extract_frame_info(self, frame_order):
+        """
+        Collects frame timing (and prompts/randoms) from the subheaders in acquisition order.
+        :param frame_order: matrix list indexes of the frames as returned by self.frame_order
+        :return:
+        """
+        subheaders = self.ecat_subheaders.take(frame_order)
+        self.frame_start_times = (subheaders.frame_start_time * 60).tolist()
+        self.frame_durations = (subheaders.frame_duration * 60).tolist()
+
+        # Not sure what this is for but running with it
+        if self.ecat_main_header['sw_version'] >= 73:
+            for name, attribute in [('prompt_rate', 'frame_prompts'), ('random_rate', 'frame_randoms')]:
+                if name in subheaders.names:
+                    setattr(self, attribute, subheaders.column(name).tolist())
+                else:
+                    setattr(self, attribute, [None] * len(subheaders))
+
+    @staticmethod
+    def reorient(image_data):
+        """
+        Flips x, y, and z of a 3d frame or 4d image, returns a view
+        """
+        return numpy.flip(image_data, axis=(0, 1, 2))
+
+    def to_nifti(self):
+        """
+        Scales and reorients the ecat image data. Unscaled frames are read straight into a single
+        array of self.dtype, then every frame's scale factor is multiplied in at once and the image
+        is flipped along each spatial axis (as a view, no copy is made).
+        :return: self.nifti_image
+        """
         # image shape
         image_shape = self.ecat.shape
 
-        # affine shape
-        affine_shape = self.ecat.affine.shape
-
         # confirm number of frames is equal to fourth dimension value in image shape
         print(f"image shape 4th-d: {image_shape[3]}, num frames: {self.ecat_main_header.get('num_frames')}")
 
-        # collect main image data
-        main_image_data = self.ecat.get_fdata()
-
-        # prepare to flip sub arrays in main_image_data around?
-        flipped_flipped_flipped_array = numpy.empty(image_shape)
-        frame_start_times = []
-        frame_delta_times = []
-        frame_prompts = []
-        frame_randoms = []
-
-        # do this for every frame
-        for frame_number in range(image_shape[3]):
-            subheader = self.ecat_subheaders[frame_number]
-            frame_data = main_image_data[:, :, :, frame_number]
-            flipped_flipped_flipped_array[:, :, :, frame_number] = numpy.flip(numpy.flip(
-                numpy.flip(frame_data * subheader['scale_factor']['value'], 2), 3), 1)
-            frame_start_times.append(subheader['frame_start_time']['value']*60)
-            frame_delta_times.append(subheader['frame_duration']['value']*60)
+        # collect main image data, unscaled, one frame at a time
+        frame_order = self.frame_order()
+        image_reader = self.ecat.dataobj._subheader
+        image_data = numpy.empty(image_shape, dtype=self.dtype)
+        for frame_number, mlist_index in enumerate(frame_order):
+            image_data[:, :, :, frame_number] = image_reader.raw_data_from_fileobj(mlist_index)
 
-        # Not sure what this is for but running with it
-        if self.ecat_main_header['sw_version'] >= 73:
-            frame_prompts.append(subheader.get('prompt_rate', {}).get('value', None))
-            frame_prompts.append(subheader.get('prompt_rate', {}).get('value', None))
+        # scale every frame in one go, the scale factors broadcast along the 4th (frame) dimension
+        image_data *= self.frame_scale_factors(frame_order)
+        self.image_data = self.reorient(image_data)
 
-        # debug
-        print("Debug")
+        self.extract_frame_info(frame_order)
+
+        self.nifti_image = nibabel.Nifti1Image(self.image_data, self.ecat.affine)
+        return self.nifti_image
+
+    def nifti_header(self):
+        """
+        Builds a nifti header for the converted image
+        :return: nibabel.Nifti1Header
+        """
+        header = nibabel.Nifti1Header()
+        header.set_data_shape(self.ecat.shape)
+        header.set_data_dtype(self.dtype)
+        header.set_qform(self.ecat.affine, code='scanner')
+        header.set_sform(self.ecat.affine, code='scanner')
+        header.set_xyzt_units('mm', 'sec')
+        header.set_data_offset(352)
+        return header
+
+    def stream_to_nifti(self, nifti_path=None):
+        """
+        Converts the ecat one frame at a time, frames are read from the memory mapped ecat, scaled,
+        reoriented and written directly into the nifti. Memory use is bounded by the size of a
+        single frame regardless of the number of frames. Nifti stores the 4th dimension last
+        (fortran order) so every frame is one contiguous block of the file; uncompressed output is
+        preallocated and memory mapped, gzipped output is written out frame by frame and compressed on
+        gzip_threads threads.
+        :param nifti_path: path of the nifti to write, defaults to self.nifti_file
+        :return: path to the written nifti
+        """
+        if nifti_path is None:
+            nifti_path = self.nifti_file
+
+        image_shape = self.ecat.shape
+        print(f"image shape 4th-d: {image_shape[3]}, num frames: {self.ecat_main_header.get('num_frames')}")
+
+        frame_order = self.frame_order()
+        scale_factors = self.frame_scale_factors(frame_order)
+        image_reader = self.ecat.dataobj._subheader
+        header = self.nifti_header()
+        data_offset = int(header.get_data_offset())
+
+        def scaled_frames():
+            for frame_number, mlist_index in enumerate(frame_order):
+                frame = image_reader.raw_data_from_fileobj(mlist_index).astype(self.dtype)
+                frame *= scale_factors[frame_number]
+                yield frame_number, self.reorient(frame)
+
+        if nifti_path.endswith('.gz'):
+            # same compression level nibabel uses when saving .nii.gz, level 9 is many times slower
+            with ParallelGzipWriter(nifti_path, compresslevel=1, threads=self.gzip_threads) as outfile:
+                header.write_to(outfile)
+                outfile.write(b'\0' * (data_offset - outfile.tell()))
+                for frame_number, frame in scaled_frames():
+                    outfile.write(frame.tobytes(order='F'))
+        else:
+            with open(nifti_path, 'wb') as outfile:
+                header.write_to(outfile)
+                outfile.write(b'\0' * (data_offset - outfile.tell()))
+                outfile.truncate(data_offset + int(numpy.prod(image_shape)) * self.dtype.itemsize)
+            image_data = numpy.memmap(nifti_path, dtype=self.dtype, mode='r+', offset=data_offset,
+                                      shape=image_shape, order='F')
+            for frame_number, frame in scaled_frames():
+                image_data[:, :, :, frame_number] = frame
+            image_data.flush()
+            del image_data
+
+        self.extract_frame_info(frame_order)
+        return nifti_path
+
+    def write_nifti(self, nifti_path=None):
+        """
+        Writes out the image converted by self.to_nifti, a .nii.gz is compressed on gzip_threads threads
+        :param nifti_path: path of the nifti to write, defaults to self.nifti_file
+        :return: path to the written nifti
+        """
+        if nifti_path is None:
+            nifti_path = self.nifti_file
+        image = nibabel.Nifti1Image(self.image_data, self.ecat.affine, header=self.nifti_header())
+        with self.instrumentation.stage('write_nifti', nifti_path=nifti_path):
+            if nifti_path.endswith('.gz'):
+                # nibabel would gzip on a single thread
+                with ParallelGzipWriter(nifti_path, compresslevel=1, threads=self.gzip_threads) as outfile:
+                    image.to_file_map({'image': nibabel.FileHolder(fileobj=outfile)})
+            else:
+                nibabel.save(image, nifti_path)
+        return nifti_path
+
+
+def find_ecats(folder):
+    """
+    Recursively collects the ecat (.v) files in a folder
+    :param folder: folder to search
+    :return: sorted list of ecat paths
+    """
+    ecat_paths = []
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            if f.lower().endswith('.v'):
+                ecat_paths.append(os.path.join(root, f))
+    return sorted(ecat_paths)
+
+
+def inspect_ecat(ecat_path):
+    """
+    Reads only the main header and the subheader blocks of an ecat, no pixel data is loaded.
+    :param ecat_path: path to the ecat file
+    :return: dictionary with the ecat_path, main header, and a list of subheaders (one per frame)
+    """
+    inspector = ConvertToNifti(ecat_path, convert=False)
+    return {'ecat_path': ecat_path, 'header': inspector.ecat_main_header,
+            'subheaders': inspector.ecat_subheaders.to_records()}
+
+
+def inspect_ecats(ecat_paths, workers=None):
+    """
+    Inspects many ecats in parallel, see inspect_ecat.
+    :param ecat_paths: list of paths to ecat files
+    :param workers: number of processes to use, defaults to the number of cpus
+    :return: list of inspect_ecat results in the same order as ecat_paths
+    """
+    if len(ecat_paths) < 2 or workers == 1:
+        return [inspect_ecat(ecat_path) for ecat_path in ecat_paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(inspect_ecat, ecat_paths))
+
+
+def write_inspection(inspections, outfile, output_format='json'):
+    """
+    Writes inspect_ecat results as json, or as a tsv table with one row per frame where each row
+    holds the frame's subheader followed by its file's main header.
+    :param inspections: list of inspect_ecat results
+    :param outfile: open text file to write to
+    :param output_format: 'json' or 'tsv'
+    :return:
+    """
+    if output_format == 'json':
+        json.dump(inspections, outfile, indent=4, default=str)
+        outfile.write('\n')
+        return
+
+    rows = []
+    for inspection in inspections:
+        for frame_number, subheader in enumerate(inspection['subheaders']):
+            row = {'ecat_path': inspection['ecat_path'], 'frame': frame_number}
+            row.update(subheader)
+            row.update({name: value for name, value in inspection['header'].items() if name not in row})
+            rows.append(row)
+
+    columns = []
+    for row in rows:
+        columns.extend(column for column in row if column not in columns)
+    writer = csv.DictWriter(outfile, fieldnames=columns, delimiter='\t', restval='n/a', lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
 
 
 @Gooey
 def cli():
     parser = GooeyParser()
     parser.add_argument('ecat_path', type=str,
-                        help='Path to ECAT file', widget="FileChooser")
+                        help='Path to ECAT file, or with --show a folder of ECAT files', widget="FileChooser")
     parser.add_argument('--show', '-s', action='store_true',
-                        help="Display headers to screen/stdout.")
+                        help="Display headers to screen/stdout without converting. Only the main header and " +
+                             "subheaders are read.")
+    parser.add_argument('--format', '-f', type=str, default='json', choices=['json', 'tsv'],
+                        help="Output format for --show, tsv writes one row per frame.")
+    parser.add_argument('--output', '-o', type=str, widget='FileSaver',
+                        help="Write --show output to this file instead of stdout.")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help="Number of ECAT files to inspect at once with --show, defaults to the number of cpus.")
     parser.add_argument('--metadata_path', '-m', type=str, widget='FileChooser',
                         help='Path to session metadata file.')
     parser.add_argument('--destination_path', '-d', type=str,
@@ -169,20 +470,52 @@ def cli():
                         "Destination path to send converted imaging and metadata files to. If " +
                         "omitted defaults to using the path supplied to folder path. If destination path " +
                         "doesn't exist an attempt to create it will be made.", required=False,
-                        widget="FileChooser"
+                        widget="DirChooser"
                         )
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float32', 'float64'],
+                        help="Data type of the converted image, float32 uses half the memory of float64.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Convert one frame at a time straight to disk, keeps memory use to about a single " +
+                             "frame regardless of how many frames the ecat has.")
+    parser.add_argument('--compression', '-z', type=str, default='gzip', choices=['gzip', 'none'],
+                        help="gzip the nifti (on every cpu) or leave it uncompressed.")
+    parser.add_argument('--gzip-threads', type=int, default=None,
+                        help="Number of threads to gzip with, defaults to the number of cpus.")
+    parser.add_argument('--trace', '-t', type=str, widget='FileSaver',
+                        help="Time each conversion stage and write a json trace of the time, cpu, io, and memory " +
+                             "used by each stage to this path.")
     args = parser.parse_args()
 
+    if args.show:
+        if isdir(args.ecat_path):
+            ecat_paths = find_ecats(args.ecat_path)
+        elif isfile(args.ecat_path):
+            ecat_paths = [args.ecat_path]
+        else:
+            raise Exception(f"Argument {args.ecat_path} is not a file or folder.")
+
+        inspections = inspect_ecats(ecat_paths, workers=args.workers)
+        if args.output:
+            with open(args.output, 'w', newline='') as outfile:
+                write_inspection(inspections, outfile, args.format)
+        else:
+            write_inspection(inspections, sys.stdout, args.format)
+        return
+
     if args.ecat_path and isfile(args.ecat_path):
-        converter = ConvertToNifti(ecat_path=args.ecat_path)
-        converter.read_in_ecat()
-        print("read in ecat file")
+        instrumentation = Instrumentation(name=args.ecat_path, trace_path=args.trace) if args.trace else None
+        converter = ConvertToNifti(ecat_path=args.ecat_path, destination_path=args.destination_path,
+                                   dtype=args.dtype, stream=args.stream, instrumentation=instrumentation,
+                                   compression=args.compression, gzip_threads=args.gzip_threads)
+        if not args.stream:
+            converter.write_nifti()
+        print(f"converted {args.ecat_path} to {converter.nifti_file}")
+        if args.trace:
+            instrumentation.write_trace()
+            instrumentation.print_summary()
     else:
         raise Exception(f"Argument {args.ecat_path} is not file.")
 
-    if args.show:
-        converter.show_header()
-
 
 if __name__ == "__main__":
     cli()
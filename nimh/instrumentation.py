@@ -0,0 +1,196 @@
+import contextlib
+import json
+import os
+import platform
+import socket
+import threading
+import time
+
+from lazy_imports import lazy_import
+
+psutil = lazy_import('psutil')
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, process, interval=0.05, include_children=False):
+        """
+        Polls the resident set size of a process in the background and keeps the largest value seen.
+        :param process: psutil.Process to watch
+        :param interval: seconds between samples
+        :param include_children: add the memory of the process' children (e.g. dcm2niix) to its own
+        """
+        super().__init__(daemon=True)
+        self.process = process
+        self.interval = interval
+        self.include_children = include_children
+        self.peak_rss = 0
+        self.finished = threading.Event()
+        self.sample()
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        try:
+            rss = self.process.memory_info().rss
+            if self.include_children:
+                for child in self.process.children(recursive=True):
+                    try:
+                        rss += child.memory_info().rss
+                    except psutil.Error:
+                        # finished since it was listed
+                        pass
+            self.peak_rss = max(self.peak_rss, rss)
+        except psutil.Error:
+            pass
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+        self.sample()
+        return self.peak_rss
+
+
+class Instrumentation:
+    def __init__(self, name=None, enabled=True, hooks=None, sample_interval=0.05, trace_path=None, threaded=False):
+        """
+        Records wall time, cpu time, subprocess cpu time, bytes read and written, and peak memory for
+        each stage of a conversion, e.g.
+
+            with instrumentation.stage('dcm2niix'):
+                converter.run_dcm2niix()
+
+        Hooks are called with ('start', record) when a stage begins and ('end', record) when it ends.
+        :param name: name for the run, included in the trace
+        :param enabled: when False stages are not measured and hooks aren't called
+        :param hooks: list of callables taking (event, record)
+        :param sample_interval: seconds between memory samples while a stage runs
+        :param trace_path: write a json trace to this path every time a top level stage finishes
+        :param threaded: stages run on threads alongside other sessions' stages (e.g. in a ConversionPipeline).
+        Cpu time is then that of the stage's own thread, and the subprocess cpu, io and memory figures, which
+        can only be had for the whole process, are left out (None) rather than charged to whichever stage is
+        running at the time
+        """
+        self.name = name
+        self.enabled = enabled
+        self.hooks = list(hooks or [])
+        self.sample_interval = sample_interval
+        self.trace_path = trace_path
+        self.threaded = threaded
+        self.stages = []
+        self.started = time.time()
+        self.depth = 0
+        self._process = None
+
+    @property
+    def process(self):
+        if self._process is None:
+            self._process = psutil.Process()
+        return self._process
+
+    def io_counters(self):
+        """
+        :return: (bytes read, bytes written) by this process so far or (None, None) where unsupported,
+        on linux this counts everything passed through read/write calls (including reads served from the
+        page cache) rather than only what reached the disk
+        """
+        try:
+            counters = self.process.io_counters()
+            if hasattr(counters, 'read_chars'):
+                return counters.read_chars, counters.write_chars
+            return counters.read_bytes, counters.write_bytes
+        except (AttributeError, NotImplementedError, psutil.Error):
+            return None, None
+
+    @contextlib.contextmanager
+    def stage(self, name, **details):
+        """
+        Measures the code run inside of the with block as a stage named name
+        :param name: stage name
+        :param details: any extra values to keep with the stage record (e.g. a file path)
+        :return: yields the stage record, which is filled in when the block exits
+        """
+        if not self.enabled:
+            yield {}
+            return
+
+        record = {'stage': name, 'depth': self.depth, 'status': 'running'}
+        record.update(details)
+        for hook in self.hooks:
+            hook('start', record)
+
+        sampler = None
+        start_read, start_written = None, None
+        if not self.threaded:
+            sampler = MemorySampler(self.process, self.sample_interval)
+            sampler.start()
+            start_read, start_written = self.io_counters()
+        start_times = os.times()
+        cpu_time = time.thread_time if self.threaded else time.process_time
+        start_cpu = cpu_time()
+        start = time.perf_counter()
+        record['started'] = time.time()
+        self.depth += 1
+        try:
+            yield record
+            record['status'] = 'success'
+        except BaseException as err:
+            record['status'] = 'failed'
+            record['error'] = f"{type(err).__name__}: {err}"
+            raise
+        finally:
+            self.depth -= 1
+            record['wall_seconds'] = round(time.perf_counter() - start, 6)
+            record['cpu_seconds'] = round(cpu_time() - start_cpu, 6)
+            if self.threaded:
+                record.update(subprocess_cpu_seconds=None, bytes_read=None, bytes_written=None, peak_rss_bytes=None)
+            else:
+                end_times = os.times()
+                record['subprocess_cpu_seconds'] = round(
+                    (end_times.children_user - start_times.children_user) +
+                    (end_times.children_system - start_times.children_system), 6)
+                end_read, end_written = self.io_counters()
+                record['bytes_read'] = end_read - start_read if start_read is not None else None
+                record['bytes_written'] = end_written - start_written if start_written is not None else None
+                record['peak_rss_bytes'] = sampler.stop()
+
+            self.stages.append(record)
+            for hook in self.hooks:
+                hook('end', record)
+            if self.trace_path and self.depth == 0:
+                self.write_trace()
+
+    def summary(self):
+        """
+        :return: dictionary of the run and every recorded stage
+        """
+        return {
+            'name': self.name,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'python': platform.python_version(),
+            'started': self.started,
+            'threaded': self.threaded,
+            'stages': self.stages,
+        }
+
+    def write_trace(self, trace_path=None):
+        """
+        Writes the summary as json
+        :param trace_path: defaults to self.trace_path
+        :return: path written to
+        """
+        trace_path = trace_path if trace_path else self.trace_path
+        with open(trace_path, 'w') as outfile:
+            json.dump(self.summary(), outfile, indent=4, default=str)
+        return trace_path
+
+    def print_summary(self):
+        for record in sorted(self.stages, key=lambda record: record['started']):
+            line = f"{'    ' * record['depth']}{record['stage']}: {record['wall_seconds']:.3f}s wall, " + \
+                   f"{record['cpu_seconds']:.3f}s {'thread ' if self.threaded else ''}cpu, "
+            if not self.threaded:
+                line += f"{record['subprocess_cpu_seconds']:.3f}s subprocess, " + \
+                        f"{record['peak_rss_bytes'] / 1024 ** 2:.1f}MB peak, "
+            print(line + record['status'])
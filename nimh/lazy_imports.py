@@ -0,0 +1,99 @@
+import argparse
+import functools
+import importlib.util
+import sys
+
+# set by Gooey when the wrapped cli runs without the gui, GooeyParser then hands back a plain argparse parser
+headless = False
+
+# names of the modules handed out by lazy_import
+lazy_modules = []
+
+
+def lazy_import(name):
+    """
+    Returns a module that isn't actually executed until one of its attributes is used, this keeps
+    heavy dependencies (pandas, nibabel, pydicom, numpy) from slowing down start up for code paths
+    that never touch them.
+    :param name: module name
+    :return: the (lazily loaded) module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    lazy_modules.append(name)
+    return module
+
+
+def load_lazy_modules():
+    """
+    Finishes loading every module handed out by lazy_import. The first attribute access on a lazy
+    module isn't thread safe, so call this before starting threads that might touch them at once.
+    :return:
+    """
+    for name in lazy_modules:
+        module = sys.modules.get(name)
+        if module is not None:
+            getattr(module, '__name__')
+
+
+class HeadlessParser(argparse.ArgumentParser):
+    """
+    Stand in for gooey.GooeyParser on the command line, accepts and ignores Gooey's widget and
+    gooey_options keywords.
+    """
+    def add_argument(self, *args, widget=None, gooey_options=None, **kwargs):
+        return super().add_argument(*args, **kwargs)
+
+    def add_argument_group(self, *args, gooey_options=None, **kwargs):
+        group = super().add_argument_group(*args, **kwargs)
+        group.add_argument = functools.partial(HeadlessParser._group_add_argument, group.add_argument)
+        return group
+
+    @staticmethod
+    def _group_add_argument(add_argument, *args, widget=None, gooey_options=None, **kwargs):
+        return add_argument(*args, **kwargs)
+
+
+def GooeyParser(*args, **kwargs):
+    """
+    Returns gooey.GooeyParser when the gui is being shown, otherwise a HeadlessParser so that
+    gooey (and wxPython) never get imported for command line runs.
+    """
+    if headless:
+        return HeadlessParser(*args, **kwargs)
+
+    from gooey import GooeyParser as gooey_parser
+    return gooey_parser(*args, **kwargs)
+
+
+def Gooey(function=None, **options):
+    """
+    Drop in replacement for the gooey.Gooey decorator that only imports gooey when the gui is going
+    to be shown. Like gooey, passing --ignore-gooey skips the gui and runs the function directly.
+    """
+    def decorator(cli_function):
+        @functools.wraps(cli_function)
+        def wrapper(*args, **kwargs):
+            global headless
+            if '--ignore-gooey' in sys.argv:
+                sys.argv.remove('--ignore-gooey')
+                headless = True
+                return cli_function(*args, **kwargs)
+
+            from gooey import Gooey as gooey
+            return gooey(cli_function, **options)(*args, **kwargs)
+
+        return wrapper
+
+    if function is None:
+        return decorator
+    return decorator(function)
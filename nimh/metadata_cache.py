@@ -0,0 +1,129 @@
+import collections
+import hashlib
+import os
+import threading
+
+from lazy_imports import lazy_import
+
+pandas = lazy_import('pandas')
+
+# where parsed workbooks are kept if a cache directory isn't supplied
+default_cache_dir = os.environ.get(
+    'BESPOKE_METADATA_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'bespoke_bids_converters', 'metadata'))
+
+# number of parsed workbooks kept in memory per process
+memory_limit = 32
+
+# parsed workbooks shared by every MetadataCache in this process, content hash -> dataframe
+_parsed = collections.OrderedDict()
+# path -> (modification time, size, content hash), saves rehashing a workbook that hasn't changed
+_stats = {}
+_lock = threading.Lock()
+
+
+def _sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_metadata_file(path):
+    """
+    Parses a metadata spreadsheet, the first row is taken as the header just as Convert has always read
+    them so that the rows and columns bespoke() picks out with iloc don't move
+    :param path: excel, csv, or tsv file
+    :return: pandas.DataFrame
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if 'xls' in extension:
+        return pandas.read_excel(path)
+    elif extension == '.tsv':
+        return pandas.read_csv(path, sep='\t')
+    elif extension == '.csv':
+        return pandas.read_csv(path)
+    raise Exception(f"Unable to read metadata from {path}, expected an excel, csv, or tsv file.")
+
+
+class MetadataCache:
+    def __init__(self, cache_dir=None, persist=True):
+        """
+        Parses each metadata workbook once and serves it from memory afterwards. Workbooks are identified
+        by their path, modification time and size, which are checked against a hash of their contents, so
+        an edited workbook is always re-read and a copy of one that's already been parsed is not. With
+        persist the parsed workbook is also pickled into cache_dir so other processes (e.g. the workers of
+        a batch) and later runs skip parsing too.
+        :param cache_dir: folder to keep parsed workbooks in, defaults to default_cache_dir
+        :param persist: keep parsed workbooks on disk as well as in memory
+        """
+        self.cache_dir = cache_dir if cache_dir else default_cache_dir
+        self.persist = persist
+        if self.persist:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def content_hash(self, path):
+        """
+        :return: sha256 of the workbook, only recomputed when its modification time or size changes
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with _lock:
+            known = _stats.get(path)
+        if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return known[2]
+        digest = _sha256(path)
+        with _lock:
+            _stats[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def entry_path(self, digest):
+        return os.path.join(self.cache_dir, digest + '.pkl')
+
+    def remember(self, digest, dataframe):
+        with _lock:
+            _parsed[digest] = dataframe
+            _parsed.move_to_end(digest)
+            while len(_parsed) > memory_limit:
+                _parsed.popitem(last=False)
+
+    def read(self, path):
+        """
+        :param path: path to a metadata workbook
+        :return: the parsed workbook, a copy so callers are free to modify it
+        """
+        digest = self.content_hash(path)
+        with _lock:
+            dataframe = _parsed.get(digest)
+            if dataframe is not None:
+                _parsed.move_to_end(digest)
+                return dataframe.copy()
+
+        entry = self.entry_path(digest)
+        if self.persist and os.path.isfile(entry):
+            try:
+                dataframe = pandas.read_pickle(entry)
+            except Exception as err:
+                print(f"Unable to read cached metadata at {entry}, parsing {path} again: {err}")
+
+        if dataframe is None:
+            dataframe = read_metadata_file(path)
+            if self.persist:
+                temporary_path = entry + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+                try:
+                    dataframe.to_pickle(temporary_path)
+                    os.replace(temporary_path, entry)
+                except OSError as err:
+                    print(f"Unable to cache parsed metadata to {entry}: {err}")
+
+        self.remember(digest, dataframe)
+        return dataframe.copy()
+
+    def clear(self):
+        """
+        Forgets every parsed workbook held in memory, the on disk entries are left alone
+        """
+        with _lock:
+            _parsed.clear()
+            _stats.clear()
@@ -0,0 +1,303 @@
+import importlib
+import json
+import os
+import re
+import threading
+
+from lazy_imports import lazy_import
+
+numpy = lazy_import('numpy')
+
+# mapping used when none is supplied, reproduces what Convert.bespoke used to hard code
+default_mapping = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mappings', 'nimh_pet.json')
+
+# the structures a mapping fills in, see Convert.bespoke
+outputs = ('pet_json', 'blood_json', 'blood_tsv', 'participants')
+
+# where a rule can read a value from by key: dicom header, dcm2niix sidecar, or values describing the session
+keyed_sources = ('dicom', 'nifti_json', 'session')
+
+rule_kinds = keyed_sources + ('value', 'cell', 'column', 'list', 'product')
+rule_modifiers = ('default', 'transform', 'index', 'scale', 'divide', 'as')
+
+
+def frame_starts(durations):
+    """
+    :param durations: frame durations
+    :return: the start time of each frame, the running total of the durations before it
+    """
+    durations = numpy.asarray(durations, dtype=float)
+    return numpy.concatenate(([0], numpy.cumsum(durations)[:-1])).astype(int)
+
+
+def energy_window(sequence):
+    """
+    :param sequence: the EnergyWindowRangeSequence of a dicom header
+    :return: (lowest lower limit, highest upper limit) of the energy windows in keV
+    """
+    lower = [float(item.EnergyWindowLowerLimit) for item in sequence if 'EnergyWindowLowerLimit' in item]
+    upper = [float(item.EnergyWindowUpperLimit) for item in sequence if 'EnergyWindowUpperLimit' in item]
+    if lower and upper:
+        return min(lower), max(upper)
+    # fall back to picking the numbers out of the sequence's text
+    numbers = [float(number) for number in re.findall(r'\d+\.\d+', str(sequence))]
+    return min(numbers), max(numbers)
+
+
+# functions a rule can apply to the value it reads with "transform"
+transforms = {
+    'frame_starts': frame_starts,
+    'energy_window': energy_window,
+}
+
+casts = {'int': int, 'float': float, 'str': str, 'list': lambda value: [value]}
+
+
+def to_native(value):
+    """
+    Converts numpy and pydicom values into plain python ones so they can be written as json
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'MultiValue':
+        return [to_native(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_native(item) for key, item in value.items()}
+    if type(value).__name__ == 'PersonName':
+        return str(value)
+    return value
+
+
+def read_mapping(path):
+    """
+    Reads a mapping spec from a json or (if PyYAML is installed) yaml file
+    :param path: path to the spec
+    :return: the spec as a dictionary
+    """
+    with open(path, 'r') as infile:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                yaml = importlib.import_module('yaml')
+            except ImportError:
+                raise Exception(f"Reading {path} requires PyYAML, install it or write the mapping as json.")
+            return yaml.safe_load(infile)
+        return json.load(infile)
+
+
+class MappingPlan:
+    def __init__(self, spec, name=None):
+        """
+        A metadata mapping compiled into an extraction plan. The spec says how each field of the PET
+        sidecar, blood tsv and json, and participants table is derived, e.g.
+
+            {"outputs": {"pet_json": {
+                "Units": {"value": "Bq/mL"},
+                "TracerRadionuclide": {"nifti_json": "RadionuclideTotalDose", "default": 0, "divide": 1000000},
+                "InjectedMass": {"product": [{"cell": [35, 10]}, {"cell": [38, 6]}]},
+                "FrameTimesStart": {"nifti_json": "FrameDuration", "transform": "frame_starts"}},
+             "blood_tsv": {"time": {"column": 6, "rows": [2, 7], "scale": 60}}}}
+
+        Rules read a constant ("value"), a dicom header entry ("dicom"), a dcm2niix sidecar entry
+        ("nifti_json"), subject_id or session_id ("session"), a spreadsheet cell ("cell": [row, column]) or
+        a range of rows in a spreadsheet column ("column" and "rows": [start, stop]), or combine other rules
+        ("list", "product"). The value can then be changed with "transform" (see transforms), "index",
+        "scale", "divide", and "as" (int, float, str, or list). Entries missing from the header or sidecar
+        are an error unless the rule gives a "default", only those rules can have a "transform" or "default".
+        A rule that isn't a dictionary is a constant.
+
+        Compiling checks the whole spec and gathers every spreadsheet cell and column the plan reads, so
+        applying it to a session reads them all from the spreadsheet at once and scales them as arrays.
+        :param spec: mapping spec dictionary
+        :param name: name used in error messages, e.g. the spec's path
+        """
+        self.name = name if name else 'mapping'
+        self.cells = []  # (row, column) of every spreadsheet cell read
+        self.blocks = {}  # (start row, stop row) -> list of (column, scale, divide) read from that range
+        unknown = set(spec.get('outputs', {})) - set(outputs)
+        if unknown:
+            raise Exception(f"{self.name}: unknown outputs {sorted(unknown)}, expected some of {list(outputs)}")
+        self.fields = {output: {field: self.compile_rule(rule, f"{output}.{field}")
+                                for field, rule in spec.get('outputs', {}).get(output, {}).items()}
+                       for output in outputs}
+
+    def compile_rule(self, rule, field):
+        """
+        Turns a rule into a function that takes the values read for a session and returns the field's value
+        """
+        if not isinstance(rule, dict):
+            rule = {'value': rule}
+        kinds = [kind for kind in rule_kinds if kind in rule]
+        unknown = set(rule) - set(rule_kinds) - set(rule_modifiers) - {'rows'}
+        if len(kinds) != 1 or unknown:
+            raise Exception(f"{self.name}: {field} must use exactly one of {list(rule_kinds)}" +
+                            (f", unknown keys {sorted(unknown)}" if unknown else ''))
+        kind = kinds[0]
+
+        if kind == 'column':
+            # scale and divide are applied to the whole block of rows it belongs to, the other modifiers below
+            start, stop = rule.get('rows', [None, None])
+            if start is None or stop is None:
+                raise Exception(f"{self.name}: {field} needs rows: [start, stop] to read a column")
+            block = self.blocks.setdefault((start, stop), [])
+            block.append((rule['column'], rule.get('scale', 1), rule.get('divide', 1)))
+            position = len(block) - 1
+            get = lambda session: session['blocks'][(start, stop)][:, position]
+            rule = {key: value for key, value in rule.items() if key not in ('scale', 'divide')}
+        elif kind == 'value':
+            constant = rule['value']
+            get = lambda session: constant
+        elif kind == 'cell':
+            self.cells.append(tuple(rule['cell']))
+            position = len(self.cells) - 1
+            get = lambda session: session['cells'][position]
+        elif kind == 'list':
+            items = [self.compile_rule(item, f"{field}[{index}]") for index, item in enumerate(rule['list'])]
+            get = lambda session: [item(session) for item in items]
+        elif kind == 'product':
+            items = [self.compile_rule(item, f"{field}[{index}]") for index, item in enumerate(rule['product'])]
+
+            def get(session):
+                value = items[0](session)
+                for item in items[1:]:
+                    value = value * item(session)
+                return value
+        else:
+            get = self.compile_lookup(kind, rule, field)
+
+        return self.compile_modifiers(get, rule, field, kind)
+
+    def compile_lookup(self, source, rule, field):
+        key = rule[source]
+        has_default = 'default' in rule
+        default = rule.get('default')
+        transform = rule.get('transform')
+        if transform is not None and transform not in transforms:
+            raise Exception(f"{self.name}: {field} uses unknown transform {transform}, expected one of " +
+                            f"{list(transforms)}")
+        memo_key = (source, key, transform)
+
+        def get(session):
+            # transforms are only run once per session no matter how many fields use them, the memo holds what
+            # was read (None if nothing) since fields reading the same entry can have different defaults
+            if memo_key in session['memo']:
+                value = session['memo'][memo_key]
+            else:
+                values = session[source]
+                value = values.get(key) if values is not None else None
+                if value is not None and transform:
+                    value = transforms[transform](value)
+                session['memo'][memo_key] = value
+            if value is None:
+                if not has_default:
+                    raise Exception(f"{field}: {key} not found in the {source.replace('_', ' ')}")
+                return default
+            return value
+        return get
+
+    @staticmethod
+    def compile_modifiers(get, rule, field, kind):
+        index = rule.get('index')
+        multiplier = rule.get('scale', 1)
+        divisor = rule.get('divide', 1)
+        cast = casts.get(rule.get('as'))
+        if rule.get('as') is not None and cast is None:
+            raise Exception(f"{field}: unknown type {rule['as']}, expected one of {list(casts)}")
+        for modifier in ('transform', 'default'):
+            if modifier in rule and kind not in keyed_sources:
+                raise Exception(f"{field}: {modifier} can only be used with {list(keyed_sources)}")
+        if index is None and multiplier == 1 and divisor == 1 and cast is None:
+            return get
+
+        def modified(session):
+            value = get(session)
+            if index is not None:
+                value = value[index]
+            if value is not None and multiplier != 1:
+                value = value * multiplier
+            if value is not None and divisor != 1:
+                value = value / divisor
+            if cast is not None:
+                value = cast(value)
+            return value
+        return modified
+
+    def read_spreadsheet(self, spreadsheet):
+        """
+        Gathers every cell and column range the plan uses from the spreadsheet in one go
+        :return: (array of cell values, dictionary of (start, stop) -> scaled 2d array of column values)
+        """
+        if not self.cells and not self.blocks:
+            return None, {}
+        if spreadsheet is None:
+            raise Exception(f"{self.name} reads from a metadata spreadsheet but none was supplied")
+        values = spreadsheet.to_numpy() if hasattr(spreadsheet, 'to_numpy') else numpy.asarray(spreadsheet)
+
+        cells = None
+        if self.cells:
+            rows, columns = zip(*self.cells)
+            cells = values[list(rows), list(columns)]
+
+        blocks = {}
+        for (start, stop), block in self.blocks.items():
+            columns, multipliers, divisors = zip(*block)
+            blocks[(start, stop)] = \
+                values[start:stop, list(columns)].astype(float) * numpy.asarray(multipliers) / numpy.asarray(divisors)
+        return cells, blocks
+
+    def apply(self, dicom=None, nifti_json=None, spreadsheet=None, session=None):
+        """
+        Runs the plan for one session
+        :param dicom: dicom header (pydicom Dataset) of the session
+        :param nifti_json: dcm2niix sidecar of the session
+        :param spreadsheet: metadata spreadsheet (pandas DataFrame) of the session
+        :param session: dictionary with the session's subject_id and session_id
+        :return: dictionary of output name -> {field: value}, the pet and blood jsons hold plain python values,
+        blood_tsv and participants columns are ready to be handed to pandas.DataFrame
+        """
+        cells, blocks = self.read_spreadsheet(spreadsheet)
+        values = {'dicom': dicom, 'nifti_json': nifti_json, 'session': session or {}, 'cells': cells,
+                  'blocks': blocks, 'memo': {}}
+
+        results = {}
+        for output, fields in self.fields.items():
+            results[output] = {field: get(values) for field, get in fields.items()}
+        for output in ('pet_json', 'blood_json'):
+            results[output] = {field: to_native(value) for field, value in results[output].items()}
+        return results
+
+
+# compiled plans by path, a batch only compiles each mapping once per process
+_plans = {}
+_lock = threading.Lock()
+
+
+def load_mapping(mapping=None):
+    """
+    :param mapping: path to a json/yaml mapping spec, a spec dictionary, or a MappingPlan, defaults to default_mapping
+    :return: compiled MappingPlan
+    """
+    if isinstance(mapping, MappingPlan):
+        return mapping
+    if isinstance(mapping, dict):
+        return MappingPlan(mapping)
+
+    path = os.path.abspath(mapping if mapping else default_mapping)
+    modified = os.stat(path).st_mtime_ns
+    with _lock:
+        plan = _plans.get(path)
+        if plan and plan[0] == modified:
+            return plan[1]
+    compiled = MappingPlan(read_mapping(path), name=os.path.basename(path))
+    with _lock:
+        _plans[path] = (modified, compiled)
+    return compiled
@@ -0,0 +1,275 @@
+import datetime
+import json
+import os
+import re
+
+from lazy_imports import lazy_import
+from parallel_gzip import ParallelGzipWriter
+
+nibabel = lazy_import('nibabel')
+numpy = lazy_import('numpy')
+pydicom = lazy_import('pydicom')
+
+# name written into the sidecar's ConversionSoftware, dcm2niix writes its own name there
+conversion_software = 'BespokeBIDSConverters native engine'
+
+# sidecar entries copied straight from the dicom header, dcm2niix name -> dicom keyword
+sidecar_tags = {
+    'Modality': 'Modality',
+    'Manufacturer': 'Manufacturer',
+    'ManufacturersModelName': 'ManufacturerModelName',
+    'SeriesDescription': 'SeriesDescription',
+    'ProtocolName': 'ProtocolName',
+    'SeriesNumber': 'SeriesNumber',
+    'SeriesInstanceUID': 'SeriesInstanceUID',
+    'ImageType': 'ImageType',
+    'Units': 'Units',
+    'DecayCorrection': 'DecayCorrection',
+    'ReconstructionMethod': 'ReconstructionMethod',
+    'ConvolutionKernel': 'ConvolutionKernel',
+    'AttenuationCorrectionMethod': 'AttenuationCorrectionMethod',
+    'SliceThickness': 'SliceThickness',
+    'ImageOrientationPatientDICOM': 'ImageOrientationPatient',
+}
+
+# entries of the RadiopharmaceuticalInformationSequence copied into the sidecar
+radiopharmaceutical_tags = ['Radiopharmaceutical', 'RadionuclideTotalDose', 'RadionuclideHalfLife',
+                            'RadionuclidePositronFraction', 'RadiopharmaceuticalStartTime']
+
+
+def native_value(value):
+    """
+    Converts a pydicom value into something json can hold
+    """
+    if value is None:
+        return None
+    if type(value).__name__ == 'MultiValue' or isinstance(value, (list, tuple)):
+        return [native_value(item) for item in value]
+    if type(value).__name__ in ('DSfloat', 'DSdecimal') or isinstance(value, float):
+        return float(value)
+    if type(value).__name__ == 'IS' or isinstance(value, int):
+        return int(value)
+    return str(value)
+
+
+def dicom_seconds(date, time):
+    """
+    :param date: dicom DA value (YYYYMMDD), may be empty
+    :param time: dicom TM value (HHMMSS.FFFFFF)
+    :return: seconds since the epoch (or since midnight without a date), None if there's no time
+    """
+    if not time:
+        return None
+    time = str(time).replace(':', '')
+    hours, minutes, seconds = int(time[0:2]), int(time[2:4] or 0), float(time[4:] or 0)
+    moment = hours * 3600 + minutes * 60 + seconds
+    if date:
+        moment += datetime.datetime.strptime(str(date), '%Y%m%d').replace(tzinfo=datetime.timezone.utc).timestamp()
+    return moment
+
+
+def frame_key(dataset):
+    """
+    :return: a value shared by every slice of one frame of a dynamic series
+    """
+    if 'TemporalPositionIdentifier' in dataset:
+        return int(dataset.TemporalPositionIdentifier)
+    if 'FrameReferenceTime' in dataset:
+        return float(dataset.FrameReferenceTime)
+    return dicom_seconds(dataset.get('AcquisitionDate'), dataset.get('AcquisitionTime'))
+
+
+def slice_normal(dataset):
+    orientation = numpy.asarray(dataset.ImageOrientationPatient, dtype=float)
+    return numpy.cross(orientation[:3], orientation[3:])
+
+
+def read_series(paths):
+    """
+    Reads a series' dicoms and orders them by frame, then by position along the slice normal
+    :param paths: files of one series
+    :return: list of frames, each a list of pydicom datasets sorted by position
+    """
+    datasets = []
+    for path in paths:
+        try:
+            datasets.append(pydicom.dcmread(path))
+        except (pydicom.errors.InvalidDicomError, EOFError) as err:
+            raise Exception(f"Unable to read {path}: {err}")
+    if not datasets:
+        raise Exception("No dicoms to convert")
+
+    normal = slice_normal(datasets[0])
+    frames = {}
+    for dataset in datasets:
+        frames.setdefault(frame_key(dataset), []).append(dataset)
+
+    def start(frame):
+        first = frame[0]
+        moment = dicom_seconds(first.get('AcquisitionDate'), first.get('AcquisitionTime'))
+        return moment if moment is not None else float(first.get('FrameReferenceTime', 0))
+
+    ordered = sorted(frames.values(), key=start)
+    for frame in ordered:
+        frame.sort(key=lambda dataset: float(numpy.dot(numpy.asarray(dataset.ImagePositionPatient, dtype=float),
+                                                       normal)))
+    sizes = {len(frame) for frame in ordered}
+    if len(sizes) != 1:
+        raise Exception(f"Frames of the series have different numbers of slices: {sorted(sizes)}")
+    return ordered
+
+
+def series_affine(frame):
+    """
+    :param frame: slices of one frame sorted by position
+    :return: 4x4 affine mapping (column, row, slice) voxel indexes to RAS+ millimetres
+    """
+    first = frame[0]
+    orientation = numpy.asarray(first.ImageOrientationPatient, dtype=float)
+    row_spacing, column_spacing = (float(spacing) for spacing in first.PixelSpacing)
+    first_position = numpy.asarray(first.ImagePositionPatient, dtype=float)
+    if len(frame) > 1:
+        step = (numpy.asarray(frame[-1].ImagePositionPatient, dtype=float) - first_position) / (len(frame) - 1)
+    else:
+        thickness = float(first.get('SpacingBetweenSlices', first.get('SliceThickness', 1)))
+        step = slice_normal(first) * thickness
+
+    affine = numpy.eye(4)
+    affine[:3, 0] = orientation[:3] * column_spacing
+    affine[:3, 1] = orientation[3:] * row_spacing
+    affine[:3, 2] = step
+    affine[:3, 3] = first_position
+    # dicom positions are LPS, nifti's are RAS
+    return numpy.diag([-1, -1, 1, 1]) @ affine
+
+
+def stack_pixels(frames):
+    """
+    Stacks every slice's pixel data into a 4d (column, row, slice, frame) volume. Rescale slopes and intercepts are
+    applied to the whole stack at once, if every slice shares the same ones the stored values are kept as they are
+    and the slope and intercept are returned for the nifti header instead.
+    :param frames: as returned by read_series
+    :return: (volume, slope, intercept)
+    """
+    slices = [dataset for frame in frames for dataset in frame]
+    first = slices[0].pixel_array
+    raw = numpy.empty((len(slices),) + first.shape, dtype=first.dtype)
+    for index, dataset in enumerate(slices):
+        raw[index] = first if index == 0 else dataset.pixel_array
+
+    slopes = numpy.array([float(dataset.get('RescaleSlope', 1)) for dataset in slices], dtype=numpy.float32)
+    intercepts = numpy.array([float(dataset.get('RescaleIntercept', 0)) for dataset in slices],
+                             dtype=numpy.float32)
+    slope, intercept = 1.0, 0.0
+    if (slopes == slopes[0]).all() and (intercepts == intercepts[0]).all():
+        slope, intercept = float(slopes[0]), float(intercepts[0])
+        volume = raw
+    else:
+        volume = raw.astype(numpy.float32)
+        volume *= slopes[:, None, None]
+        volume += intercepts[:, None, None]
+
+    # (frame * slice, row, column) -> (column, row, slice, frame)
+    volume = volume.reshape((len(frames), len(frames[0])) + first.shape)
+    return volume.transpose(3, 2, 1, 0), slope, intercept
+
+
+def build_sidecar(frames):
+    """
+    Builds the json sidecar dcm2niix would have written for a series
+    :param frames: as returned by read_series
+    :return: sidecar dictionary
+    """
+    first = frames[0][0]
+    sidecar = {}
+    for name, keyword in sidecar_tags.items():
+        if keyword in first:
+            sidecar[name] = native_value(first.get(keyword))
+    if 'RadiopharmaceuticalInformationSequence' in first and first.RadiopharmaceuticalInformationSequence:
+        information = first.RadiopharmaceuticalInformationSequence[0]
+        for keyword in radiopharmaceutical_tags:
+            if keyword in information:
+                sidecar[keyword] = native_value(information.get(keyword))
+    if 'AcquisitionTime' in first:
+        sidecar['AcquisitionTime'] = str(first.AcquisitionTime)
+
+    heads = [frame[0] for frame in frames]
+    starts = [dicom_seconds(head.get('AcquisitionDate'), head.get('AcquisitionTime')) for head in heads]
+    if None not in starts:
+        sidecar['FrameTimesStart'] = [round(start - starts[0], 3) for start in starts]
+    if all('ActualFrameDuration' in head for head in heads):
+        sidecar['FrameDuration'] = [float(head.ActualFrameDuration) / 1000 for head in heads]
+    if all('DecayFactor' in head for head in heads):
+        sidecar['DecayFactor'] = [float(head.DecayFactor) for head in heads]
+    sidecar['ConversionSoftware'] = conversion_software
+    return sidecar
+
+
+def output_name(folder, dataset):
+    """
+    :return: file name (without extension) for a series, following dcm2niix's default %f_%p_%t_%s
+    """
+    parts = [os.path.basename(os.path.normpath(folder)),
+             str(dataset.get('ProtocolName') or dataset.get('SeriesDescription') or ''),
+             str(dataset.get('StudyDate', '')) + str(dataset.get('StudyTime', dataset.get('SeriesTime', '')))[:6],
+             str(dataset.get('SeriesNumber', ''))]
+    return '_'.join(re.sub(r'[^a-zA-Z0-9.-]', '_', part).strip('_') for part in parts if part)
+
+
+def convert_series(paths, destination_path, name, compression='gzip', gzip_threads=None):
+    """
+    Converts one dicom series to a nifti and json sidecar without calling dcm2niix
+    :param paths: files of the series
+    :param destination_path: folder to write to
+    :param name: file name without extension
+    :param compression: 'gzip' writes a .nii.gz on gzip_threads threads, anything else a .nii
+    :param gzip_threads: number of threads to gzip with, defaults to the number of cpus
+    :return: dictionary with the nifti_path, sidecar_path, sidecar, and shape written
+    """
+    frames = read_series(paths)
+    volume, slope, intercept = stack_pixels(frames)
+    if volume.shape[3] == 1:
+        volume = volume[:, :, :, 0]
+    affine = series_affine(frames[0])
+
+    image = nibabel.Nifti1Image(volume, affine)
+    image.header.set_slope_inter(slope, intercept)
+    image.header.set_qform(affine, code='scanner')
+    image.header.set_sform(affine, code='scanner')
+    image.header.set_xyzt_units('mm', 'sec')
+
+    nifti_path = os.path.join(destination_path, name + ('.nii.gz' if compression == 'gzip' else '.nii'))
+    if compression == 'gzip':
+        with ParallelGzipWriter(nifti_path, compresslevel=6, threads=gzip_threads) as outfile:
+            image.to_file_map({'image': nibabel.FileHolder(fileobj=outfile)})
+    else:
+        nibabel.save(image, nifti_path)
+
+    sidecar = build_sidecar(frames)
+    sidecar_path = os.path.join(destination_path, name + '.json')
+    with open(sidecar_path, 'w') as outfile:
+        json.dump(sidecar, outfile, indent=4)
+    return {'nifti_path': nifti_path, 'sidecar_path': sidecar_path, 'sidecar': sidecar, 'shape': volume.shape}
+
+
+def convert_index(index, destination_path, compression='gzip', gzip_threads=None):
+    """
+    Converts every series in a scanned folder
+    :param index: dicom_index.DicomSeriesIndex that's been updated
+    :param destination_path: folder to write to
+    :param compression: see convert_series
+    :param gzip_threads: see convert_series
+    :return: dictionary of series uid -> convert_series result, in the index's series order
+    """
+    os.makedirs(destination_path, exist_ok=True)
+    results = {}
+    names = set()
+    for series_uid in index.series_uids():
+        paths = index.get_files(series_uid)
+        name = output_name(index.folder, pydicom.dcmread(paths[0], stop_before_pixels=True))
+        if name in names:
+            # series that would share a name get a suffix, like dcm2niix's _a, _b, ...
+            name += f'_{len(names)}'
+        names.add(name)
+        results[series_uid] = convert_series(paths, destination_path, name, compression, gzip_threads)
+    return results
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+
+# name of the index file written into the root of an output tree
+index_filename = '.nifti_sidecar_index.json'
+
+# bump this when the layout of the index file changes so stale indexes get rebuilt
+index_version = 1
+
+nifti_extensions = ('.nii.gz', '.nii')
+
+# sidecar entries recorded in the index, used to tell series apart
+sidecar_fields = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'ProtocolName', 'Modality',
+                  'AcquisitionTime']
+
+
+def split_nifti_path(path):
+    """
+    :return: (path without extension, extension) for .nii and .nii.gz files, (path, None) otherwise
+    """
+    lowered = path.lower()
+    for extension in nifti_extensions:
+        if lowered.endswith(extension):
+            return path[:-len(extension)], extension
+    return path, None
+
+
+class NiftiSidecarIndex:
+    def __init__(self, root, index_path=None):
+        """
+        Index of the niftis in an output tree paired with their json sidecars. The tree is walked once,
+        each nifti is matched to the json with the same name in the same folder, and the series
+        information in that sidecar is recorded. Sidecars are only re-read when their modification
+        time or size changes, so the index can be kept up to date cheaply as conversions land in a
+        shared output tree.
+        :param root: root of the output tree
+        :param index_path: where to keep the index, defaults to index_filename inside of root
+        """
+        self.root = root
+        self.index_path = index_path if index_path else os.path.join(root, index_filename)
+        self.entries = {}  # relative nifti path -> {'sidecar', 'mtime', 'size', sidecar_fields...}
+        self.load()
+
+    def load(self):
+        """
+        Reads a previously written index from disk
+        :return:
+        """
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as infile:
+                index = json.load(infile)
+        except (OSError, ValueError):
+            print(f"Unable to read nifti index at {self.index_path}, rebuilding it.")
+            return
+        if index.get('version') == index_version:
+            self.entries = index.get('entries', {})
+
+    def save(self):
+        """
+        Writes the index to disk, failing to write is not an error, the index is rebuilt next time.
+        :return:
+        """
+        temporary_path = self.index_path + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary_path, 'w') as outfile:
+                json.dump({'version': index_version, 'entries': self.entries}, outfile)
+            os.replace(temporary_path, self.index_path)
+        except OSError as err:
+            print(f"Unable to write nifti index to {self.index_path}: {err}")
+
+    def index_pair(self, nifti_path, sidecar_path, sidecar_stat=None):
+        """
+        Records (or refreshes) a single nifti and sidecar pair
+        :param nifti_path: path to the nifti
+        :param sidecar_path: path to its json sidecar
+        :param sidecar_stat: os.stat result for the sidecar if already known
+        :return: True if the entry changed
+        """
+        relative_path = os.path.relpath(nifti_path, self.root)
+        stat = sidecar_stat if sidecar_stat else os.stat(sidecar_path)
+        entry = self.entries.get(relative_path)
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return False
+
+        try:
+            with open(sidecar_path, 'r') as infile:
+                sidecar = json.load(infile)
+        except (OSError, ValueError):
+            sidecar = {}
+
+        entry = {'sidecar': os.path.relpath(sidecar_path, self.root), 'mtime': stat.st_mtime_ns,
+                 'size': stat.st_size}
+        for field in sidecar_fields:
+            entry[field] = sidecar.get(field)
+        self.entries[relative_path] = entry
+        return True
+
+    def update(self):
+        """
+        Walks the output tree once and pairs every nifti with its sidecar, entries for niftis that no
+        longer exist are dropped. The index is written back to disk if anything changed.
+        :return: self.entries
+        """
+        seen = set()
+        changed = False
+        for root, dirs, files in os.walk(self.root):
+            dirs.sort()
+            names = set(files)
+            for f in sorted(files):
+                stem, extension = split_nifti_path(f)
+                if extension is None or stem + '.json' not in names:
+                    continue
+                sidecar_path = os.path.join(root, stem + '.json')
+                try:
+                    changed |= self.index_pair(os.path.join(root, f), sidecar_path)
+                except OSError:
+                    continue
+                seen.add(os.path.relpath(os.path.join(root, f), self.root))
+
+        for relative_path in set(self.entries) - seen:
+            del self.entries[relative_path]
+            changed = True
+
+        if changed:
+            self.save()
+        return self.entries
+
+    def add(self, paths):
+        """
+        Adds newly written outputs without walking the whole tree
+        :param paths: nifti and/or json paths, e.g. the files dcm2niix just wrote
+        :return:
+        """
+        changed = False
+        for path in paths:
+            stem, extension = split_nifti_path(path)
+            if extension is None:
+                stem = os.path.splitext(path)[0]
+            for nifti_extension in nifti_extensions:
+                nifti_path = stem + nifti_extension
+                if os.path.isfile(nifti_path) and os.path.isfile(stem + '.json'):
+                    changed |= self.index_pair(nifti_path, stem + '.json')
+        if changed:
+            self.save()
+
+    def find(self, folder=None, **fields):
+        """
+        Looks up indexed niftis
+        :param folder: only return niftis in this folder (not its sub folders)
+        :param fields: sidecar field values to match, e.g. SeriesNumber=3, None values are ignored
+        :return: list of (nifti path, sidecar path, entry) ordered by sidecar modification time, newest first
+        """
+        matches = []
+        for relative_path, entry in self.entries.items():
+            nifti_path = os.path.join(self.root, relative_path)
+            if folder is not None and os.path.abspath(os.path.dirname(nifti_path)) != os.path.abspath(folder):
+                continue
+            if any(value is not None and entry.get(field) != value for field, value in fields.items()):
+                continue
+            matches.append((nifti_path, os.path.join(self.root, entry['sidecar']), entry))
+        return sorted(matches, key=lambda match: match[2]['mtime'], reverse=True)
@@ -0,0 +1,210 @@
+import collections
+import io
+import os
+import shutil
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# ways the converters can write their niftis: gzipped as they're written, uncompressed, or uncompressed and then
+# gzipped by a background stage so the next conversion doesn't have to wait for it
+compression_modes = ('gzip', 'none', 'background')
+
+# uncompressed bytes in each block handed to a compression thread
+default_block_size = 1 << 20
+
+# deflate looks back at most this far, each block is primed with this much of the one before it
+dictionary_size = 32768
+
+# gzip header: magic, deflate, no flags, no mtime, no extra flags, unknown os
+gzip_header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def pigz_available():
+    """
+    :return: True if pigz is on the path, dcm2niix -z y uses it to compress on every core
+    """
+    return shutil.which('pigz') is not None
+
+
+def deflate_block(block, dictionary, compresslevel, last):
+    """
+    Compresses one block as raw deflate data that can be appended to the blocks before it, zlib releases the
+    GIL while it works so blocks are compressed on several threads at once
+    :param block: uncompressed bytes
+    :param dictionary: the last dictionary_size bytes of the previous block, or None for the first block
+    :param compresslevel: zlib compression level
+    :param last: True for the final block of the stream
+    :return: compressed bytes
+    """
+    if dictionary:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter:
+    def __init__(self, path, compresslevel=6, threads=None, block_size=default_block_size):
+        """
+        A write only gzip file that compresses on several threads the way pigz does. Data is cut into blocks
+        that are deflated in parallel, each primed with the end of the block before it so the ratio is about
+        the same as gzip's, and the blocks are written in order as a single ordinary gzip member any gzip
+        reader (nibabel, FSL, gzip -d) can open. Use it in place of gzip.open(path, 'wb').
+        :param path: path of the .gz file to write
+        :param compresslevel: zlib compression level, 1 is fastest
+        :param threads: number of compression threads, defaults to the number of cpus
+        :param block_size: uncompressed bytes compressed by each thread at a time
+        """
+        self.path = path
+        self.compresslevel = compresslevel
+        self.threads = threads if threads else os.cpu_count() or 1
+        self.block_size = block_size
+        self.file = open(path, 'wb')
+        self.file.write(gzip_header)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = collections.deque()  # compressed blocks not yet written, in order
+        self.buffer = bytearray()
+        self.dictionary = None
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def tell(self):
+        """
+        :return: uncompressed bytes written so far
+        """
+        return self.size
+
+    def read(self, size=-1):
+        raise io.UnsupportedOperation("ParallelGzipWriter is write only")
+
+    def seek(self, offset, whence=0):
+        """
+        Only moves forward from the current position, filling the gap with zeros, like a gzip file opened for
+        writing. nibabel seeks to the image data offset this way.
+        """
+        if whence == 1:
+            offset += self.size
+        if whence == 2 or offset < self.size:
+            raise OSError("Can't seek backwards in a file being compressed")
+        self.write(b'\0' * (offset - self.size))
+        return self.size
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        self.size += len(view)
+        offset = 0
+        if self.buffer:
+            offset = min(len(view), self.block_size - len(self.buffer))
+            self.buffer += view[:offset]
+            if len(self.buffer) < self.block_size:
+                return len(view)
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(view) - offset >= self.block_size:
+            self.submit(bytes(view[offset:offset + self.block_size]))
+            offset += self.block_size
+        self.buffer += view[offset:]
+        return len(view)
+
+    def submit(self, block, last=False):
+        self.crc = zlib.crc32(block, self.crc)
+        self.pending.append(self.executor.submit(deflate_block, block, self.dictionary, self.compresslevel, last))
+        self.dictionary = block[-dictionary_size:]
+        # keep a few blocks per thread in flight, enough to keep them busy without holding the whole file
+        while len(self.pending) > self.threads * 2:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        self.submit(bytes(self.buffer), last=True)
+        self.buffer = bytearray()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.file.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        self.file.close()
+        self.executor.shutdown()
+        self.closed = True
+
+    def abort(self):
+        """
+        Stops without finishing the file, used when writing fails part way
+        """
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        self.file.close()
+        self.closed = True
+
+
+def compress_file(path, compresslevel=6, threads=None, remove=True):
+    """
+    Gzips a file with ParallelGzipWriter, the .gz only appears once it's complete
+    :param path: file to compress
+    :param compresslevel: zlib compression level
+    :param threads: number of compression threads, defaults to the number of cpus
+    :param remove: delete the uncompressed file afterwards
+    :return: path of the .gz file
+    """
+    compressed_path = path + '.gz'
+    temporary_path = compressed_path + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(path, 'rb') as infile, ParallelGzipWriter(temporary_path, compresslevel, threads) as outfile:
+            shutil.copyfileobj(infile, outfile, default_block_size)
+        shutil.copystat(path, temporary_path)
+        os.replace(temporary_path, compressed_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    if remove:
+        os.remove(path)
+    return compressed_path
+
+
+class BackgroundCompressor:
+    def __init__(self, threads=None, compresslevel=6):
+        """
+        A compression stage that runs beside the conversions, converters write uncompressed niftis and hand
+        them over here so they can get on with the next session while these are gzipped
+        :param threads: number of threads each file is compressed with, defaults to the number of cpus
+        :param compresslevel: zlib compression level
+        """
+        self.threads = threads
+        self.compresslevel = compresslevel
+        # files are compressed one at a time, each one uses every thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compress')
+        self.submitted = []  # (paths, future) of everything handed over
+
+    def submit(self, paths):
+        """
+        :param paths: files to gzip (the originals are removed)
+        :return: concurrent.futures.Future of the list of .gz paths written
+        """
+        paths = list(paths)
+        future = self.executor.submit(self.compress, paths)
+        self.submitted.append((paths, future))
+        return future
+
+    def compress(self, paths):
+        return [compress_file(path, self.compresslevel, self.threads) for path in paths]
+
+    def close(self):
+        """
+        Waits for everything submitted to be compressed
+        :return: list of error messages for the files that couldn't be compressed
+        """
+        self.executor.shutdown(wait=True)
+        return [f"Unable to compress {', '.join(paths)}: {type(future.exception()).__name__}: {future.exception()}"
+                for paths, future in self.submitted if future.exception() is not None]
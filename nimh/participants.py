@@ -0,0 +1,168 @@
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+participants_filename = 'participants.tsv'
+
+# column participants are merged on
+key_column = 'sub_id'
+
+# written for values a participant doesn't have
+missing_value = 'n/a'
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on path (created if needed) for the duration of the with block, other
+    processes (and threads) using file_lock on the same path wait for it
+    """
+    with open(path, 'a+') as handle:
+        if os.name == 'nt':
+            handle.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds, keep waiting
+                    time.sleep(0.1)
+        else:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def to_records(rows):
+    """
+    :param rows: a dictionary of column -> list of values (as built by Convert.bespoke), a single row
+    dictionary, or a list of row dictionaries
+    :return: list of row dictionaries
+    """
+    if isinstance(rows, dict):
+        if all(isinstance(value, (list, tuple)) for value in rows.values()):
+            length = max((len(value) for value in rows.values()), default=0)
+            return [{column: values[index] if index < len(values) else None for column, values in rows.items()}
+                    for index in range(length)]
+        return [rows]
+    return list(rows)
+
+
+class ParticipantsTable:
+    def __init__(self, dataset_root, flush_every=1):
+        """
+        The participants.tsv at the root of a dataset, shared safely between any number of conversions
+        running at once. Rows are appended to a small pending journal next to the table and merged into
+        it by sub_id (new values replace old ones, other columns are kept) every flush_every rows, so a
+        large batch doesn't rewrite the whole table for every session. Both files are only touched while
+        holding a lock file and the table is replaced atomically, readers never see a partial table. The
+        journal and lock file are hidden so they don't show up as files in the BIDS dataset, and the
+        journal is removed once it's merged.
+        :param dataset_root: folder the participants.tsv lives in
+        :param flush_every: merge the pending rows into the table once there are this many, 1 merges right away
+        """
+        self.dataset_root = dataset_root
+        self.flush_every = max(1, flush_every)
+        self.path = os.path.join(dataset_root, participants_filename)
+        self.pending_path = os.path.join(dataset_root, f'.{participants_filename}.pending')
+        self.lock_path = os.path.join(dataset_root, f'.{participants_filename}.lock')
+        # where the journal was kept before it was hidden, rows left in it are still merged
+        self.legacy_pending_path = self.path + '.pending'
+
+    def add(self, rows):
+        """
+        Adds (or updates) participants
+        :param rows: see to_records
+        :return:
+        """
+        records = [record for record in to_records(rows) if record.get(key_column) is not None]
+        if not records:
+            return
+        os.makedirs(self.dataset_root, exist_ok=True)
+        with file_lock(self.lock_path):
+            with open(self.pending_path, 'a') as journal:
+                for record in records:
+                    journal.write(json.dumps(record, default=str) + '\n')
+            if self.count_pending() >= self.flush_every:
+                self._merge()
+
+    def count_pending(self):
+        if not os.path.isfile(self.pending_path):
+            return 0
+        with open(self.pending_path, 'r') as journal:
+            return sum(1 for line in journal if line.strip())
+
+    def flush(self):
+        """
+        Merges any pending rows into the table
+        :return:
+        """
+        if not os.path.isfile(self.pending_path) and not os.path.isfile(self.legacy_pending_path):
+            return
+        with file_lock(self.lock_path):
+            self._merge()
+
+    def read(self):
+        """
+        :return: (columns, dictionary of sub_id -> row dictionary) of the table as it is on disk
+        """
+        if not os.path.isfile(self.path):
+            return [key_column], {}
+        with open(self.path, 'r', newline='') as infile:
+            reader = csv.DictReader(infile, delimiter='\t')
+            columns = list(reader.fieldnames or [key_column])
+            return columns, {row[key_column]: row for row in reader if row.get(key_column)}
+
+    def _merge(self):
+        # only called with the lock held
+        pending = []
+        journals = [path for path in (self.legacy_pending_path, self.pending_path) if os.path.isfile(path)]
+        for path in journals:
+            with open(path, 'r') as journal:
+                for line in journal:
+                    try:
+                        pending.append(json.loads(line))
+                    except ValueError:
+                        # a write cut short by a crash, the rest of the journal is still good
+                        continue
+        if not pending:
+            for path in journals:
+                os.remove(path)
+            return
+
+        columns, participants = self.read()
+        for record in pending:
+            sub_id = str(record[key_column])
+            row = participants.setdefault(sub_id, {key_column: sub_id})
+            for column, value in record.items():
+                if column not in columns:
+                    columns.append(column)
+                if value is not None:
+                    row[column] = str(value)
+
+        temporary_path = os.path.join(self.dataset_root,
+                                      f'.{participants_filename}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(temporary_path, 'w', newline='') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=columns, delimiter='\t', restval=missing_value,
+                                    extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+            for sub_id in sorted(participants):
+                writer.writerow({column: value if value not in (None, '') else missing_value
+                                 for column, value in participants[sub_id].items()})
+        os.replace(temporary_path, self.path)
+        for path in journals:
+            os.remove(path)
@@ -0,0 +1,127 @@
+import os
+import queue
+import threading
+import time
+import traceback
+
+from lazy_imports import load_lazy_modules
+
+# the stages a conversion is split into, in order: (stage name, Convert method, default number of workers).
+# Header scans are io bound, dcm2niix is cpu bound (and runs outside of python), metadata parsing and writes
+# hold the GIL so more than a couple of workers only adds contention.
+stages = [
+    ('headers', 'scan_headers', 4),
+    ('dcm2niix', 'convert_images', os.cpu_count() or 1),
+    ('metadata', 'build_metadata', 1),
+    ('write', 'write_outputs', 2),
+]
+
+# marks the end of the jobs flowing into a stage
+finished = object()
+
+
+class ConversionPipeline:
+    def __init__(self, make_converter, workers=None, queue_size=2, on_result=None):
+        """
+        Runs conversions as a pipeline of stages (see stages) connected by bounded queues, each stage has
+        its own pool of worker threads. While one session's metadata is being parsed and written the next
+        sessions' headers are being read and dcm2niix is running on them, so disks and cpus stay busy
+        instead of taking turns.
+        :param make_converter: callable taking a job and returning a Convert created with convert=False
+        :param workers: dictionary of stage name -> number of workers, overrides the defaults in stages
+        :param queue_size: number of sessions allowed to wait between two stages, keeps memory bounded
+        :param on_result: called with each job summary as soon as the job finishes or fails
+        """
+        self.make_converter = make_converter
+        self.workers = {name: count for name, _, count in stages}
+        self.workers.update({name: max(1, count) for name, count in (workers or {}).items() if count})
+        self.queue_size = queue_size
+        self.on_result = on_result
+        self.results = []
+        self.lock = threading.Lock()
+
+    def finish(self, item, error=None):
+        """
+        Records the outcome of a job, whether it made it through every stage or failed part way
+        """
+        summary = item['summary']
+        if item['converter'] is not None and item['converter'].uncompressed_outputs:
+            # niftis left for a background compressor, see batch_convert.run_pipeline
+            summary['uncompressed'] = item['converter'].uncompressed_outputs
+        if error:
+            summary['status'] = 'failed'
+            summary['error'] = f"{type(error).__name__}: {error}"
+            summary['traceback'] = traceback.format_exc()
+        else:
+            summary['status'] = 'success'
+            summary['error'] = None
+        summary['seconds'] = round(time.time() - item['start'], 3)
+        with self.lock:
+            self.results[item['index']] = summary
+        if self.on_result:
+            self.on_result(summary)
+
+    def work(self, stage_index, inbox, outbox, remaining):
+        """
+        Worker loop for a single stage, takes sessions from inbox, runs the stage and hands them on to
+        outbox. The last worker of a stage to finish tells the next stage that no more sessions are coming.
+        """
+        name, method, _ = stages[stage_index]
+        while True:
+            item = inbox.get()
+            if item is finished:
+                break
+            try:
+                if item['converter'] is None:
+                    item['start'] = time.time()
+                    item['converter'] = self.make_converter(item['summary'])
+                item['summary'].setdefault('stage_seconds', {})
+                start = time.time()
+                getattr(item['converter'], method)()
+                item['summary']['stage_seconds'][name] = round(time.time() - start, 3)
+            except Exception as err:
+                self.finish(item, err)
+                continue
+            if outbox is None:
+                self.finish(item)
+                # drop the converter as soon as the session is written so memory doesn't grow with the batch
+                item['converter'] = None
+            else:
+                outbox.put(item)
+
+        with self.lock:
+            remaining[stage_index] -= 1
+            last = remaining[stage_index] == 0
+        if last and outbox is not None:
+            for _ in range(self.workers[stages[stage_index + 1][0]]):
+                outbox.put(finished)
+
+    def run(self, jobs):
+        """
+        Pushes every job through the pipeline
+        :param jobs: list of job dictionaries (see batch_convert.read_manifest)
+        :return: list of job summaries in the same order as jobs
+        """
+        self.results = [None] * len(jobs)
+        load_lazy_modules()
+        # the first queue is unbounded since it's only filled with job descriptions
+        queues = [queue.Queue()] + [queue.Queue(maxsize=self.queue_size) for _ in stages[1:]]
+        remaining = [self.workers[name] for name, _, _ in stages]
+
+        threads = []
+        for stage_index, (name, _, _) in enumerate(stages):
+            outbox = queues[stage_index + 1] if stage_index + 1 < len(stages) else None
+            for worker in range(self.workers[name]):
+                thread = threading.Thread(target=self.work, args=(stage_index, queues[stage_index], outbox, remaining),
+                                          name=f'{name}-{worker}', daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for index, job in enumerate(jobs):
+            queues[0].put({'index': index, 'summary': dict(job), 'converter': None, 'start': None})
+        for _ in range(self.workers[stages[0][0]]):
+            queues[0].put(finished)
+
+        for thread in threads:
+            thread.join()
+        return self.results
@@ -0,0 +1,226 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from instrumentation import MemorySampler
+from lazy_imports import lazy_import
+
+nibabel = lazy_import('nibabel')
+numpy = lazy_import('numpy')
+psutil = lazy_import('psutil')
+
+# share of the memory available when a run starts that it's allowed to use when no budget is given
+default_budget_fraction = 0.8
+
+# memory kept free for everything else on the node no matter what the budget says
+default_headroom = 512 * 1024 ** 2
+
+# what a worker process needs before it's given a job: the interpreter, numpy, pandas, pydicom and nibabel
+worker_overhead = 250 * 1024 ** 2
+
+# peak memory of a dicom job as a multiple of the size of its dicoms. dcm2niix holds the series and the
+# image it builds from it, the native engine also holds the float32 volume and the blocks being compressed
+dicom_footprint_factors = {'dcm2niix': 2.0, 'native': 3.0}
+
+# seconds between looks at the node's free memory while jobs are waiting for it
+poll_interval = 1.0
+
+
+def folder_bytes(folder):
+    """
+    :return: total size of the files in a folder and its sub folders
+    """
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            try:
+                total += os.stat(os.path.join(root, f)).st_size
+            except OSError:
+                continue
+    return total
+
+
+def ecat_footprint(ecat_path, dtype='float64', stream=False):
+    """
+    Estimates the peak memory of converting an ecat from its main header and subheaders, no pixel data is read.
+    ConvertToNifti.to_nifti holds the whole scaled image in dtype and nibabel needs about as much again to write
+    it, streaming only ever holds a frame or two.
+    :param ecat_path: path to the ecat
+    :param dtype: data type the image is converted to
+    :param stream: whether the ecat is converted one frame at a time
+    :return: bytes
+    """
+    shape = nibabel.ecat.load(ecat_path).shape
+    frame_voxels = int(numpy.prod(shape[:3]))
+    frames = shape[3] if len(shape) > 3 else 1
+    itemsize = numpy.dtype(dtype).itemsize
+    raw_frame = frame_voxels * 2
+    if stream:
+        return raw_frame + 3 * frame_voxels * itemsize
+    return raw_frame + 2 * frame_voxels * frames * itemsize
+
+
+def estimate_footprint(job, options):
+    """
+    :param job: dataset_run job dictionary
+    :param options: the options the job runs with (dtype, stream, engine)
+    :return: (kind of job, estimated peak memory of the job in bytes, not counting the worker itself)
+    """
+    if job.get('kind') == 'ecat':
+        stream = options.get('stream', False)
+        return ('ecat_stream' if stream else 'ecat',
+                ecat_footprint(job['folder'], options.get('dtype', 'float64'), stream))
+    engine = options.get('engine', 'dcm2niix')
+    return f'dicom_{engine}', int(folder_bytes(job['folder']) * dicom_footprint_factors.get(engine, 2.0))
+
+
+def run_measured(function, job, *args):
+    """
+    Runs function(job, *args) in a worker and records the most memory the worker (and anything it started, like
+    dcm2niix) used above what it was using beforehand under 'memory_bytes' in the job's summary
+    """
+    process = psutil.Process()
+    start_rss = process.memory_info().rss
+    sampler = MemorySampler(process, interval=0.1, include_children=True)
+    sampler.start()
+    try:
+        summary = function(job, *args)
+    finally:
+        peak_rss = sampler.stop()
+    summary['memory_bytes'] = max(peak_rss - start_rss, 0)
+    return summary
+
+
+class MemoryScheduler:
+    def __init__(self, budget=None, max_workers=None, headroom=default_headroom, options=None):
+        """
+        Runs jobs over a process pool, starting each one only once there's memory for it rather than keeping a
+        fixed number running. Each job's peak memory is estimated up front (see estimate_footprint), the biggest
+        jobs are started first and smaller ones fill in the memory they leave. A job is admitted while the
+        estimates of the running jobs plus its own stay within the budget and the node actually has that much
+        free (psutil), so other work on the node is taken into account too. The memory each job really used is
+        measured, and the estimates for the jobs of that kind still waiting are scaled to match, so concurrency
+        grows when the estimates were pessimistic and shrinks when they weren't. If nothing is running the next
+        job is always started, even when it's bigger than the budget.
+        :param budget: bytes the jobs are allowed to use, defaults to default_budget_fraction of the memory
+        available now
+        :param max_workers: most jobs to run at once, defaults to the number of cpus
+        :param headroom: bytes that are always left free on the node
+        :param options: the options the jobs run with, used to estimate them (see estimate_footprint)
+        """
+        self.budget = budget if budget else int(psutil.virtual_memory().available * default_budget_fraction)
+        self.max_workers = max_workers if max_workers else os.cpu_count() or 1
+        self.headroom = headroom
+        self.options = options or {}
+        self.corrections = {}  # kind of job -> measured / estimated memory of the jobs of that kind so far
+        self.peak_committed = 0
+        self.peak_running = 0
+
+    def estimate(self, kind, footprint):
+        return int(footprint * self.corrections.get(kind, 1.0)) + worker_overhead
+
+    def calibrate(self, kind, footprint, measured):
+        """
+        Moves the correction for a kind of job towards what the last one of them really used
+        """
+        if not footprint or measured is None:
+            return
+        ratio = min(max((measured + worker_overhead / 4) / footprint, 0.25), 4.0)
+        previous = self.corrections.get(kind)
+        self.corrections[kind] = ratio if previous is None else (previous + ratio) / 2
+
+    def fits(self, estimate, committed, running):
+        if not running:
+            return True
+        if len(running) >= self.max_workers or committed + estimate > self.budget:
+            return False
+        return psutil.virtual_memory().available - self.headroom >= estimate
+
+    def run(self, jobs, function, *args):
+        """
+        Runs function(job, *args) for every job in worker processes
+        :param jobs: job dictionaries
+        :param function: picklable function taking a job, returns the job's summary dictionary
+        :param args: passed on to function after the job
+        :return: generator of (job, finished future) as jobs finish, the future's result is the job's summary
+        with the memory it used under 'memory_bytes'
+        """
+        waiting = []
+        for job in jobs:
+            try:
+                kind, footprint = estimate_footprint(job, self.options)
+            except Exception as err:
+                # the job itself will fail and report why, there's no point reserving memory for it
+                print(f"Unable to estimate the memory needed for {job.get('folder')}: {err}")
+                kind, footprint = 'unknown', 0
+            waiting.append((job, kind, footprint))
+        waiting.sort(key=lambda item: item[2], reverse=True)
+
+        running = {}  # future -> (job, kind, footprint, estimate)
+        executor = None
+        try:
+            while waiting or running:
+                if executor is None:
+                    executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                broken = False
+                committed = sum(item[3] for item in running.values())
+                for item in list(waiting):
+                    job, kind, footprint = item
+                    estimate = self.estimate(kind, footprint)
+                    if not self.fits(estimate, committed, running):
+                        continue
+                    if estimate > self.budget:
+                        print(f"{job.get('folder')} is estimated to need {estimate / 1024 ** 3:.1f}GB, more than the " +
+                              f"memory budget of {self.budget / 1024 ** 3:.1f}GB, running it on its own.")
+                    try:
+                        future = executor.submit(run_measured, function, job, *args)
+                    except BrokenProcessPool:
+                        broken = True
+                        break
+                    waiting.remove(item)
+                    running[future] = (job, kind, footprint, estimate)
+                    committed += estimate
+                self.peak_committed = max(self.peak_committed, committed)
+                self.peak_running = max(self.peak_running, len(running))
+
+                if not broken:
+                    done, _ = wait(list(running), timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    broken = any(isinstance(future.exception(), BrokenProcessPool) for future in done)
+                if broken:
+                    yield from self.pool_died(running)
+                    running = {}
+                    executor.shutdown()
+                    executor = None
+                    continue
+                for future in done:
+                    job, kind, footprint, _ = running.pop(future)
+                    if future.exception() is None:
+                        self.calibrate(kind, footprint, future.result().get('memory_bytes'))
+                    yield job, future
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def pool_died(self, running):
+        """
+        A worker was killed (most likely by the OS running out of memory), which takes every job running in the
+        pool down with it. There's no telling which job it was, so each one is failed with the memory that was
+        reserved for it, and the estimates for their kinds of job are doubled for the rest of the run.
+        :param running: future -> (job, kind, footprint, estimate) of the jobs that were running
+        :return: generator of (job, future holding the job's failed summary)
+        """
+        wait(list(running))
+        for kind in {item[1] for item in running.values()}:
+            self.corrections[kind] = min(self.corrections.get(kind, 1.0) * 2, 4.0)
+        print(f"A worker process died, failing the {len(running)} jobs that were running and starting a new pool.")
+        for future, (job, kind, footprint, estimate) in running.items():
+            if future.exception() is None:
+                # finished before the pool broke
+                yield job, future
+                continue
+            failed = Future()
+            failed.set_result(dict(job, status='failed', seconds=None, memory_bytes=estimate,
+                                   error=f"Worker process died while running alongside {len(running) - 1} other " +
+                                         f"jobs, most likely out of memory ({estimate / 1024 ** 3:.1f}GB was " +
+                                         f"reserved for it): {future.exception()}"))
+            yield job, failed
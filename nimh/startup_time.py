@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# command line entry points to time
+cli_scripts = ['convert.py', 'ecat_convert.py', 'batch_convert.py', 'validate.py']
+
+# modules that shouldn't be imported just to start up a headless cli
+heavy_modules = ['gooey', 'wx', 'pandas', 'numpy', 'nibabel', 'pydicom']
+
+# prints which heavy modules have actually been executed after importing a cli module
+import_check = """
+import json, sys
+sys.path.insert(0, {here!r})
+sys.argv = ['{script}', '--ignore-gooey']
+import {module}
+# modules made with lazy_import stay a _LazyModule until something is looked up on them
+loaded = [name for name in {heavy!r} if name in sys.modules and type(sys.modules[name]).__name__ != '_LazyModule']
+print(json.dumps(loaded))
+"""
+
+
+def time_script(script, repeats=5):
+    """
+    Times `python <script> --ignore-gooey --help` in a fresh interpreter
+    :param script: file name of a cli in this folder
+    :param repeats: number of runs
+    :return: list of wall times in seconds
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(here, script), '--ignore-gooey', '--help'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def loaded_heavy_modules(script):
+    """
+    :param script: file name of a cli in this folder
+    :return: heavy modules that are executed by importing the script
+    """
+    module = os.path.splitext(script)[0]
+    check = subprocess.run(
+        [sys.executable, '-c', import_check.format(here=here, script=script, module=module, heavy=heavy_modules)],
+        capture_output=True, check=True, text=True)
+    return json.loads(check.stdout.strip().splitlines()[-1])
+
+
+def time_interpreter(repeats=5):
+    """
+    :return: wall times of starting a bare interpreter, to put the cli times in context
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def measure(scripts=None, repeats=5):
+    """
+    Measures the start up time of each cli
+    :param scripts: clis to measure, defaults to cli_scripts
+    :param repeats: number of runs per cli
+    :return: list of result dictionaries
+    """
+    baseline = min(time_interpreter(repeats))
+    results = []
+    for script in scripts or cli_scripts:
+        times = time_script(script, repeats)
+        results.append({
+            'script': script,
+            'median_seconds': round(statistics.median(times), 4),
+            'min_seconds': round(min(times), 4),
+            'interpreter_seconds': round(baseline, 4),
+            'heavy_modules_loaded': loaded_heavy_modules(script),
+        })
+    return results
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Measures how long the headless command line tools take to start (--help) and reports " +
+                    "any heavy modules that get imported during start up.")
+    parser.add_argument('scripts', nargs='*', default=None, help=f"clis to measure, defaults to {cli_scripts}")
+    parser.add_argument('-r', '--repeats', type=int, default=5, help="Number of runs per cli.")
+    parser.add_argument('-o', '--output', type=str, default=None, help="Write results as json to this path.")
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help="Exit with an error if any cli's median start up time is over this many seconds.")
+    args = parser.parse_args()
+
+    results = measure(args.scripts, args.repeats)
+    for result in results:
+        print(f"{result['script']}: {result['median_seconds']}s median, {result['min_seconds']}s min " +
+              f"(bare interpreter {result['interpreter_seconds']}s), heavy modules loaded: " +
+              f"{', '.join(result['heavy_modules_loaded']) or 'none'}")
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=4)
+
+    if args.max_seconds is not None:
+        too_slow = [result['script'] for result in results if result['median_seconds'] > args.max_seconds]
+        if too_slow:
+            print(f"Start up slower than {args.max_seconds}s: {', '.join(too_slow)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
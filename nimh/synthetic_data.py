@@ -0,0 +1,236 @@
+import datetime
+import json
+import os
+
+from lazy_imports import lazy_import
+
+nibabel = lazy_import('nibabel')
+numpy = lazy_import('numpy')
+pandas = lazy_import('pandas')
+pydicom = lazy_import('pydicom')
+
+# sop class uid of a PET image storage dicom
+pet_sop_class_uid = '1.2.840.10008.5.1.4.1.1.128'
+
+# ecat files are made up of 512 byte blocks
+ecat_block_size = 512
+
+
+def write_pet_dicom_series(folder, slices=47, frames=10, rows=128, columns=128, frame_duration=60, seed=0):
+    """
+    Writes a synthetic dynamic PET dicom series, one file per slice per frame. The files carry the
+    header entries Convert.bespoke reads (PatientWeight, ReconstructionMethod, EnergyWindowRangeSequence,
+    ConvolutionKernel, AttenuationCorrectionMethod, ...) along with the usual geometry and timing tags.
+    :param folder: folder to write the series to, created if it doesn't exist
+    :param slices: number of slices per frame
+    :param frames: number of frames
+    :param rows: rows per slice
+    :param columns: columns per slice
+    :param frame_duration: duration of each frame in seconds
+    :param seed: seed for the random pixel data
+    :return: list of written file paths
+    """
+    os.makedirs(folder, exist_ok=True)
+    random = numpy.random.default_rng(seed)
+    study_uid = pydicom.uid.generate_uid()
+    series_uid = pydicom.uid.generate_uid()
+    frame_of_reference_uid = pydicom.uid.generate_uid()
+    acquisition_start = datetime.datetime(2021, 6, 1, 10, 16, 15)
+
+    energy_window = pydicom.Dataset()
+    energy_window.EnergyWindowLowerLimit = '425.0'
+    energy_window.EnergyWindowUpperLimit = '650.0'
+
+    radiopharmaceutical = pydicom.Dataset()
+    radiopharmaceutical.Radiopharmaceutical = 'Fluorodeoxyglucose'
+    radiopharmaceutical.RadionuclideTotalDose = '370000000.0'
+    radiopharmaceutical.RadionuclideHalfLife = '6586.2'
+    radiopharmaceutical.RadiopharmaceuticalStartTime = '101514.000000'
+
+    paths = []
+    for frame in range(frames):
+        frame_start = acquisition_start + datetime.timedelta(seconds=frame * frame_duration)
+        for plane in range(slices):
+            image_index = frame * slices + plane + 1
+            file_meta = pydicom.dataset.FileMetaDataset()
+            file_meta.MediaStorageSOPClassUID = pet_sop_class_uid
+            file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+            file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+
+            path = os.path.join(folder, f'{image_index:06d}.dcm')
+            dataset = pydicom.dataset.FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+            dataset.is_little_endian = True
+            dataset.is_implicit_VR = False
+
+            dataset.SOPClassUID = pet_sop_class_uid
+            dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+            dataset.StudyInstanceUID = study_uid
+            dataset.SeriesInstanceUID = series_uid
+            dataset.FrameOfReferenceUID = frame_of_reference_uid
+            dataset.Modality = 'PT'
+            dataset.Manufacturer = 'SIEMENS'
+            dataset.ManufacturerModelName = 'Biograph128_Vision 600 Edge'
+            dataset.PatientName = 'Synthetic^Subject'
+            dataset.PatientID = 'SYNTHETIC01'
+            dataset.PatientWeight = '70.5'
+            dataset.PatientSex = 'F'
+            dataset.StudyDate = acquisition_start.strftime('%Y%m%d')
+            dataset.SeriesDate = dataset.StudyDate
+            dataset.SeriesTime = acquisition_start.strftime('%H%M%S')
+            dataset.AcquisitionDate = dataset.StudyDate
+            dataset.AcquisitionTime = frame_start.strftime('%H%M%S.%f')
+            dataset.SeriesNumber = 3
+            dataset.SeriesDescription = 'Synthetic dynamic PET'
+            dataset.InstanceNumber = image_index
+            dataset.ImageIndex = image_index
+            dataset.NumberOfSlices = slices
+            dataset.NumberOfTimeSlices = frames
+            dataset.FrameReferenceTime = str(frame * frame_duration * 1000)
+            dataset.ActualFrameDuration = frame_duration * 1000
+            dataset.DecayFactor = str(round(2 ** (frame * frame_duration / 6586.2), 5))
+            dataset.Units = 'BQML'
+            dataset.DecayCorrection = 'START'
+            dataset.ReconstructionMethod = 'OSEM3D 3i21s'
+            dataset.ConvolutionKernel = 'XYZGAUSSIAN3.00'
+            dataset.AttenuationCorrectionMethod = 'measured,AC_CT'
+            dataset.EnergyWindowRangeSequence = [energy_window]
+            dataset.RadiopharmaceuticalInformationSequence = [radiopharmaceutical]
+
+            dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+            dataset.ImagePositionPatient = [-columns, -rows, plane * 2.0]
+            dataset.PixelSpacing = [2.0, 2.0]
+            dataset.SliceThickness = 2.0
+            dataset.SliceLocation = plane * 2.0
+            dataset.Rows = rows
+            dataset.Columns = columns
+            dataset.SamplesPerPixel = 1
+            dataset.PhotometricInterpretation = 'MONOCHROME2'
+            dataset.BitsAllocated = 16
+            dataset.BitsStored = 16
+            dataset.HighBit = 15
+            dataset.PixelRepresentation = 1
+            dataset.RescaleIntercept = 0
+            dataset.RescaleSlope = str(round(0.5 + frame * 0.01, 4))
+            dataset.PixelData = random.integers(0, 32767, (rows, columns), dtype=numpy.int16).tobytes()
+
+            pydicom.dcmwrite(path, dataset, write_like_original=False)
+            paths.append(path)
+
+    return paths
+
+
+def write_ecat(path, shape=(128, 128, 47), frames=10, frame_duration=60, seed=0):
+    """
+    Writes a synthetic ECAT 7.3 volume file (16 bit big endian frames) that nibabel can read.
+    :param path: path of the ecat to write
+    :param shape: x, y, z dimensions of each frame
+    :param frames: number of frames
+    :param frame_duration: duration of each frame in seconds
+    :param seed: seed for the random pixel data
+    :return: path
+    """
+    random = numpy.random.default_rng(seed)
+    x, y, z = shape
+    data_blocks = -(-x * y * z * 2 // ecat_block_size)
+
+    main_header = numpy.zeros((), dtype=nibabel.ecat.hdr_dtype.newbyteorder('>'))
+    main_header['magic_number'] = b'MATRIX72v'
+    main_header['sw_version'] = 73
+    main_header['file_type'] = 7  # volume 16 bit
+    main_header['num_frames'] = frames
+    main_header['num_planes'] = z
+    main_header['patient_orientation'] = 3
+    main_header['ecat_calibration_factor'] = 1.0
+    main_header['patient_id'] = b'SYNTHETIC01'
+    main_header['radiopharmaceutical'] = b'FDG'
+    main_header['isotope_halflife'] = 6586.2
+
+    # the matrix list (directory) takes up one block per 31 frames, frames follow it
+    directory_blocks = -(-frames // 31)
+    directory = numpy.zeros((directory_blocks, 32, 4), dtype='>i4')
+    block = 2 + directory_blocks
+    frame_blocks = []
+    for frame in range(frames):
+        directory_index, row = divmod(frame, 31)
+        used = min(31, frames - 31 * directory_index)
+        next_directory = 2 + directory_index + 1 if directory_index + 1 < directory_blocks else 2
+        directory[directory_index, 0] = [31 - used, next_directory, 2 + directory_index - 1, used]
+        # matrix id for frame (1 based), plane 1, gate 1, data 0, bed 0
+        matrix_id = (frame + 1) | (1 << 16) | (1 << 24)
+        directory[directory_index, row + 1] = [matrix_id, block, block + data_blocks, 1]
+        frame_blocks.append(block)
+        block += 1 + data_blocks
+
+    with open(path, 'wb') as outfile:
+        outfile.write(main_header.tobytes().ljust(ecat_block_size, b'\0'))
+        outfile.write(directory.tobytes())
+        for frame, frame_block in enumerate(frame_blocks):
+            subheader = numpy.zeros((), dtype=nibabel.ecat.subhdr_dtype.newbyteorder('>'))
+            subheader['data_type'] = 6  # sun short
+            subheader['num_dimensions'] = 3
+            subheader['x_dimension'] = x
+            subheader['y_dimension'] = y
+            subheader['z_dimension'] = z
+            subheader['x_pixel_size'] = 0.2
+            subheader['y_pixel_size'] = 0.2
+            subheader['z_pixel_size'] = 0.2
+            subheader['scale_factor'] = 0.5 + frame * 0.01
+            subheader['frame_start_time'] = frame * frame_duration * 1000
+            subheader['frame_duration'] = frame_duration * 1000
+            frame_data = random.integers(0, 32767, (x, y, z), dtype=numpy.int16).astype('>i2')
+
+            outfile.seek((frame_block - 1) * ecat_block_size)
+            outfile.write(subheader.tobytes().ljust(ecat_block_size, b'\0'))
+            outfile.write(frame_data.tobytes(order='F').ljust(data_blocks * ecat_block_size, b'\0'))
+
+    return path
+
+
+def write_metadata_workbook(path, rows=40, columns=36, seed=0):
+    """
+    Writes a numeric spreadsheet large enough to cover every cell Convert.bespoke reads
+    (injected mass, molar activity, and the blood sample block).
+    :param path: path of the workbook (.xlsx) to write, requires openpyxl
+    :param rows: number of data rows
+    :param columns: number of columns
+    :param seed: seed for the random values
+    :return: path
+    """
+    random = numpy.random.default_rng(seed)
+    workbook = pandas.DataFrame(random.uniform(0.1, 100, (rows, columns)),
+                                columns=[f'column_{column}' for column in range(columns)])
+    workbook.to_excel(path, index=False)
+    return path
+
+
+def write_dcm2niix_outputs(destination_path, name, shape, frame_duration=60):
+    """
+    Stands in for dcm2niix when it isn't installed, writes a gzipped nifti of the given shape and a
+    sidecar json with the entries dcm2niix would have pulled from a PET series.
+    :param destination_path: folder to write to
+    :param name: file name (without extension) of the outputs
+    :param shape: x, y, z, t shape of the image
+    :param frame_duration: duration of each frame in seconds
+    :return: (nifti path, json path)
+    """
+    os.makedirs(destination_path, exist_ok=True)
+    nifti_path = os.path.join(destination_path, name + '.nii.gz')
+    json_path = os.path.join(destination_path, name + '.json')
+    frames = shape[3]
+    nibabel.save(nibabel.Nifti1Image(numpy.zeros(shape, dtype=numpy.float32), numpy.eye(4)), nifti_path)
+    sidecar = {
+        'Modality': 'PT',
+        'Manufacturer': 'Siemens',
+        'ManufacturersModelName': 'Biograph128_Vision 600 Edge',
+        'SeriesDescription': 'Synthetic dynamic PET',
+        'ProtocolName': 'Synthetic dynamic PET',
+        'SeriesNumber': 3,
+        'Radiopharmaceutical': 'Fluorodeoxyglucose',
+        'RadionuclideTotalDose': 370000000,
+        'FrameTimesStart': [frame * frame_duration for frame in range(frames)],
+        'FrameDuration': [frame_duration] * frames,
+        'DecayFactor': [round(2 ** (frame * frame_duration / 6586.2), 5) for frame in range(frames)],
+    }
+    with open(json_path, 'w') as outfile:
+        json.dump(sidecar, outfile, indent=4)
+    return nifti_path, json_path
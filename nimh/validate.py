@@ -0,0 +1,386 @@
+import collections
+import csv
+import json
+import os
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from lazy_imports import Gooey, GooeyParser, lazy_import, load_lazy_modules
+from nifti_index import split_nifti_path
+
+nibabel = lazy_import('nibabel')
+numpy = lazy_import('numpy')
+
+# determine whether to run as gui or not
+if len(sys.argv) >= 2:
+    if '--ignore-gooey' not in sys.argv:
+        sys.argv.append('--ignore-gooey')
+
+# columns of the report, one row per problem found
+report_columns = ['level', 'path', 'check', 'message']
+
+# entries BIDS requires in a *_pet.json
+required_pet_fields = ['Manufacturer', 'ManufacturersModelName', 'Units', 'TracerName', 'TracerRadionuclide',
+                       'InjectedRadioactivity', 'InjectedRadioactivityUnits', 'InjectedMass', 'InjectedMassUnits',
+                       'SpecificRadioactivity', 'SpecificRadioactivityUnits', 'ModeOfAdministration', 'TimeZero',
+                       'ScanStart', 'InjectionStart', 'FrameTimesStart', 'FrameDuration', 'AcquisitionMode',
+                       'ImageDecayCorrected', 'ImageDecayCorrectionTime', 'ReconMethodName',
+                       'ReconMethodParameterLabels', 'ReconFilterType', 'ReconFilterSize', 'AttenuationCorrection']
+
+# units a *_pet.json's Units may have
+image_units = ['Bq/mL', 'kBq/mL', 'MBq/mL', 'mL/g', 'g/mL', 'unitless']
+
+# dicom Units (as dcm2niix copies them into its sidecar) -> the same units written the BIDS way
+dicom_units = {'BQML': 'Bq/mL', 'GML': 'g/mL', 'MLG': 'mL/g', 'NONE': 'unitless'}
+
+# sidecar entries holding one value per frame
+per_frame_fields = ['FrameTimesStart', 'FrameDuration', 'DecayFactor', 'DecayCorrectionFactor']
+
+# seconds frames may overlap or sidecars may disagree by before it's reported, sidecars round to the millisecond
+timing_tolerance = 0.01
+
+# a frame longer than this (a day in seconds) was almost certainly written in milliseconds
+longest_frame = 86400
+
+# folders whose results are waiting to be written, per worker thread
+folders_in_flight = 4
+
+
+def finding(level, path, check, message):
+    return {'level': level, 'path': path, 'check': check, 'message': message}
+
+
+def read_json(path, findings):
+    """
+    :return: the json's contents, None (with an error in findings) if it can't be read
+    """
+    try:
+        with open(path, 'r') as infile:
+            return json.load(infile)
+    except (OSError, ValueError) as err:
+        findings.append(finding('error', path, 'json', f"Unable to read: {err}"))
+        return None
+
+
+def check_nifti(path, findings):
+    """
+    Reads a nifti's header, never its pixel data, and checks the file holds as much data as the header describes.
+    For .nii.gz files that's the uncompressed size in the gzip trailer, so a truncated file is found without
+    decompressing it.
+    :return: number of frames in the image, None if the header can't be read
+    """
+    try:
+        header = nibabel.load(path).header
+    except Exception as err:
+        findings.append(finding('error', path, 'nifti_header', f"Unable to read header: {err}"))
+        return None
+
+    shape = header.get_data_shape()
+    expected = int(header['vox_offset']) + int(numpy.prod(shape)) * header.get_data_dtype().itemsize
+    try:
+        if path.lower().endswith('.gz'):
+            with open(path, 'rb') as infile:
+                infile.seek(-4, os.SEEK_END)
+                size = struct.unpack('<I', infile.read(4))[0]
+            # the trailer only holds the size modulo 4GB
+            expected &= 0xffffffff
+        else:
+            size = os.path.getsize(path)
+    except OSError as err:
+        findings.append(finding('error', path, 'nifti_size', f"Unable to read: {err}"))
+    else:
+        if size < expected:
+            findings.append(finding('error', path, 'nifti_size',
+                                    f"Holds {size} bytes, the header describes {expected}, the file is incomplete"))
+
+    if len(shape) not in (3, 4):
+        findings.append(finding('error', path, 'nifti_shape', f"Expected a 3d or 4d image, found shape {shape}"))
+    spatial_unit, _ = header.get_xyzt_units()
+    if spatial_unit != 'mm':
+        findings.append(finding('warning', path, 'nifti_units', f"Voxel sizes are in {spatial_unit}, not mm"))
+    return shape[3] if len(shape) > 3 else 1
+
+
+def check_frame_timing(sidecar, frames, path, findings):
+    """
+    Checks a sidecar's per frame entries against the number of frames in its image and that the frames follow
+    one another in time
+    :param sidecar: sidecar dictionary
+    :param frames: number of frames in the image, None if unknown
+    :param path: path of the sidecar, for the report
+    :param findings: list the problems are added to
+    """
+    for field in per_frame_fields:
+        values = sidecar.get(field)
+        if values is None:
+            continue
+        if not isinstance(values, list):
+            values = [values]
+        if frames is not None and len(values) != frames:
+            findings.append(finding('error', path, 'frame_count',
+                                    f"{field} has {len(values)} entries, the image has {frames} frames"))
+
+    starts, durations = sidecar.get('FrameTimesStart'), sidecar.get('FrameDuration')
+    if isinstance(durations, list):
+        if any(not isinstance(duration, (int, float)) or duration <= 0 for duration in durations):
+            findings.append(finding('error', path, 'frame_timing', "FrameDuration has entries that aren't positive"))
+        elif max(durations, default=0) > longest_frame:
+            findings.append(finding('warning', path, 'frame_units',
+                                    f"FrameDuration has a {max(durations)} second frame, is it in milliseconds?"))
+    if not isinstance(starts, list) or not all(isinstance(start, (int, float)) for start in starts):
+        return
+    if any(later <= earlier for earlier, later in zip(starts, starts[1:])):
+        findings.append(finding('error', path, 'frame_timing', "FrameTimesStart isn't strictly increasing"))
+    elif isinstance(durations, list) and len(durations) == len(starts) and \
+            all(isinstance(duration, (int, float)) for duration in durations):
+        overlaps = [index for index in range(len(starts) - 1)
+                    if starts[index] + durations[index] > starts[index + 1] + timing_tolerance]
+        if overlaps:
+            findings.append(finding('error', path, 'frame_timing',
+                                    f"Frame {overlaps[0]} runs into the next one, FrameTimesStart and FrameDuration "
+                                    f"disagree for {len(overlaps)} frames"))
+
+
+def check_pet_json(sidecar, path, findings, image_sidecar=None):
+    """
+    Checks a BIDS *_pet.json has the required entries and units, and agrees with the sidecar written with its image
+    :param sidecar: the *_pet.json's contents
+    :param path: path of the *_pet.json, for the report
+    :param findings: list the problems are added to
+    :param image_sidecar: the sidecar dcm2niix (or the native engine) wrote beside the image, optional
+    """
+    missing = [field for field in required_pet_fields if sidecar.get(field) is None]
+    if missing:
+        findings.append(finding('error', path, 'required_fields', f"Missing {', '.join(missing)}"))
+
+    units = sidecar.get('Units')
+    if units is not None and units not in image_units:
+        findings.append(finding('error', path, 'units', f"Units is {units}, expected one of {', '.join(image_units)}"))
+    for field, value in sidecar.items():
+        if field.endswith('Units') and field != 'Units' and value is not None:
+            if not isinstance(value, (str, list)) or not value:
+                findings.append(finding('error', path, 'units', f"{field} is {value!r}"))
+            elif isinstance(value, str) and field[:-len('Units')] not in sidecar:
+                findings.append(finding('warning', path, 'units',
+                                        f"{field} is given without {field[:-len('Units')]}"))
+
+    parameters = [sidecar.get(field) for field in ('ReconMethodParameterLabels', 'ReconMethodParameterUnits',
+                                                  'ReconMethodParameterValues')]
+    lengths = {len(parameter) for parameter in parameters if isinstance(parameter, list)}
+    if len(lengths) > 1:
+        findings.append(finding('error', path, 'recon_parameters',
+                                "ReconMethodParameterLabels, Units and Values have different lengths"))
+
+    if not image_sidecar:
+        return
+    scanner_units = image_sidecar.get('Units')
+    scanner_units = dicom_units.get(scanner_units.upper()) if isinstance(scanner_units, str) else None
+    if units is not None and scanner_units is not None and units != scanner_units:
+        findings.append(finding('error', path, 'units', f"Units is {units}, the image was written in {scanner_units}"))
+    for field in ('FrameTimesStart', 'FrameDuration'):
+        ours, theirs = sidecar.get(field), image_sidecar.get(field)
+        if not isinstance(ours, list) or not isinstance(theirs, list):
+            continue
+        try:
+            agree = len(ours) == len(theirs) and \
+                all(abs(float(a) - float(b)) <= timing_tolerance for a, b in zip(ours, theirs))
+        except (TypeError, ValueError):
+            agree = False
+        if not agree:
+            findings.append(finding('error', path, 'frame_timing', f"{field} differs from the image's sidecar"))
+
+
+def blood_json_paths(tsv_path):
+    """
+    :return: paths the json describing a blood tsv may have, its BIDS name first. Convert.write_out_jsons writes
+    *_recording-manual-blood.json beside *_recording-manual_blood.tsv
+    """
+    stem = tsv_path[:-len('.tsv')]
+    paths = [stem + '.json']
+    if stem.endswith('_blood'):
+        paths.append(stem[:-len('_blood')] + '-blood.json')
+    return paths
+
+
+def check_blood_tsv(path, findings):
+    """
+    Checks every row of a blood tsv has a value for every column, that the values are numbers (or n/a) and the
+    samples are in time order, and that its json describes the same columns
+    """
+    try:
+        with open(path, 'r', newline='') as infile:
+            rows = list(csv.reader(infile, delimiter='\t'))
+    except OSError as err:
+        findings.append(finding('error', path, 'blood_tsv', f"Unable to read: {err}"))
+        return
+    if not rows or not any(rows[0]):
+        findings.append(finding('error', path, 'blood_tsv', "No header row"))
+        return
+
+    columns = rows[0]
+    duplicates = sorted({column for column in columns if columns.count(column) > 1})
+    if duplicates:
+        findings.append(finding('error', path, 'blood_columns', f"Repeated columns {', '.join(duplicates)}"))
+    if 'time' not in columns:
+        findings.append(finding('error', path, 'blood_columns', "No time column"))
+
+    values = collections.defaultdict(list)
+    for line, row in enumerate(rows[1:], start=2):
+        if len(row) != len(columns):
+            findings.append(finding('error', path, 'blood_columns',
+                                    f"Line {line} has {len(row)} values for {len(columns)} columns"))
+            continue
+        for column, value in zip(columns, row):
+            if value == 'n/a':
+                continue
+            try:
+                values[column].append(float(value))
+            except ValueError:
+                findings.append(finding('error', path, 'blood_values', f"Line {line} {column} is {value!r}"))
+    times = values.get('time', [])
+    if any(later < earlier for earlier, later in zip(times, times[1:])):
+        findings.append(finding('warning', path, 'blood_timing', "Samples aren't in time order"))
+
+    candidates = blood_json_paths(path)
+    sidecar_path = next((candidate for candidate in candidates if os.path.isfile(candidate)), None)
+    if sidecar_path is None:
+        findings.append(finding('warning', path, 'blood_json', f"No {os.path.basename(candidates[0])} beside it"))
+        return
+    sidecar = read_json(sidecar_path, findings)
+    described = {key for key, value in (sidecar or {}).items() if isinstance(value, dict)}
+    if described:
+        undescribed = [column for column in columns if column not in described]
+        absent = sorted(described - set(columns))
+        if undescribed:
+            findings.append(finding('warning', sidecar_path, 'blood_json',
+                                    f"Columns {', '.join(undescribed)} aren't described"))
+        if absent:
+            findings.append(finding('error', sidecar_path, 'blood_json',
+                                    f"Describes {', '.join(absent)}, which the tsv doesn't have"))
+
+
+def validate_folder(folder, files):
+    """
+    Checks the niftis, sidecars and blood tsvs in one folder of an output tree
+    :param folder: path of the folder
+    :param files: names of the files in it
+    :return: list of findings
+    """
+    findings = []
+    names = set(files)
+    niftis = {}  # stem -> (nifti path, number of frames)
+    for f in sorted(files):
+        stem, extension = split_nifti_path(f)
+        if extension is None:
+            continue
+        if stem in niftis:
+            # e.g. a .nii left behind by a compression that didn't finish, only one of them has the sidecar
+            findings.append(finding('error', os.path.join(folder, f), 'nifti_duplicate',
+                                    f"{os.path.basename(niftis[stem][0])} has the same name, only one of them " +
+                                    "can belong with its sidecar"))
+        niftis[stem] = (os.path.join(folder, f), check_nifti(os.path.join(folder, f), findings))
+
+    image_sidecars = {}  # stem -> contents of the json written beside the nifti
+    for stem, (nifti_path, frames) in niftis.items():
+        if stem + '.json' not in names:
+            if not any(name.endswith('_pet.json') for name in names):
+                findings.append(finding('warning', nifti_path, 'sidecar', "No json sidecar"))
+            continue
+        sidecar_path = os.path.join(folder, stem + '.json')
+        sidecar = read_json(sidecar_path, findings)
+        if sidecar is not None:
+            image_sidecars[stem] = sidecar
+            check_frame_timing(sidecar, frames, sidecar_path, findings)
+
+    for f in sorted(files):
+        if f.endswith('_pet.json'):
+            path = os.path.join(folder, f)
+            sidecar = read_json(path, findings)
+            if sidecar is None:
+                continue
+            # a renamed nifti shares the json's name and was checked as its sidecar above, otherwise the
+            # converter writes one image per folder beside the json
+            stem = f[:-len('.json')]
+            image_sidecar = None
+            if stem not in niftis:
+                if len(niftis) == 1:
+                    stem = next(iter(niftis))
+                    image_sidecar = image_sidecars.get(stem)
+                    check_frame_timing(sidecar, niftis[stem][1], path, findings)
+                else:
+                    findings.append(finding('warning', path, 'sidecar',
+                                            f"Can't tell which of the {len(niftis)} niftis here it describes"
+                                            if niftis else "No nifti beside it"))
+                    check_frame_timing(sidecar, None, path, findings)
+            check_pet_json(sidecar, path, findings, image_sidecar)
+        elif f.endswith('_blood.tsv'):
+            check_blood_tsv(os.path.join(folder, f), findings)
+    return findings
+
+
+def validate_tree(root, report=None, workers=None):
+    """
+    Validates every folder of an output tree on a pool of threads, only headers and sidecars are read so this
+    is bound by file system latency rather than cpu. Findings are written to the report as each folder is
+    checked, in the order the tree is walked, so a long run can be followed (or stopped) part way.
+    :param root: root of the output tree, e.g. a BIDS dataset
+    :param report: file object the report is written to as tab separated values, defaults to stdout
+    :param workers: number of threads, defaults to 4 per cpu
+    :return: dictionary of level -> number of findings, and the number of folders checked
+    """
+    report = report if report else sys.stdout
+    workers = workers if workers else (os.cpu_count() or 1) * 4
+    writer = csv.DictWriter(report, fieldnames=report_columns, delimiter='\t', lineterminator='\n')
+    writer.writeheader()
+    counts = {'error': 0, 'warning': 0, 'folders': 0}
+
+    def write(future):
+        for row in future.result():
+            writer.writerow(row)
+            counts[row['level']] += 1
+        counts['folders'] += 1
+        report.flush()
+
+    # nibabel and numpy are looked up for the first time from the worker threads
+    load_lazy_modules()
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for folder, dirs, files in os.walk(root):
+            dirs.sort()
+            pending.append(executor.submit(validate_folder, folder, files))
+            while len(pending) > workers * folders_in_flight:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+    return counts
+
+
+@Gooey
+def cli():
+    parser = GooeyParser(description="Checks converted niftis, sidecars and blood tsvs agree with one another "
+                                     "before a dataset is published. Only nifti headers are read.")
+    parser.add_argument('root', type=str, widget="DirChooser", help="Output tree or BIDS dataset to check.")
+    parser.add_argument('-o', '--report', type=str, default=None, widget="FileSaver",
+                        help="Write the report to this tsv instead of the screen.")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Number of threads to check with, defaults to 4 per cpu.")
+    parser.add_argument('--strict', action='store_true', help="Exit with an error on warnings too.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        raise FileNotFoundError(f"{args.root} is not a valid path")
+
+    if args.report:
+        with open(args.report, 'w', newline='') as report:
+            counts = validate_tree(args.root, report, args.workers)
+    else:
+        counts = validate_tree(args.root, workers=args.workers)
+    print(f"Checked {counts['folders']} folders: {counts['error']} errors, {counts['warning']} warnings.",
+          file=sys.stderr if not args.report else sys.stdout)
+    if counts['error'] or (args.strict and counts['warning']):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,385 @@
+import importlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from batch_convert import flush_participants, print_result
+from convert import engines
+from dataset_run import is_dicom, is_ecat, make_job, run_dataset_job, skipped_extensions
+from lazy_imports import Gooey, GooeyParser
+from parallel_gzip import BackgroundCompressor, compression_modes
+
+# determine whether to run as gui or not
+if len(sys.argv) >= 2:
+    if '--ignore-gooey' not in sys.argv:
+        sys.argv.append('--ignore-gooey')
+
+state_filename = '.bespoke_watch_state.json'
+
+
+def session_signature(paths):
+    """
+    :param paths: files making up a session
+    :return: [number of files, total size, newest modification time], changes whenever a file is added or grows
+    """
+    count, size, newest = 0, 0, 0
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # removed since it was listed, the next look at the session will notice
+            continue
+        count += 1
+        size += stat.st_size
+        newest = max(newest, stat.st_mtime_ns)
+    return [count, size, newest]
+
+
+def ignore_interrupts():
+    # workers finish the session they're on when ctrl-c is pressed, the watcher decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class WatchFolder:
+    def __init__(self, input_root, output_root=None, state_path=None, settle_seconds=60, poll_interval=5,
+                 workers=None, use_watchdog=True, **options):
+        """
+        Watches an incoming folder and converts dicom sessions (folders holding dicoms) and ecat files once they've
+        stopped changing for settle_seconds. Only folders that something happened in are looked at: watchdog
+        (if installed) reports them, otherwise folder modification times are polled, and sessions that are still
+        settling are re-checked each poll since a file growing in place doesn't change its folder. Converted
+        sessions and the state they were converted in are kept in a state file so a restart only converts what's
+        new or has changed since.
+        :param input_root: folder the scanner exports into
+        :param output_root: mirror the input tree under this folder for the outputs, defaults to converting in place
+        :param state_path: where to keep the state file, defaults to state_filename inside of input_root
+        :param settle_seconds: how long a session has to go unchanged before it's converted
+        :param poll_interval: seconds between looks at the folder
+        :param workers: number of conversions to run at once, defaults to the number of cpus
+        :param use_watchdog: use watchdog for file system events when it's installed
+        :param options: passed on to dataset_run.run_dataset_job
+        """
+        self.input_root = os.path.abspath(input_root)
+        self.output_root = os.path.abspath(output_root) if output_root else None
+        self.state_path = state_path if state_path else os.path.join(self.input_root, state_filename)
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.workers = workers if workers else os.cpu_count() or 1
+        self.options = options
+
+        self.state = {}  # session -> {'kind', 'signature', 'status', 'error', 'finished'} of its last conversion
+        self.folder_mtimes = {}  # folder -> modification time when it was last listed
+        self.subfolders = {}  # folder -> its sub folders when it was last listed
+        self.sessions = {}  # session -> {'kind', 'paths', 'signature', 'changed'} for sessions seen since starting
+        self.dirty = set()  # folders reported by watchdog that need listing
+        self.dirty_lock = threading.Lock()
+        self.ready = []  # sessions that have settled and are waiting for a worker
+        self.running = {}  # future -> (session, signature)
+        self.stopping = False
+        self.observer = None
+        # with background compression workers write .nii and this process gzips them while they convert the next
+        self.compressor = BackgroundCompressor(options.get('gzip_threads')) \
+            if options.get('compression') == 'background' else None
+        self.load_state()
+        if use_watchdog:
+            self.start_observer()
+
+    def load_state(self):
+        if not os.path.isfile(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r') as infile:
+                self.state = json.load(infile).get('sessions', {})
+        except (OSError, ValueError) as err:
+            print(f"Unable to read watch state at {self.state_path}, starting fresh: {err}")
+
+    def save_state(self):
+        temporary_path = self.state_path + f'.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as outfile:
+            json.dump({'input_root': self.input_root, 'sessions': self.state}, outfile, indent=4)
+        os.replace(temporary_path, self.state_path)
+
+    def start_observer(self):
+        """
+        Subscribes to file system events with watchdog, falls back to polling if it isn't installed
+        """
+        try:
+            observers = importlib.import_module('watchdog.observers')
+            events = importlib.import_module('watchdog.events')
+        except ImportError:
+            print("watchdog isn't installed, polling for changes instead.")
+            return
+
+        watcher = self
+
+        class Handler(events.FileSystemEventHandler):
+            def on_any_event(self, event):
+                for path in (event.src_path, getattr(event, 'dest_path', None)):
+                    if path:
+                        watcher.mark_dirty(path if event.is_directory else os.path.dirname(path))
+
+        self.observer = observers.Observer()
+        self.observer.schedule(Handler(), self.input_root, recursive=True)
+        self.observer.daemon = True
+        self.observer.start()
+
+    def mark_dirty(self, folder):
+        with self.dirty_lock:
+            self.dirty.add(os.path.abspath(folder))
+
+    def ignored(self, folder):
+        """
+        :return: True for hidden folders and the output tree when it's kept inside of the input folder
+        """
+        relative_path = os.path.relpath(folder, self.input_root)
+        if relative_path != '.' and any(part.startswith('.') for part in relative_path.split(os.sep)):
+            return True
+        return self.output_root is not None and (folder == self.output_root or
+                                                 folder.startswith(self.output_root + os.sep))
+
+    def changed_folders(self):
+        """
+        :return: folders that need listing, all of them the first time round, afterwards those reported by watchdog
+        or (when polling) those whose modification time has changed
+        """
+        if self.observer is not None and self.folder_mtimes:
+            with self.dirty_lock:
+                dirty, self.dirty = self.dirty, set()
+            changed = set()
+            for folder in dirty:
+                if not os.path.isdir(folder) or self.ignored(folder):
+                    continue
+                changed.add(folder)
+                # a folder copied in whole shows up as a change to its parent, pick up everything inside of it
+                for entry in os.scandir(folder):
+                    if entry.is_dir() and entry.path not in self.folder_mtimes and not self.ignored(entry.path):
+                        changed.update(root for root, dirs, files in os.walk(entry.path) if not self.ignored(root))
+            return changed
+
+        changed = set()
+        stack = [self.input_root]
+        while stack:
+            folder = stack.pop()
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+                entries = list(os.scandir(folder)) if self.folder_mtimes.get(folder) != mtime else None
+            except OSError:
+                continue
+            if entries is not None:
+                changed.add(folder)
+                self.folder_mtimes[folder] = mtime
+                self.subfolders[folder] = [entry.path for entry in entries
+                                           if entry.is_dir() and not self.ignored(entry.path)]
+            # unchanged folders can still have changes further down
+            stack.extend(self.subfolders.get(folder, []))
+        return changed
+
+    def list_folder(self, folder):
+        """
+        Finds the sessions in a single folder and updates what's known about them
+        """
+        try:
+            names = sorted(name for name in os.listdir(folder) if not name.startswith('.'))
+        except OSError:
+            return
+        self.folder_mtimes.setdefault(folder, 0)
+        dicoms = []
+        for name in names:
+            path = os.path.join(folder, name)
+            if not os.path.isfile(path):
+                continue
+            if name.lower().endswith('.v'):
+                if is_ecat(path):
+                    self.observe(path, 'ecat', [path])
+            elif not name.lower().endswith(skipped_extensions) and is_dicom(path):
+                dicoms.append(path)
+        if dicoms:
+            self.observe(folder, 'dicom', dicoms)
+
+    def observe(self, session, kind, paths):
+        signature = session_signature(paths)
+        known = self.sessions.get(session)
+        if known is None:
+            # a session that was already there when we started has been settling since its newest file was written
+            changed = min(time.time(), signature[2] / 1e9)
+            self.sessions[session] = {'kind': kind, 'paths': paths, 'signature': signature, 'changed': changed}
+        elif known['signature'] != signature or known['paths'] != paths:
+            self.sessions[session] = {'kind': kind, 'paths': paths, 'signature': signature, 'changed': time.time()}
+
+    def poll(self):
+        """
+        Looks for new and changed sessions, then queues up those that have settled
+        """
+        for folder in self.changed_folders():
+            self.list_folder(folder)
+
+        now = time.time()
+        queued = set(self.ready) | {session for session, _ in self.running.values()}
+        for session, known in list(self.sessions.items()):
+            if session in queued:
+                continue
+            converted = self.state.get(session)
+            if converted and converted['signature'] == known['signature']:
+                # converted and unchanged since, if anything lands in its folder list_folder has already looked
+                # at it again above, so there's no need to stat every file of every session ever seen
+                continue
+            # files growing in place don't touch their folder, so keep checking sessions that haven't settled
+            self.observe(session, known['kind'], known['paths'])
+            known = self.sessions[session]
+            if converted and converted['signature'] == known['signature']:
+                continue
+            if known['signature'][0] and now - known['changed'] >= self.settle_seconds:
+                self.ready.append(session)
+
+    def submit(self, executor):
+        """
+        Hands settled sessions to the workers, no more than one per worker is in flight so a burst of new
+        sessions waits here rather than piling up inside of the pool
+        """
+        while self.ready and len(self.running) < self.workers and not self.stopping:
+            session = self.ready.pop(0)
+            known = self.sessions[session]
+            job = self.make_job(session)
+            print(f"Converting {session}")
+            future = executor.submit(run_dataset_job, job, self.options)
+            self.running[future] = (session, known['signature'])
+
+    def collect(self, timeout):
+        """
+        Waits up to timeout seconds for conversions to finish and records their results
+        :return: number of conversions that finished
+        """
+        if not self.running:
+            time.sleep(timeout)
+            return 0
+        done, _ = wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            session, signature = self.running.pop(future)
+            try:
+                result = future.result()
+            except Exception as err:
+                result = {'folder': session, 'status': 'failed', 'error': f"{type(err).__name__}: {err}"}
+            uncompressed = result.pop('uncompressed', None)
+            if self.compressor is not None and uncompressed:
+                self.compressor.submit(uncompressed)
+            print_result(result)
+            # a session that changed while it was converting won't match this signature and is converted again
+            self.state[session] = {'kind': self.sessions[session]['kind'], 'signature': signature,
+                                   'status': result['status'], 'error': result['error'], 'finished': time.time()}
+        if done:
+            self.save_state()
+        return len(done)
+
+    def make_job(self, session):
+        return make_job(self.sessions[session]['kind'] if session in self.sessions else self.state[session]['kind'],
+                        session, self.input_root, self.output_root, self.options.get('metadata_path'))
+
+    def flush_participants(self):
+        flush_participants([self.make_job(session) for session, converted in self.state.items()
+                            if converted['kind'] == 'dicom'], self.options.get('dataset_root'))
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self, once=False):
+        """
+        Watches until stopped (SIGINT or SIGTERM), in flight conversions are allowed to finish
+        :param once: convert the sessions that have settled, wait for them, then return
+        :return:
+        """
+        if threading.current_thread() is threading.main_thread():
+            for signal_number in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signal_number, self.stop)
+
+        print(f"Watching {self.input_root}" + (" with watchdog" if self.observer else " by polling"))
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=ignore_interrupts) as executor:
+            while not self.stopping:
+                self.poll()
+                self.submit(executor)
+                if self.collect(self.poll_interval) and not self.running:
+                    self.flush_participants()
+                if once and not self.ready and not self.running:
+                    break
+            while self.running:
+                self.collect(self.poll_interval)
+
+        if self.observer is not None:
+            self.observer.stop()
+        if self.compressor is not None:
+            for error in self.compressor.close():
+                print(error)
+        self.flush_participants()
+        self.save_state()
+
+
+@Gooey
+def cli():
+    parser = GooeyParser(description="Watches a folder and converts dicom sessions and ecat files as they arrive.")
+    parser.add_argument('input_root', type=str, widget="DirChooser", help="Folder the scanner exports into.")
+    parser.add_argument('-o', '--output-root', type=str, default=None, widget="DirChooser",
+                        help="Mirror the input tree under this folder for the outputs, defaults to converting in place.")
+    parser.add_argument('--state-path', type=str, default=None, widget="FileSaver",
+                        help=f"Where to keep track of converted sessions, defaults to {state_filename} in the input " +
+                             "folder.")
+    parser.add_argument('--settle-seconds', type=float, default=60,
+                        help="Convert a session once its files have stopped changing for this many seconds.")
+    parser.add_argument('--poll-interval', type=float, default=5, help="Seconds between looks at the folder.")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Number of sessions to convert at once, defaults to the number of cpus.")
+    parser.add_argument('--no-watchdog', action='store_true',
+                        help="Poll folder modification times even if watchdog is installed.")
+    parser.add_argument('--once', action='store_true',
+                        help="Convert whatever has settled and exit instead of watching.")
+    parser.add_argument('-m', '--metadata-path', type=str, default=None, widget="FileChooser",
+                        help="Metadata spreadsheet for every dicom session.")
+    parser.add_argument('-r', '--dataset-root', type=str, default=None, widget="DirChooser",
+                        help="Root of the BIDS dataset for participants.tsv, defaults to the output root.")
+    parser.add_argument('-c', '--cache-dir', type=str, default=None, widget="DirChooser",
+                        help="Reuse dcm2niix outputs stored in this folder.")
+    parser.add_argument('-M', '--metadata-cache-dir', type=str, default=None, widget="DirChooser",
+                        help="Keep parsed metadata workbooks in this folder.")
+    parser.add_argument('--mapping', type=str, default=None, widget="FileChooser",
+                        help="Metadata mapping spec, defaults to mappings/nimh_pet.json.")
+    parser.add_argument('-l', '--log-dir', type=str, default=None, widget="DirChooser",
+                        help="Write each dicom session's dcm2niix output to a log file in this folder.")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="Fail a dicom session if dcm2niix runs for longer than this many seconds.")
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float32', 'float64'],
+                        help="Data type of converted ecat images.")
+    parser.add_argument('--stream', action='store_true', help="Convert ecats one frame at a time straight to disk.")
+    parser.add_argument('-z', '--compression', type=str, default='gzip', choices=compression_modes,
+                        help="gzip the niftis as they're converted, leave them uncompressed, or write them " +
+                             "uncompressed and gzip them in the background while the next sessions convert.")
+    parser.add_argument('--gzip-threads', type=int, default=None,
+                        help="Number of threads to gzip each nifti with, defaults to the number of cpus.")
+    parser.add_argument('-e', '--engine', type=str, default='dcm2niix', choices=engines,
+                        help="Convert dicom sessions with the dcm2niix executable, or natively with pydicom and " +
+                             "nibabel.")
+    parser.add_argument('--verify-cache', action='store_true',
+                        help="Check the checksums of cached conversions before reusing them, not just their sizes " +
+                             "and modification times.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.input_root):
+        raise FileNotFoundError(f"{args.input_root} is not a valid path")
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    watcher = WatchFolder(args.input_root, output_root=args.output_root, state_path=args.state_path,
+                          settle_seconds=args.settle_seconds, poll_interval=args.poll_interval,
+                          workers=args.workers, use_watchdog=not args.no_watchdog,
+                          metadata_path=args.metadata_path,
+                          dataset_root=args.dataset_root if args.dataset_root else args.output_root,
+                          cache_dir=args.cache_dir, metadata_cache_dir=args.metadata_cache_dir, mapping=args.mapping,
+                          log_dir=args.log_dir, timeout=args.timeout, dtype=args.dtype, stream=args.stream,
+                          compression=args.compression, gzip_threads=args.gzip_threads, engine=args.engine,
+                          verify_cache=args.verify_cache)
+    watcher.run(once=args.once)
+
+
+if __name__ == "__main__":
+    cli()